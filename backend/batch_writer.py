@@ -0,0 +1,157 @@
+# File: batch_writer.py
+"""
+异步批量写入 (write-behind)
+
+请求路径上只把记录追加到内存缓冲区；后台任务按批 (攒够 max_batch 条或每隔 flush_interval 秒，先到者为准)
+在线程池里调用 flush 函数批量落库，热路径上没有任何磁盘 IO。
+缓冲区有上限: 数据库长时间写不进去时丢弃最旧的记录并计数，不会把内存撑爆。
+写入失败的一批单独留着按指数退避重试，连续失败 max_retries 次后逐条重写，仍写不进去的记录
+记日志后移入死信 (保留最近 max_dead_letters 条，计数见 stats)，一条坏数据不会一直堵住后面的写入。
+
+用法:
+    writer = BatchWriter("usage", write_rows, max_batch=500, flush_interval=1.0)
+    writer.start()          # 在事件循环里调用 (例如 lifespan)
+    writer.add({"...": 1})  # 非阻塞
+    await writer.close()    # 退出前把剩余记录写完
+"""
+
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Any, Callable, Optional
+
+logger = logging.getLogger("turtlesoup")
+
+
+class BatchWriter:
+    def __init__(
+        self,
+        name: str,
+        flush_fn: Callable[[list], Any],
+        *,
+        max_batch: int = 500,
+        flush_interval: float = 1.0,
+        max_buffer: int = 100_000,
+        max_retries: int = 8,
+        max_retry_delay: float = 60.0,
+        max_dead_letters: int = 1000,
+        on_flushed: Optional[Callable[[list], Any]] = None,
+    ):
+        self.name = name
+        self.flush_fn = flush_fn  # 同步函数，在线程池里执行，一次收到一批记录
+        self.on_flushed = on_flushed  # 可选，一批写入成功后在事件循环里调用
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.max_retries = max_retries
+        self.max_retry_delay = max_retry_delay
+        self._buffer: deque = deque()
+        # 上次写入失败的一批: 单独保存，和它已经失败的次数、下次重试的时间一起
+        self._retry_batch: Optional[list] = None
+        self._retry_attempts = 0
+        self._retry_at = 0.0
+        self.dead_letters: deque = deque(maxlen=max_dead_letters)
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self.written = 0
+        self.dropped = 0
+        self.failed_batches = 0
+        self.dead_lettered = 0
+
+    def add(self, record):
+        if len(self._buffer) >= self.max_buffer:
+            self._buffer.popleft()
+            self.dropped += 1
+        self._buffer.append(record)
+        if len(self._buffer) >= self.max_batch and self._wakeup is not None:
+            self._wakeup.set()
+
+    def start(self):
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self, force: bool = False):
+        """把缓冲区写空；上次失败的一批先重试，没到退避时间 (且不是 force) 就等下个周期"""
+        if self._retry_batch is not None:
+            if not force and time.monotonic() < self._retry_at:
+                return
+            batch, self._retry_batch = self._retry_batch, None
+            if not await self._write(batch):
+                return
+        while self._buffer:
+            batch = [self._buffer.popleft() for _ in range(min(self.max_batch, len(self._buffer)))]
+            if not await self._write(batch):
+                return
+
+    async def _write(self, batch: list) -> bool:
+        try:
+            await asyncio.to_thread(self.flush_fn, batch)
+        except Exception as e:
+            self.failed_batches += 1
+            self._retry_attempts += 1
+            if self._retry_attempts >= self.max_retries:
+                logger.error(
+                    f"❌ BatchWriter[{self.name}] batch failed {self._retry_attempts} times "
+                    f"({len(batch)} records), retrying one by one: {e}"
+                )
+                self._retry_attempts = 0
+                await self._write_each(batch)
+                return True
+            delay = min(self.flush_interval * 2 ** (self._retry_attempts - 1), self.max_retry_delay)
+            self._retry_batch = batch
+            self._retry_at = time.monotonic() + delay
+            logger.warning(
+                f"⚠️ BatchWriter[{self.name}] flush failed ({len(batch)} records, "
+                f"attempt {self._retry_attempts}/{self.max_retries}, retry in {delay:.1f}s): {e}"
+            )
+            return False
+        self._retry_attempts = 0
+        self._flushed(batch)
+        return True
+
+    async def _write_each(self, batch: list):
+        """逐条写入，找出写不进去的记录移入死信，其余照常落库"""
+        for record in batch:
+            try:
+                await asyncio.to_thread(self.flush_fn, [record])
+            except Exception as e:
+                self.dead_letters.append(record)
+                self.dead_lettered += 1
+                logger.error(f"❌ BatchWriter[{self.name}] dead-lettered record {record!r}: {e}")
+                continue
+            self._flushed([record])
+
+    def _flushed(self, batch: list):
+        self.written += len(batch)
+        if self.on_flushed is not None:
+            self.on_flushed(batch)
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush(force=True)
+
+    def stats(self):
+        return {
+            "buffered": len(self._buffer) + len(self._retry_batch or ()),
+            "written": self.written,
+            "dropped": self.dropped,
+            "failed_batches": self.failed_batches,
+            "retrying": self._retry_attempts if self._retry_batch is not None else 0,
+            "dead_lettered": self.dead_lettered,
+        }
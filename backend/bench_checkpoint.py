@@ -0,0 +1,145 @@
+# File: bench_checkpoint.py
+"""
+Checkpoint 写入延迟基准测试
+
+模拟若干局游戏（每轮追加一问一答，从不总结），统计每轮 checkpoint 写入 (aput) 的耗时。
+分别给出每局前 10% 轮次和最后 10% 轮次的 p50: 两者接近说明写入开销与对局长度无关；
+sqlite-full 是不开逐条存储 (history 整表序列化) 的对照组，后段会明显变慢。
+
+用法:
+    python bench_checkpoint.py                 # memory + sqlite + sqlite-full
+    python bench_checkpoint.py --turns 500     # 单局轮数
+    REDIS_URL=redis://localhost:6379/0 python bench_checkpoint.py   # 额外测试 redis
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+import uuid
+from typing import Annotated, List, TypedDict
+
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage
+from langgraph.graph import END, StateGraph
+from langgraph.graph.message import add_messages
+
+from checkpointer import create_checkpointer
+
+
+class BenchState(TypedDict):
+    # 与 server.GameState 保持相同的字段，避免导入 server 带来的副作用
+    puzzle_id: str
+    history: Annotated[List[BaseMessage], add_messages]
+    transcript: List[str]
+    recent_history_text: str
+    summary: str
+    turn_count: int
+    model: str
+    last_cost: float
+    last_tokens: int
+    last_cached_tokens: int
+
+
+async def fake_host(state: BenchState):
+    reply = AIMessage(content="不是。这与汤底无关。")
+    transcript = (state["transcript"] + [f"用户: {state['history'][-1].content}", f"主持人: {reply.content}"])[-20:]
+    return {
+        "history": [reply],
+        "transcript": transcript,
+        "recent_history_text": "".join(f"{line}\n" for line in transcript),
+        "turn_count": state["turn_count"] + 1,
+        "last_cost": 0.0001,
+        "last_tokens": 1200,
+    }
+
+
+def build_graph(saver):
+    workflow = StateGraph(BenchState)
+    workflow.add_node("host", fake_host)
+    workflow.set_entry_point("host")
+    workflow.add_edge("host", END)
+    return workflow.compile(checkpointer=saver)
+
+
+async def run_backend(name, saver, games, turns):
+    timings = []
+    # 每次写入发生在第几轮，用来比较对局前段和后段的写入耗时
+    turn_of_write = []
+    current_turn = 0
+    original_aput = saver.aput
+
+    async def timed_aput(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await original_aput(*args, **kwargs)
+        finally:
+            timings.append(time.perf_counter() - start)
+            turn_of_write.append(current_turn)
+
+    saver.aput = timed_aput
+    app_graph = build_graph(saver)
+
+    for _ in range(games):
+        config = {"configurable": {"thread_id": str(uuid.uuid4())}}
+        await app_graph.aupdate_state(
+            config,
+            {
+                "puzzle_id": "100元钱",
+                "history": [],
+                "transcript": [],
+                "recent_history_text": "",
+                "summary": "游戏开始。",
+                "turn_count": 0,
+                "model": "gemini-2.5-flash",
+                "last_cost": 0.0,
+                "last_tokens": 0,
+                "last_cached_tokens": 0,
+            },
+        )
+        for turn in range(turns):
+            current_turn = turn
+            question = HumanMessage(content=f"第 {turn} 个问题：他是自杀吗？")
+            await app_graph.ainvoke({"history": [question]}, config)
+
+    edge = max(1, turns // 10)
+    early = [t * 1000 for t, turn in zip(timings, turn_of_write) if turn < edge]
+    late = [t * 1000 for t, turn in zip(timings, turn_of_write) if turn >= turns - edge]
+    timings_ms = sorted(t * 1000 for t in timings)
+    p = lambda q: timings_ms[min(len(timings_ms) - 1, int(len(timings_ms) * q))]
+    print(
+        f"{name:<11} | writes={len(timings_ms):<6} | mean={statistics.mean(timings_ms):.3f}ms"
+        f" | p50={p(0.50):.3f}ms | p95={p(0.95):.3f}ms | p99={p(0.99):.3f}ms"
+        f" | early p50={statistics.median(early):.3f}ms | late p50={statistics.median(late):.3f}ms"
+    )
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--games", type=int, default=5)
+    parser.add_argument("--turns", type=int, default=200)
+    args = parser.parse_args()
+
+    print(f"\n--- Checkpoint 写入延迟 ({args.games} 局 x {args.turns} 轮) ---")
+    await run_backend("memory", create_checkpointer("memory"), args.games, args.turns)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        saver = create_checkpointer(
+            "sqlite", sqlite_path=os.path.join(tmp, "bench.db"), append_channels=("history",)
+        )
+        await run_backend("sqlite", saver, args.games, args.turns)
+        saver.close()
+        saver = create_checkpointer("sqlite", sqlite_path=os.path.join(tmp, "bench-full.db"))
+        await run_backend("sqlite-full", saver, args.games, args.turns)
+        saver.close()
+
+    if os.environ.get("REDIS_URL"):
+        saver = create_checkpointer(
+            "redis", redis_url=os.environ["REDIS_URL"], append_channels=("history",)
+        )
+        await run_backend("redis", saver, args.games, args.turns)
+        saver.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
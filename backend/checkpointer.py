@@ -0,0 +1,851 @@
+# File: checkpointer.py
+"""
+持久化的 LangGraph checkpointer，用来替代进程内的 MemorySaver。
+
+- 每个 thread 只保留最新一个 checkpoint（游戏不需要时间回溯），旧数据随写随删，不会无限增长
+- 各通道 (story / history / summary ...) 的值单独按通道存储，每轮只写入本轮有变化的通道（增量写入）
+- 消息列表通道 (append_channels，例如 history) 按消息逐条存储，每轮只写入新增 / 改动的消息、
+  删除被 RemoveMessage 移除的消息，写入量与对局长度无关
+- 写入时检查父 checkpoint 仍是当前最新的那个，两个 worker 基于同一状态并发写入时后到的一方
+  抛出 CheckpointConflict，而不是把两次写入的通道值混在一起
+- SQLite 后端使用 WAL 模式，多个 uvicorn worker 可以共享同一个数据库文件
+- 可选 Redis 后端 (需要安装 redis)，适合多机部署
+- 记录每个 thread 的最后写入时间，闲置对局的淘汰直接按时间查询存储 (多个 worker 看到的是同一份数据)
+
+用法:
+    saver = create_checkpointer("sqlite", sqlite_path="./checkpoints.db", append_channels=("history",))
+    app_graph = workflow.compile(checkpointer=saver)
+"""
+
+import asyncio
+import random
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Iterator, List, NamedTuple, Optional, Sequence
+
+from langchain_core.runnables import RunnableConfig
+from langgraph.checkpoint.base import (
+    WRITES_IDX_MAP,
+    BaseCheckpointSaver,
+    ChannelVersions,
+    Checkpoint,
+    CheckpointMetadata,
+    CheckpointTuple,
+    get_checkpoint_id,
+    get_checkpoint_metadata,
+    writes_sort_key,
+)
+from langgraph.checkpoint.memory import MemorySaver
+
+try:
+    import redis
+except ImportError:  # Redis 后端是可选的
+    redis = None
+
+
+class CheckpointConflict(RuntimeError):
+    """thread 的最新 checkpoint 已经不是本次写入的父 checkpoint (别的写入者抢先了一步)"""
+
+
+# --- 存储后端 ---
+# 后端只负责按 thread 存取序列化后的字节，所有 LangGraph 相关的逻辑都在 DeltaCheckpointSaver 里
+#
+# checkpoint 行: (checkpoint_id, parent_checkpoint_id, type, checkpoint, metadata_type, metadata)
+#               写入时后端另外记下 updated_at (time.time())，供闲置淘汰查询
+# 通道值:       channel -> (version, type, value)
+# 待写入:       (task_id, idx, channel, type, value, task_path)
+# 逐条存储的消息: channel -> (msg_id, seq, type, value)，按 seq 排序还原列表；
+#               这类通道在通道值里只记版本号，type 为 APPEND_TYPE
+#
+# save_checkpoint 的 messages 参数: channel -> MessageDelta
+#   replace 为 True 时先清空该通道的全部消息再写入 upserts (整表重写)
+#   upserts: [(msg_id, seq, type, value)]  新增或内容有变化的消息
+#   deletes: [msg_id]                     被移除的消息
+APPEND_TYPE = "append"
+
+
+class MessageDelta(NamedTuple):
+    replace: bool
+    upserts: list
+    deletes: list
+
+
+class SQLiteBackend:
+    def __init__(self, path: str):
+        self.path = path
+        # 同一个连接在多个线程间共享（async 方法通过 to_thread 调用），用锁串行化访问
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS checkpoints (
+                thread_id TEXT NOT NULL,
+                checkpoint_ns TEXT NOT NULL DEFAULT '',
+                checkpoint_id TEXT NOT NULL,
+                parent_checkpoint_id TEXT,
+                type TEXT,
+                checkpoint BLOB,
+                metadata_type TEXT,
+                metadata BLOB,
+                updated_at REAL,
+                PRIMARY KEY (thread_id, checkpoint_ns)
+            );
+            CREATE TABLE IF NOT EXISTS checkpoint_blobs (
+                thread_id TEXT NOT NULL,
+                checkpoint_ns TEXT NOT NULL DEFAULT '',
+                channel TEXT NOT NULL,
+                version TEXT NOT NULL,
+                type TEXT NOT NULL,
+                blob BLOB,
+                PRIMARY KEY (thread_id, checkpoint_ns, channel)
+            );
+            CREATE TABLE IF NOT EXISTS checkpoint_writes (
+                thread_id TEXT NOT NULL,
+                checkpoint_ns TEXT NOT NULL DEFAULT '',
+                checkpoint_id TEXT NOT NULL,
+                task_id TEXT NOT NULL,
+                idx INTEGER NOT NULL,
+                channel TEXT NOT NULL,
+                type TEXT,
+                blob BLOB,
+                task_path TEXT NOT NULL DEFAULT '',
+                PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id, task_id, idx)
+            );
+            CREATE TABLE IF NOT EXISTS checkpoint_messages (
+                thread_id TEXT NOT NULL,
+                checkpoint_ns TEXT NOT NULL DEFAULT '',
+                channel TEXT NOT NULL,
+                msg_id TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                type TEXT NOT NULL,
+                blob BLOB,
+                PRIMARY KEY (thread_id, checkpoint_ns, channel, msg_id)
+            );
+            """
+        )
+        # 旧库没有 updated_at 列: 补上，已有对局从升级时刻开始计算闲置时间
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(checkpoints)")}
+        if "updated_at" not in columns:
+            try:
+                self._conn.execute("ALTER TABLE checkpoints ADD COLUMN updated_at REAL")
+            except sqlite3.OperationalError as e:
+                # 多个 worker 同时启动时，别的进程可能已经加过了
+                if "duplicate column" not in str(e):
+                    raise
+            self._conn.execute(
+                "UPDATE checkpoints SET updated_at = ? WHERE updated_at IS NULL", (time.time(),)
+            )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_checkpoints_updated_at ON checkpoints (updated_at)"
+        )
+
+    def load_checkpoint(self, thread_id, checkpoint_ns, checkpoint_id=None):
+        sql = (
+            "SELECT checkpoint_id, parent_checkpoint_id, type, checkpoint, metadata_type, metadata "
+            "FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ?"
+        )
+        params = [thread_id, checkpoint_ns]
+        if checkpoint_id:
+            sql += " AND checkpoint_id = ?"
+            params.append(checkpoint_id)
+        with self._lock:
+            return self._conn.execute(sql, params).fetchone()
+
+    def load_blobs(self, thread_id, checkpoint_ns):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT channel, version, type, blob FROM checkpoint_blobs "
+                "WHERE thread_id = ? AND checkpoint_ns = ?",
+                (thread_id, checkpoint_ns),
+            ).fetchall()
+        return {channel: (version, type_, blob) for channel, version, type_, blob in rows}
+
+    def load_messages(self, thread_id, checkpoint_ns, channel):
+        with self._lock:
+            return self._conn.execute(
+                "SELECT msg_id, seq, type, blob FROM checkpoint_messages "
+                "WHERE thread_id = ? AND checkpoint_ns = ? AND channel = ? ORDER BY seq",
+                (thread_id, checkpoint_ns, channel),
+            ).fetchall()
+
+    def load_writes(self, thread_id, checkpoint_ns, checkpoint_id):
+        with self._lock:
+            return self._conn.execute(
+                "SELECT task_id, idx, channel, type, blob, task_path FROM checkpoint_writes "
+                "WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ?",
+                (thread_id, checkpoint_ns, checkpoint_id),
+            ).fetchall()
+
+    def save_checkpoint(self, thread_id, checkpoint_ns, row, blobs, messages, parent_id):
+        """在一个事务里写入 checkpoint 行、有变化的通道和消息，并清掉旧 checkpoint 的待写入
+
+        当前最新的 checkpoint 不是 parent_id 时整个事务回滚并抛出 CheckpointConflict。
+        """
+        with self._lock:
+            conn = self._conn
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                current = conn.execute(
+                    "SELECT checkpoint_id FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ?",
+                    (thread_id, checkpoint_ns),
+                ).fetchone()
+                if current is not None and current[0] != parent_id:
+                    raise CheckpointConflict(
+                        f"{thread_id}: latest checkpoint is {current[0]}, not {parent_id}"
+                    )
+                conn.execute(
+                    "INSERT OR REPLACE INTO checkpoints (thread_id, checkpoint_ns, checkpoint_id, "
+                    "parent_checkpoint_id, type, checkpoint, metadata_type, metadata, updated_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (thread_id, checkpoint_ns, *row, time.time()),
+                )
+                conn.executemany(
+                    "INSERT OR REPLACE INTO checkpoint_blobs VALUES (?, ?, ?, ?, ?, ?)",
+                    [
+                        (thread_id, checkpoint_ns, channel, version, type_, blob)
+                        for channel, (version, type_, blob) in blobs.items()
+                    ],
+                )
+                for channel, delta in messages.items():
+                    key = (thread_id, checkpoint_ns, channel)
+                    if delta.replace:
+                        conn.execute(
+                            "DELETE FROM checkpoint_messages "
+                            "WHERE thread_id = ? AND checkpoint_ns = ? AND channel = ?",
+                            key,
+                        )
+                    conn.executemany(
+                        "DELETE FROM checkpoint_messages "
+                        "WHERE thread_id = ? AND checkpoint_ns = ? AND channel = ? AND msg_id = ?",
+                        [(*key, msg_id) for msg_id in delta.deletes],
+                    )
+                    conn.executemany(
+                        "INSERT OR REPLACE INTO checkpoint_messages VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        [(*key, *message) for message in delta.upserts],
+                    )
+                conn.execute(
+                    "DELETE FROM checkpoint_writes "
+                    "WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id != ?",
+                    (thread_id, checkpoint_ns, row[0]),
+                )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+
+    def save_writes(self, thread_id, checkpoint_ns, checkpoint_id, writes, overwrite):
+        verb = "INSERT OR REPLACE" if overwrite else "INSERT OR IGNORE"
+        with self._lock:
+            self._conn.executemany(
+                f"{verb} INTO checkpoint_writes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (thread_id, checkpoint_ns, checkpoint_id, task_id, idx, channel, type_, blob, task_path)
+                    for task_id, idx, channel, type_, blob, task_path in writes
+                ],
+            )
+
+    def list_threads(self):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT thread_id, checkpoint_ns FROM checkpoints ORDER BY checkpoint_id DESC"
+            ).fetchall()
+        return rows
+
+    def list_idle_threads(self, before, limit):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT thread_id FROM checkpoints WHERE updated_at < ? ORDER BY updated_at LIMIT ?",
+                (before, limit),
+            ).fetchall()
+        return list(dict.fromkeys(thread_id for (thread_id,) in rows))
+
+    def storage_stats(self):
+        """(thread 数, 存储的字节数)；字节数只统计各表里的序列化数据，不含索引和页面开销"""
+        with self._lock:
+            conn = self._conn
+            threads = conn.execute("SELECT COUNT(DISTINCT thread_id) FROM checkpoints").fetchone()[0]
+            size = sum(
+                conn.execute(f"SELECT COALESCE(SUM({expr}), 0) FROM {table}").fetchone()[0]
+                for table, expr in (
+                    ("checkpoints", "LENGTH(checkpoint) + LENGTH(metadata)"),
+                    ("checkpoint_blobs", "LENGTH(blob)"),
+                    ("checkpoint_writes", "LENGTH(blob)"),
+                    ("checkpoint_messages", "LENGTH(blob)"),
+                )
+            )
+        return threads, size
+
+    def delete_thread(self, thread_id):
+        self.delete_idle_thread(thread_id, None)
+
+    def delete_idle_thread(self, thread_id, before):
+        """删除 thread；给了 before 时只在最后写入早于它时才删 (检查和删除在同一个事务里)"""
+        with self._lock:
+            conn = self._conn
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                if before is not None:
+                    row = conn.execute(
+                        "SELECT MAX(updated_at) FROM checkpoints WHERE thread_id = ?", (thread_id,)
+                    ).fetchone()
+                    if row[0] is None or row[0] >= before:
+                        conn.execute("ROLLBACK")
+                        return False
+                for table in (
+                    "checkpoints",
+                    "checkpoint_blobs",
+                    "checkpoint_writes",
+                    "checkpoint_messages",
+                ):
+                    conn.execute(f"DELETE FROM {table} WHERE thread_id = ?", (thread_id,))
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return True
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def _pack(*parts: Any) -> bytes:
+    """把若干字段打包成一个 Redis 值: 长度前缀 + 内容"""
+    out = bytearray()
+    for part in parts:
+        data = b"" if part is None else part if isinstance(part, bytes) else str(part).encode()
+        out += len(data).to_bytes(4, "big") + data
+    return bytes(out)
+
+
+def _unpack(data: bytes) -> list[bytes]:
+    parts, pos = [], 0
+    while pos < len(data):
+        size = int.from_bytes(data[pos : pos + 4], "big")
+        parts.append(data[pos + 4 : pos + 4 + size])
+        pos += 4 + size
+    return parts
+
+
+class RedisBackend:
+    """与 SQLiteBackend 相同的存储布局，每个 thread 对应几个 hash
+
+    最后写入时间存两份: {prefix}:{thread}:updated 用于删除前的检查，
+    有序集合 {prefix}:updated (score 为时间戳) 用于按时间查出闲置的 thread。
+    """
+
+    def __init__(self, url: str, prefix: str = "turtlesoup:ckpt"):
+        if redis is None:
+            raise RuntimeError("CHECKPOINT_BACKEND=redis 需要先 pip install redis")
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def _key(self, thread_id, checkpoint_ns, kind):
+        return f"{self.prefix}:{thread_id}:{checkpoint_ns}:{kind}"
+
+    def _updated_key(self, thread_id):
+        return f"{self.prefix}:{thread_id}:updated"
+
+    def load_checkpoint(self, thread_id, checkpoint_ns, checkpoint_id=None):
+        data = self.client.get(self._key(thread_id, checkpoint_ns, "checkpoint"))
+        if data is None:
+            return None
+        cid, parent, type_, checkpoint, metadata_type, metadata = _unpack(data)
+        row = (cid.decode(), parent.decode() or None, type_.decode(), checkpoint, metadata_type.decode(), metadata)
+        if checkpoint_id and row[0] != checkpoint_id:
+            return None
+        return row
+
+    def load_blobs(self, thread_id, checkpoint_ns):
+        stored = self.client.hgetall(self._key(thread_id, checkpoint_ns, "blobs"))
+        result = {}
+        for channel, data in stored.items():
+            version, type_, blob = _unpack(data)
+            result[channel.decode()] = (version.decode(), type_.decode(), blob)
+        return result
+
+    def load_writes(self, thread_id, checkpoint_ns, checkpoint_id):
+        stored = self.client.hgetall(self._key(thread_id, checkpoint_ns, f"writes:{checkpoint_id}"))
+        rows = []
+        for data in stored.values():
+            task_id, idx, channel, type_, blob, task_path = _unpack(data)
+            rows.append((task_id.decode(), int(idx), channel.decode(), type_.decode(), blob, task_path.decode()))
+        return rows
+
+    def load_messages(self, thread_id, checkpoint_ns, channel):
+        stored = self.client.hgetall(self._key(thread_id, checkpoint_ns, f"messages:{channel}"))
+        rows = []
+        for msg_id, data in stored.items():
+            seq, type_, blob = _unpack(data)
+            rows.append((msg_id.decode(), int(seq), type_.decode(), blob))
+        rows.sort(key=lambda r: r[1])
+        return rows
+
+    def save_checkpoint(self, thread_id, checkpoint_ns, row, blobs, messages, parent_id):
+        """WATCH 最新 checkpoint: 检查父 checkpoint 和写入在同一个事务里，期间被别人改过则冲突"""
+        checkpoint_key = self._key(thread_id, checkpoint_ns, "checkpoint")
+        with self.client.pipeline(transaction=True) as pipe:
+            try:
+                pipe.watch(checkpoint_key)
+                data = pipe.get(checkpoint_key)
+                previous_id = _unpack(data)[0].decode() if data is not None else None
+                if previous_id is not None and previous_id != parent_id:
+                    raise CheckpointConflict(
+                        f"{thread_id}: latest checkpoint is {previous_id}, not {parent_id}"
+                    )
+                pipe.multi()
+                pipe.set(checkpoint_key, _pack(*row))
+                if blobs:
+                    pipe.hset(
+                        self._key(thread_id, checkpoint_ns, "blobs"),
+                        mapping={channel: _pack(*value) for channel, value in blobs.items()},
+                    )
+                for channel, delta in messages.items():
+                    key = self._key(thread_id, checkpoint_ns, f"messages:{channel}")
+                    if delta.replace:
+                        pipe.delete(key)
+                    if delta.deletes:
+                        pipe.hdel(key, *delta.deletes)
+                    if delta.upserts:
+                        pipe.hset(
+                            key,
+                            mapping={
+                                msg_id: _pack(seq, type_, blob)
+                                for msg_id, seq, type_, blob in delta.upserts
+                            },
+                        )
+                if previous_id is not None and previous_id != row[0]:
+                    pipe.delete(self._key(thread_id, checkpoint_ns, f"writes:{previous_id}"))
+                pipe.sadd(f"{self.prefix}:threads", f"{thread_id}\0{checkpoint_ns}")
+                now = time.time()
+                pipe.set(self._updated_key(thread_id), now)
+                pipe.zadd(f"{self.prefix}:updated", {thread_id: now})
+                pipe.execute()
+            except redis.WatchError:
+                raise CheckpointConflict(f"{thread_id}: checkpoint changed during write") from None
+
+    def save_writes(self, thread_id, checkpoint_ns, checkpoint_id, writes, overwrite):
+        key = self._key(thread_id, checkpoint_ns, f"writes:{checkpoint_id}")
+        pipe = self.client.pipeline(transaction=True)
+        for task_id, idx, channel, type_, blob, task_path in writes:
+            field, value = f"{task_id}:{idx}", _pack(task_id, idx, channel, type_, blob, task_path)
+            if overwrite:
+                pipe.hset(key, field, value)
+            else:
+                pipe.hsetnx(key, field, value)
+        pipe.execute()
+
+    def list_threads(self):
+        members = self.client.smembers(f"{self.prefix}:threads")
+        return [tuple(m.decode().split("\0", 1)) for m in members]
+
+    def list_idle_threads(self, before, limit):
+        members = self.client.zrangebyscore(
+            f"{self.prefix}:updated", "-inf", f"({before}", start=0, num=limit
+        )
+        return [member.decode() for member in members]
+
+    def storage_stats(self):
+        """(thread 数, 字节数)；Redis 无法便宜地按前缀统计占用，字节数取整个实例的 used_memory"""
+        threads = self.client.zcard(f"{self.prefix}:updated")
+        return threads, self.client.info("memory").get("used_memory", 0)
+
+    def delete_thread(self, thread_id):
+        self.delete_idle_thread(thread_id, None)
+
+    def delete_idle_thread(self, thread_id, before):
+        """删除 thread；给了 before 时只在最后写入早于它时才删，期间有新写入 (WATCH 失败) 则放弃"""
+        updated_key = self._updated_key(thread_id)
+        with self.client.pipeline(transaction=True) as pipe:
+            try:
+                if before is not None:
+                    pipe.watch(updated_key)
+                    updated = pipe.get(updated_key)
+                    if updated is None or float(updated) >= before:
+                        return False
+                keys = list(self.client.scan_iter(match=f"{self.prefix}:{thread_id}:*"))
+                members = [
+                    member
+                    for member in self.client.smembers(f"{self.prefix}:threads")
+                    if member.decode().split("\0", 1)[0] == thread_id
+                ]
+                pipe.multi()
+                if keys:
+                    pipe.delete(*keys)
+                if members:
+                    pipe.srem(f"{self.prefix}:threads", *members)
+                pipe.zrem(f"{self.prefix}:updated", thread_id)
+                pipe.execute()
+            except redis.WatchError:
+                return False
+        return True
+
+    def close(self):
+        self.client.close()
+
+
+# --- Checkpointer ---
+
+
+class DeltaCheckpointSaver(BaseCheckpointSaver[str]):
+    """只保留每个 thread 最新 checkpoint、按通道增量写入的 checkpointer
+
+    append_channels 里的通道 (值是带 id 的消息列表) 逐条存储。要算出本轮新增 / 改动 / 移除了哪些消息，
+    需要知道存储里现在有什么: 本进程最近读写过的 thread 在内存里记着 (checkpoint_id, 各消息)，
+    父 checkpoint 对得上就只写差异；对不上 (别的 worker 写过 / 缓存被挤掉) 时整表重写一次。
+    """
+
+    def __init__(self, backend, *, serde=None, append_channels: Sequence[str] = (), cache_size: int = 10000):
+        super().__init__(serde=serde)
+        self.backend = backend
+        self.append_channels = frozenset(append_channels)
+        self.cache_size = cache_size
+        # thread_id -> {(checkpoint_ns, channel): (checkpoint_id, {msg_id: (seq, 消息)}, 下一个 seq)}
+        self._stored_messages: OrderedDict[str, dict] = OrderedDict()
+        self._cache_lock = threading.Lock()
+
+    def _remember_messages(self, key: tuple, checkpoint_id: str, stored: dict, next_seq: int):
+        thread_id, checkpoint_ns, channel = key
+        with self._cache_lock:
+            entry = self._stored_messages.setdefault(thread_id, {})
+            entry[checkpoint_ns, channel] = (checkpoint_id, stored, next_seq)
+            self._stored_messages.move_to_end(thread_id)
+            while len(self._stored_messages) > self.cache_size:
+                self._stored_messages.popitem(last=False)
+
+    def _advance_messages(self, thread_id: str, parent_id: Optional[str], checkpoint_id: str):
+        """本次写入没有改动的消息通道，存储里的内容仍是父 checkpoint 时的那份，跟着换成新 checkpoint_id"""
+        with self._cache_lock:
+            entry = self._stored_messages.get(thread_id)
+            if entry is None:
+                return
+            for key, (cached_id, stored, next_seq) in entry.items():
+                if cached_id == parent_id:
+                    entry[key] = (checkpoint_id, stored, next_seq)
+
+    def _forget_messages(self, thread_id: str):
+        with self._cache_lock:
+            self._stored_messages.pop(thread_id, None)
+
+    def _message_delta(self, key: tuple, parent_id: Optional[str], messages: list):
+        """和存储里的消息比较，返回 (MessageDelta, 写入后的 {msg_id: (seq, 消息)}, 下一个 seq)"""
+        thread_id, checkpoint_ns, channel = key
+        with self._cache_lock:
+            cached = self._stored_messages.get(thread_id, {}).get((checkpoint_ns, channel))
+        if cached is not None and parent_id is not None and cached[0] == parent_id:
+            _, previous, next_seq = cached
+            fresh = messages[len(previous):]
+            # 最常见的情况: 只在末尾追加，前面的还是上次读 / 写时的同一批对象，逐个比较身份即可
+            if (
+                len(messages) >= len(previous)
+                and all(msg is old for msg, (_, old) in zip(messages, previous.values()))
+                and len({msg.id for msg in fresh} - previous.keys()) == len(fresh)
+            ):
+                upserts = []
+                for msg in fresh:
+                    upserts.append((msg.id, next_seq, *self.serde.dumps_typed(msg)))
+                    previous[msg.id] = (next_seq, msg)
+                    next_seq += 1
+                return MessageDelta(False, upserts, []), previous, next_seq
+
+            current_ids = {msg.id for msg in messages}
+            kept = [msg for msg in messages if msg.id in previous]
+            # add_messages 只会原地替换或在末尾追加: 保留下来的消息顺序不变、新消息都在最后，
+            # 否则 (例如调用方自己重排了列表) 按整表重写处理
+            if len(current_ids) == len(messages) and [msg.id for msg in kept] == [
+                msg_id for msg_id in previous if msg_id in current_ids
+            ] and all(msg.id not in previous for msg in messages[len(kept):]):
+                upserts, stored = [], {}
+                for msg in kept:
+                    seq, old = previous[msg.id]
+                    if old is not msg and old != msg:
+                        upserts.append((msg.id, seq, *self.serde.dumps_typed(msg)))
+                    stored[msg.id] = (seq, msg)
+                for msg in messages[len(kept):]:
+                    upserts.append((msg.id, next_seq, *self.serde.dumps_typed(msg)))
+                    stored[msg.id] = (next_seq, msg)
+                    next_seq += 1
+                deletes = [msg_id for msg_id in previous if msg_id not in current_ids]
+                return MessageDelta(False, upserts, deletes), stored, next_seq
+
+        upserts = [(msg.id, seq, *self.serde.dumps_typed(msg)) for seq, msg in enumerate(messages)]
+        stored = {msg.id: (seq, msg) for seq, msg in enumerate(messages)}
+        return MessageDelta(True, upserts, []), stored, len(messages)
+
+    # ---- 读取 ----
+
+    def get_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        row = self.backend.load_checkpoint(thread_id, checkpoint_ns, get_checkpoint_id(config))
+        if row is None:
+            return None
+        return self._build_tuple(thread_id, checkpoint_ns, row)
+
+    def _build_tuple(self, thread_id, checkpoint_ns, row) -> CheckpointTuple:
+        checkpoint_id, parent_checkpoint_id, type_, checkpoint_blob, metadata_type, metadata_blob = row
+        checkpoint: Checkpoint = self.serde.loads_typed((type_, checkpoint_blob))
+
+        # 只还原与 checkpoint 版本一致的通道值
+        channel_values = {}
+        blobs = self.backend.load_blobs(thread_id, checkpoint_ns)
+        for channel, version in checkpoint["channel_versions"].items():
+            stored = blobs.get(channel)
+            if stored is None or stored[0] != str(version) or stored[1] == "empty":
+                continue
+            if stored[1] == APPEND_TYPE:
+                rows = self.backend.load_messages(thread_id, checkpoint_ns, channel)
+                messages = [self.serde.loads_typed((type_, blob)) for _, _, type_, blob in rows]
+                channel_values[channel] = messages
+                # 记下存储里的内容，下一次写入只需写差异
+                self._remember_messages(
+                    (thread_id, checkpoint_ns, channel),
+                    checkpoint_id,
+                    {msg.id: (row[1], msg) for row, msg in zip(rows, messages)},
+                    rows[-1][1] + 1 if rows else 0,
+                )
+                continue
+            channel_values[channel] = self.serde.loads_typed((stored[1], stored[2]))
+
+        writes = sorted(
+            self.backend.load_writes(thread_id, checkpoint_ns, checkpoint_id),
+            key=lambda w: writes_sort_key(w[5], w[0], w[1]),
+        )
+        return CheckpointTuple(
+            config={
+                "configurable": {
+                    "thread_id": thread_id,
+                    "checkpoint_ns": checkpoint_ns,
+                    "checkpoint_id": checkpoint_id,
+                }
+            },
+            checkpoint={**checkpoint, "channel_values": channel_values},
+            metadata=self.serde.loads_typed((metadata_type, metadata_blob)),
+            pending_writes=[
+                (task_id, channel, self.serde.loads_typed((type_, blob)))
+                for task_id, _, channel, type_, blob, _ in writes
+            ],
+            parent_config=(
+                {
+                    "configurable": {
+                        "thread_id": thread_id,
+                        "checkpoint_ns": checkpoint_ns,
+                        "checkpoint_id": parent_checkpoint_id,
+                    }
+                }
+                if parent_checkpoint_id
+                else None
+            ),
+        )
+
+    def list(
+        self,
+        config: Optional[RunnableConfig],
+        *,
+        filter: Optional[dict[str, Any]] = None,
+        before: Optional[RunnableConfig] = None,
+        limit: Optional[int] = None,
+    ) -> Iterator[CheckpointTuple]:
+        if config is not None:
+            configurable = config["configurable"]
+            targets = [(configurable["thread_id"], configurable.get("checkpoint_ns", ""))]
+        else:
+            targets = self.backend.list_threads()
+
+        count = 0
+        for thread_id, checkpoint_ns in targets:
+            if limit is not None and count >= limit:
+                break
+            row = self.backend.load_checkpoint(thread_id, checkpoint_ns)
+            if row is None:
+                continue
+            if before and (before_id := get_checkpoint_id(before)) and row[0] >= before_id:
+                continue
+            item = self._build_tuple(thread_id, checkpoint_ns, row)
+            if filter and any(item.metadata.get(k) != v for k, v in filter.items()):
+                continue
+            count += 1
+            yield item
+
+    # ---- 写入 ----
+
+    def put(
+        self,
+        config: RunnableConfig,
+        checkpoint: Checkpoint,
+        metadata: CheckpointMetadata,
+        new_versions: ChannelVersions,
+    ) -> RunnableConfig:
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        parent_id = config["configurable"].get("checkpoint_id")
+        c = checkpoint.copy()
+        values: dict[str, Any] = c.pop("channel_values")
+
+        # 增量: 只序列化本轮版本号发生变化的通道；消息列表通道只序列化有变化的消息
+        blobs, messages, remembered = {}, {}, []
+        for channel, version in new_versions.items():
+            value = values.get(channel)
+            if (
+                channel in self.append_channels
+                and isinstance(value, list)
+                and all(getattr(msg, "id", None) for msg in value)
+            ):
+                key = (thread_id, checkpoint_ns, channel)
+                messages[channel], stored, next_seq = self._message_delta(key, parent_id, value)
+                remembered.append((key, stored, next_seq))
+                blobs[channel] = (str(version), APPEND_TYPE, b"")
+            elif channel in values:
+                blobs[channel] = (str(version), *self.serde.dumps_typed(value))
+            else:
+                blobs[channel] = (str(version), "empty", b"")
+        type_, checkpoint_blob = self.serde.dumps_typed(c)
+        metadata_type, metadata_blob = self.serde.dumps_typed(get_checkpoint_metadata(config, metadata))
+        row = (
+            checkpoint["id"],
+            parent_id,
+            type_,
+            checkpoint_blob,
+            metadata_type,
+            metadata_blob,
+        )
+        try:
+            self.backend.save_checkpoint(thread_id, checkpoint_ns, row, blobs, messages, parent_id)
+        except BaseException:
+            self._forget_messages(thread_id)
+            raise
+        self._advance_messages(thread_id, parent_id, checkpoint["id"])
+        for key, stored, next_seq in remembered:
+            self._remember_messages(key, checkpoint["id"], stored, next_seq)
+        return {
+            "configurable": {
+                "thread_id": thread_id,
+                "checkpoint_ns": checkpoint_ns,
+                "checkpoint_id": checkpoint["id"],
+            }
+        }
+
+    def put_writes(
+        self,
+        config: RunnableConfig,
+        writes: Sequence[tuple[str, Any]],
+        task_id: str,
+        task_path: str = "",
+    ) -> None:
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        checkpoint_id = config["configurable"]["checkpoint_id"]
+        rows = [
+            (task_id, WRITES_IDX_MAP.get(channel, idx), channel, *self.serde.dumps_typed(value), task_path)
+            for idx, (channel, value) in enumerate(writes)
+        ]
+        # 特殊通道 (错误 / 中断等) 允许覆盖，普通写入保持幂等
+        overwrite = all(channel in WRITES_IDX_MAP for channel, _ in writes)
+        self.backend.save_writes(thread_id, checkpoint_ns, checkpoint_id, rows, overwrite)
+
+    def delete_thread(self, thread_id: str) -> None:
+        self._forget_messages(thread_id)
+        self.backend.delete_thread(thread_id)
+
+    # ---- 容量统计 ----
+
+    def storage_stats(self) -> tuple[int, int]:
+        """(存储里的 thread 数, 大致占用字节数)"""
+        return self.backend.storage_stats()
+
+    # ---- 闲置淘汰: 时间都是 time.time() ----
+
+    def list_idle_threads(self, before: float, limit: int) -> List[str]:
+        """最后一次写入早于 before 的 thread，最久没写的在前"""
+        return self.backend.list_idle_threads(before, limit)
+
+    def delete_idle_thread(self, thread_id: str, before: float) -> bool:
+        """最后一次写入仍早于 before 时删除 thread；查询之后又有写入则保留并返回 False"""
+        if not self.backend.delete_idle_thread(thread_id, before):
+            return False
+        self._forget_messages(thread_id)
+        return True
+
+    def close(self) -> None:
+        self.backend.close()
+
+    def get_next_version(self, current: Optional[str], channel: None = None) -> str:
+        # 与 MemorySaver 相同的字符串版本号，便于在两种存储之间拷贝 checkpoint
+        if current is None:
+            current_v = 0
+        elif isinstance(current, int):
+            current_v = current
+        else:
+            current_v = int(current.split(".")[0])
+        return f"{current_v + 1:032}.{random.random():016}"
+
+    # ---- async: 后端都是阻塞 I/O，放到线程池里执行，避免卡住事件循环 ----
+
+    async def aget_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        return await asyncio.to_thread(self.get_tuple, config)
+
+    async def alist(
+        self,
+        config: Optional[RunnableConfig],
+        *,
+        filter: Optional[dict[str, Any]] = None,
+        before: Optional[RunnableConfig] = None,
+        limit: Optional[int] = None,
+    ) -> AsyncIterator[CheckpointTuple]:
+        items = await asyncio.to_thread(
+            lambda: list(self.list(config, filter=filter, before=before, limit=limit))
+        )
+        for item in items:
+            yield item
+
+    async def aput(
+        self,
+        config: RunnableConfig,
+        checkpoint: Checkpoint,
+        metadata: CheckpointMetadata,
+        new_versions: ChannelVersions,
+    ) -> RunnableConfig:
+        return await asyncio.to_thread(self.put, config, checkpoint, metadata, new_versions)
+
+    async def aput_writes(
+        self,
+        config: RunnableConfig,
+        writes: Sequence[tuple[str, Any]],
+        task_id: str,
+        task_path: str = "",
+    ) -> None:
+        await asyncio.to_thread(self.put_writes, config, writes, task_id, task_path)
+
+    async def adelete_thread(self, thread_id: str) -> None:
+        await asyncio.to_thread(self.delete_thread, thread_id)
+
+    async def astorage_stats(self) -> tuple[int, int]:
+        return await asyncio.to_thread(self.storage_stats)
+
+    async def alist_idle_threads(self, before: float, limit: int) -> List[str]:
+        return await asyncio.to_thread(self.list_idle_threads, before, limit)
+
+    async def adelete_idle_thread(self, thread_id: str, before: float) -> bool:
+        return await asyncio.to_thread(self.delete_idle_thread, thread_id, before)
+
+
+def create_checkpointer(
+    backend: str = "sqlite",
+    *,
+    sqlite_path: str = "./checkpoints.db",
+    redis_url: str = "redis://localhost:6379/0",
+    append_channels: Sequence[str] = (),
+) -> BaseCheckpointSaver:
+    """按配置创建 checkpointer: memory / sqlite / redis"""
+    if backend == "memory":
+        return MemorySaver()
+    if backend == "sqlite":
+        return DeltaCheckpointSaver(SQLiteBackend(sqlite_path), append_channels=append_channels)
+    if backend == "redis":
+        return DeltaCheckpointSaver(RedisBackend(redis_url), append_channels=append_channels)
+    raise ValueError(f"Unknown checkpoint backend: {backend}")
@@ -0,0 +1,85 @@
+# File: database.py
+"""
+数据库连接层
+
+同一个数据库同时提供两套引擎:
+- 同步引擎 (SessionLocal): 启动时建表、管理脚本 (manage_codes.py / reset_pwd.py)，
+  以及在线程池里执行的批量写入 / 报表查询
+- 异步引擎 (AsyncSessionLocal): async def 接口里使用，查询期间不阻塞事件循环
+
+支持:
+- SQLite (默认): 异步驱动 aiosqlite，连接时设置 WAL 等 PRAGMA，读写不再互相阻塞
+- PostgreSQL: DATABASE_URL=postgresql://...，异步驱动 asyncpg (需要 pip install asyncpg psycopg2-binary)
+
+用法:
+    engine, async_engine = create_engines("sqlite:///./sql_app.db", pool_size=5, max_overflow=10)
+"""
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine
+
+# 每个新连接都执行一遍；journal_mode=WAL 会持久化到数据库文件，其余只对当前连接生效
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",  # 读不阻塞写、写不阻塞读
+    "PRAGMA synchronous=NORMAL",  # WAL 下只在 checkpoint 时 fsync，掉电最多丢最后几个事务
+    "PRAGMA busy_timeout=5000",  # 遇到写锁时等待而不是立刻报 database is locked
+    "PRAGMA cache_size=-16000",  # 每个连接 16MB 页缓存
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA foreign_keys=ON",
+)
+
+# 同步 URL 的方言 -> 异步驱动
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg",
+}
+
+
+def to_async_url(url: str) -> str:
+    """sqlite:///x.db -> sqlite+aiosqlite:///x.db；已经指定了驱动的 URL 原样返回"""
+    parsed = make_url(url)
+    if "+" in parsed.drivername:
+        return url
+    driver = ASYNC_DRIVERS.get(parsed.drivername)
+    if driver is None:
+        raise ValueError(f"No async driver configured for {parsed.drivername}")
+    return parsed.set(drivername=driver).render_as_string(hide_password=False)
+
+
+def _apply_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cursor.execute(pragma)
+    cursor.close()
+
+
+def create_engines(
+    url: str,
+    *,
+    pool_size: int = 5,
+    max_overflow: int = 10,
+    pool_timeout: float = 30,
+    pool_recycle: int = 1800,
+    echo: bool = False,
+):
+    """按 URL 创建 (同步引擎, 异步引擎)，两者使用相同的连接池参数"""
+    is_sqlite = make_url(url).get_backend_name() == "sqlite"
+    options = dict(
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+        pool_timeout=pool_timeout,
+        pool_recycle=pool_recycle,
+        pool_pre_ping=not is_sqlite,  # 网络数据库的连接可能被服务端断开
+        echo=echo,
+    )
+    # sqlite3 连接默认只允许创建它的线程使用；连接池会把连接交给不同的线程
+    sync_connect_args = {"check_same_thread": False} if is_sqlite else {}
+
+    engine = create_engine(url, connect_args=sync_connect_args, **options)
+    async_engine = create_async_engine(to_async_url(url), **options)
+
+    if is_sqlite:
+        event.listen(engine, "connect", _apply_sqlite_pragmas)
+        event.listen(async_engine.sync_engine, "connect", _apply_sqlite_pragmas)
+    return engine, async_engine
@@ -0,0 +1,125 @@
+# File: fake_llm_server.py
+"""
+本地假的 OpenAI 兼容服务 (/v1/chat/completions)，用于离线验证流式输出、模型路由、降级和对冲
+
+用法:
+    python fake_llm_server.py                       # 监听 127.0.0.1:9999
+    python fake_llm_server.py --port 9000
+    # 然后在 .env 里设置 BASE_URL=http://127.0.0.1:9999/v1 (OPENAI_API_KEY 随便填)
+
+环境变量:
+    FAKE_LLM_REPLY          固定回复内容 (默认 "不是。这与汤底无关。")
+    FAKE_LLM_TOKEN_DELAY    每个 token 之间的间隔秒数 (默认 0.02)
+    FAKE_LLM_SLOW_MODELS    按模型设置首 token 前的额外延迟，例如 "gpt-4o=5,gemini-2.5-pro=1.5"
+    FAKE_LLM_FAIL_MODELS    这些模型直接返回 500，例如 "gpt-5.1,claude-3-7-sonnet-latest"
+    FAKE_LLM_CACHED_TOKENS  usage 里上报的前缀缓存命中 token 数 (默认 0)
+    FAKE_LLM_VERDICT        请求带 response_format=json_object 时，按主持人结构化格式
+                            {"verdict", "reply"} 返回，verdict 取这里的值 (默认 "no")
+                            例如: FAKE_LLM_REPLY="🎉 恭喜你，猜对了！" FAKE_LLM_VERDICT=solved
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+REPLY = os.environ.get("FAKE_LLM_REPLY", "不是。这与汤底无关。")
+TOKEN_DELAY = float(os.environ.get("FAKE_LLM_TOKEN_DELAY", "0.02"))
+SLOW_MODELS = {
+    name.strip(): float(delay)
+    for name, delay in (
+        item.rsplit("=", 1)
+        for item in os.environ.get("FAKE_LLM_SLOW_MODELS", "").split(",")
+        if "=" in item
+    )
+}
+FAIL_MODELS = {
+    name.strip() for name in os.environ.get("FAKE_LLM_FAIL_MODELS", "").split(",") if name.strip()
+}
+CACHED_TOKENS = int(os.environ.get("FAKE_LLM_CACHED_TOKENS", "0"))
+VERDICT = os.environ.get("FAKE_LLM_VERDICT", "no")
+
+app = FastAPI()
+stats = {"requests": 0, "by_model": {}}
+
+
+def chunk_payload(model, delta=None, finish_reason=None, usage=None):
+    payload = {
+        "id": "chatcmpl-fake",
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [] if usage else [{"index": 0, "delta": delta or {}, "finish_reason": finish_reason}],
+    }
+    if usage:
+        payload["usage"] = usage
+    return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    model = body.get("model", "unknown")
+    stats["requests"] += 1
+    stats["by_model"][model] = stats["by_model"].get(model, 0) + 1
+
+    if model in FAIL_MODELS:
+        return JSONResponse({"error": {"message": f"{model} is down"}}, status_code=500)
+
+    reply = REPLY
+    if (body.get("response_format") or {}).get("type") == "json_object":
+        reply = json.dumps(
+            {"verdict": VERDICT, "reply": REPLY},
+            ensure_ascii=False,
+        )
+
+    prompt_chars = sum(len(str(m.get("content", ""))) for m in body.get("messages", []))
+    usage = {
+        "prompt_tokens": prompt_chars,
+        "completion_tokens": len(reply),
+        "total_tokens": prompt_chars + len(reply),
+        "prompt_tokens_details": {"cached_tokens": min(CACHED_TOKENS, prompt_chars)},
+    }
+    await asyncio.sleep(SLOW_MODELS.get(model, 0))
+
+    if not body.get("stream"):
+        await asyncio.sleep(TOKEN_DELAY * len(reply))
+        return {
+            "id": "chatcmpl-fake",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [
+                {"index": 0, "message": {"role": "assistant", "content": reply}, "finish_reason": "stop"}
+            ],
+            "usage": usage,
+        }
+
+    async def event_stream():
+        # 和 OpenAI 一样，第一个 chunk 只带 role (SDK 的结构化输出流式解析依赖它)
+        yield chunk_payload(model, delta={"role": "assistant", "content": ""})
+        for char in reply:
+            yield chunk_payload(model, delta={"content": char})
+            await asyncio.sleep(TOKEN_DELAY)
+        yield chunk_payload(model, finish_reason="stop")
+        yield chunk_payload(model, usage=usage)
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+
+@app.get("/stats")
+async def get_stats():
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9999)
+    args = parser.parse_args()
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
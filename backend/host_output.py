@@ -0,0 +1,168 @@
+# File: host_output.py
+"""
+主持人结构化输出的增量解析
+
+主持人按 {"verdict": "solved", "reply": "..."} 输出 JSON，
+HostOutputParser 边收 chunk 边解码 reply 字段，流式接口只把 reply 的文字推给玩家，
+结束时再整体解析出 verdict。判定结果直接来自模型输出的字段，不需要再对回复文字做匹配，
+也不需要额外调用一次模型来分类。
+
+模型没有按 JSON 输出 (不支持 response_format、被降级到别的模型等) 时自动退化为纯文本:
+整段输出就是 reply，verdict 为 None，调用方自行兜底。
+
+用法:
+    parser = HostOutputParser()
+    async for chunk in stream:
+        text = parser.feed(chunk.content)   # 本次新解码出的 reply 文字，可能为空串
+        ...
+    text = parser.close()                    # 剩余未推送的文字 (解析失败退化为纯文本时)
+    output = parser.output                   # HostOutput(reply, verdict, structured)
+"""
+
+import json
+import re
+from typing import NamedTuple, Optional
+
+# verdict 的取值 (见 server.py 里各意图的主持人规则)；其他值一律视为 None，避免指标标签失控
+VERDICT_SOLVED = "solved"  # 猜真相: 完全猜对
+VERDICT_CLOSE = "close"  # 猜真相: 非常接近
+VERDICT_WRONG = "wrong"  # 猜真相: 猜错
+VERDICT_YES = "yes"
+VERDICT_NO = "no"
+VERDICT_IRRELEVANT = "irrelevant"
+VERDICT_PARTIAL = "partial"  # 是又不是
+VERDICT_MULTIPLE = "multiple"  # 一次问了多个问题，逐条回答
+VERDICT_HINT = "hint"
+VERDICTS = frozenset(
+    {
+        VERDICT_SOLVED,
+        VERDICT_CLOSE,
+        VERDICT_WRONG,
+        VERDICT_YES,
+        VERDICT_NO,
+        VERDICT_IRRELEVANT,
+        VERDICT_PARTIAL,
+        VERDICT_MULTIPLE,
+        VERDICT_HINT,
+    }
+)
+
+_REPLY_KEY_RE = re.compile(r'"reply"\s*:\s*"')
+_CODE_FENCE_RE = re.compile(r"^```[a-zA-Z]*\s*|\s*```\s*$")
+
+
+class HostOutput(NamedTuple):
+    reply: str
+    verdict: Optional[str]
+    structured: bool  # False: 模型没有按 JSON 输出，reply 是原文
+
+
+def _normalize_verdict(value) -> Optional[str]:
+    if not isinstance(value, str):
+        return None
+    value = value.strip().lower()
+    return value if value in VERDICTS else None
+
+
+class HostOutputParser:
+    def __init__(self):
+        self._buffer = ""
+        self._mode = None  # None: 还没看到有效字符；"json" / "text"
+        self._reply_pos = None  # reply 字符串中下一个未解码字符在 _buffer 里的位置
+        self._reply_done = False
+        self._broken = False  # reply 里出现无法解码的转义，放弃增量解码，结束时按原文兜底
+        self.streamed = ""  # 已经通过 feed / close 返回的 reply 文字
+        self.output: Optional[HostOutput] = None
+
+    def feed(self, text: str) -> str:
+        if not text:
+            return ""
+        self._buffer += text
+        if self._mode is None:
+            head = self._buffer.lstrip()
+            if not head:
+                return ""
+            # 允许模型把 JSON 包在 ```json 代码块里
+            self._mode = "json" if head[0] in "{`" else "text"
+        if self._mode == "text":
+            return self._emit(text if self.streamed else self._buffer.lstrip())
+        return self._emit(self._decode_reply())
+
+    def _emit(self, text: str) -> str:
+        self.streamed += text
+        return text
+
+    def _decode_reply(self) -> str:
+        if self._reply_done or self._broken:
+            return ""
+        if self._reply_pos is None:
+            match = _REPLY_KEY_RE.search(self._buffer)
+            if match is None:
+                return ""
+            self._reply_pos = match.end()
+
+        # 找出可以安全解码的最长前缀: 不能停在转义序列中间，高代理项要和低代理项一起解码
+        raw = self._buffer
+        start = i = self._reply_pos
+        while i < len(raw):
+            ch = raw[i]
+            if ch == '"':
+                self._reply_done = True
+                break
+            if ch != "\\":
+                i += 1
+                continue
+            if i + 1 >= len(raw):
+                break
+            if raw[i + 1] != "u":
+                i += 2
+                continue
+            if i + 6 > len(raw):
+                break
+            try:
+                code = int(raw[i + 2 : i + 6], 16)
+            except ValueError:
+                self._broken = True
+                return ""
+            if 0xD800 <= code <= 0xDBFF:
+                if i + 12 > len(raw):
+                    break
+                i += 12
+            else:
+                i += 6
+        if i == start:
+            return ""
+        try:
+            decoded = json.loads('"' + raw[start:i] + '"', strict=False)
+        except ValueError:
+            self._broken = True
+            return ""
+        self._reply_pos = i
+        return decoded
+
+    def close(self) -> str:
+        """结束解析，返回还没推送过的 reply 文字；结果在 self.output"""
+        text = self._buffer.strip()
+        if self._mode == "json":
+            try:
+                data = json.loads(_CODE_FENCE_RE.sub("", text), strict=False)
+            except ValueError:
+                data = None
+            if isinstance(data, dict) and isinstance(data.get("reply"), str):
+                self.output = HostOutput(
+                    data["reply"].strip(),
+                    _normalize_verdict(data.get("verdict")),
+                    True,
+                )
+            elif self.streamed:
+                # JSON 被截断或有多余内容，但 reply 已经推送了一部分: 以推送过的内容为准
+                self.output = HostOutput(self.streamed.strip(), None, False)
+            else:
+                self.output = HostOutput(text, None, False)
+        else:
+            self.output = HostOutput(text, None, False)
+
+        reply = self.output.reply
+        if reply.startswith(self.streamed.strip()):
+            return self._emit(reply[len(self.streamed.strip()) :])
+        return ""
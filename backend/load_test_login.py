@@ -0,0 +1,101 @@
+# File: load_test_login.py
+"""
+登录突发对 /chat 延迟的影响
+
+先测一段基线: 只有一个玩家在连续提问；再在同一时间段里并发打一波 /token 登录，
+比较两段 /chat 的延迟分位数。密码校验在事件循环上算时，第二段的 p95 会被拉高十几倍，
+并发高于数据库连接池时 /chat 甚至会超时；放进线程池后两段应该基本持平。
+(单核机器上哈希仍然和事件循环抢 CPU，第二段会略高一些，/token 自身的延迟随并发上升。)
+
+建议配合 fake_llm_server.py 使用，排除上游模型延迟的抖动。
+server.py 启动时用 load_dotenv(override=True) 读取 .env，命令行上的环境变量会被覆盖，
+所以限流要在 .env 里关掉，否则 /chat 会被 429 (/token 本身不限流，登录波次不会被拒):
+    # .env
+    BASE_URL=http://127.0.0.1:9999/v1
+    RATE_LIMIT_IP=
+    RATE_LIMIT_USER=
+
+    python fake_llm_server.py --port 9999
+    uvicorn server:app --port 8000
+    python load_test_login.py --username alice --password secret
+
+用法:
+    python load_test_login.py --logins 400 --concurrency 50 --chats 30
+"""
+import argparse
+import asyncio
+import statistics
+import time
+import uuid
+
+import httpx
+
+
+def summarize(name, timings):
+    timings_ms = sorted(t * 1000 for t in timings)
+    p = lambda q: timings_ms[min(len(timings_ms) - 1, int(len(timings_ms) * q))]
+    print(
+        f"{name:<22} | n={len(timings_ms):<5} | mean={statistics.mean(timings_ms):8.1f}ms"
+        f" | p50={p(0.50):8.1f}ms | p95={p(0.95):8.1f}ms | max={timings_ms[-1]:8.1f}ms"
+    )
+
+
+async def run_chats(client, thread_id, count, phase):
+    timings = []
+    for i in range(count):
+        # 每个问题都不一样，避免命中答案缓存
+        started = time.perf_counter()
+        message = f"{phase}第 {i} 个问题：他是男的吗？"
+        res = await client.post("/chat", json={"thread_id": thread_id, "message": message})
+        res.raise_for_status()
+        timings.append(time.perf_counter() - started)
+    return timings
+
+
+async def run_logins(client, args):
+    semaphore = asyncio.Semaphore(args.concurrency)
+    timings = []
+
+    async def login():
+        async with semaphore:
+            started = time.perf_counter()
+            res = await client.post("/token", data={"username": args.username, "password": args.password})
+            res.raise_for_status()
+            timings.append(time.perf_counter() - started)
+
+    await asyncio.gather(*(login() for _ in range(args.logins)))
+    return timings
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--base-url", default="http://127.0.0.1:8000")
+    parser.add_argument("--username", required=True)
+    parser.add_argument("--password", required=True)
+    parser.add_argument("--puzzle-id", default="100元钱")
+    parser.add_argument("--model", default="gemini-2.5-flash")
+    parser.add_argument("--logins", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--chats", type=int, default=30)
+    args = parser.parse_args()
+
+    limits = httpx.Limits(max_connections=args.concurrency + 10)
+    async with httpx.AsyncClient(base_url=args.base_url, timeout=120, limits=limits) as client:
+        thread_id = str(uuid.uuid4())
+        res = await client.post(
+            "/init", json={"thread_id": thread_id, "puzzle_id": args.puzzle_id, "model": args.model}
+        )
+        res.raise_for_status()
+
+        print(f"\n--- /chat 延迟: 基线 vs {args.logins} 次并发登录 (并发 {args.concurrency}) ---")
+        summarize("/chat (baseline)", await run_chats(client, thread_id, args.chats, "基线"))
+
+        logins = asyncio.create_task(run_logins(client, args))
+        chat_timings = await run_chats(client, thread_id, args.chats, "登录")
+        login_timings = await logins
+        summarize("/chat (login burst)", chat_timings)
+        summarize("/token", login_timings)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,218 @@
+# File: ratelimit.py
+"""
+令牌桶限流 & 准入控制
+
+- TokenBucketLimiter: 进程内令牌桶，单 worker 部署直接用
+- RedisTokenBucketLimiter: 基于 Redis + Lua 的共享令牌桶，多个 worker / 多台机器共享同一份配额 (需要安装 redis)
+- AdmissionQueue: 限制同时处理的请求数，排队也有上限；过载时快速拒绝，而不是把请求都堆到上游模型
+
+一次请求通常要同时检查多个桶 (用户 / IP / 模型)，acquire 是“全部放行才扣减”的原子操作，
+被某一个桶拒绝时不会白白消耗其他桶的令牌。
+
+用法:
+    limiter = create_rate_limiter("memory")
+    retry_after = await limiter.acquire([("user:alice", RateLimit(30, 10))])
+    if retry_after > 0:
+        ...  # 返回 429，Retry-After: retry_after 秒
+"""
+
+import asyncio
+import time
+from typing import NamedTuple, Optional, Sequence
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:  # Redis 后端是可选的
+    aioredis = None
+
+
+class RateLimit(NamedTuple):
+    per_minute: float  # 平均速率 (每分钟补充的令牌数)
+    burst: int  # 桶容量 (允许的瞬时突发)
+
+    @property
+    def per_second(self) -> float:
+        return self.per_minute / 60.0
+
+
+def parse_rate_limit(raw: str) -> Optional[RateLimit]:
+    """解析 "每分钟次数/突发容量"，例如 "30/10"；省略突发容量时等于每分钟次数，空或 0 表示不限"""
+    raw = raw.strip()
+    if not raw:
+        return None
+    per_minute, _, burst = raw.partition("/")
+    per_minute = float(per_minute)
+    if per_minute <= 0:
+        return None
+    return RateLimit(per_minute, int(burst) if burst else max(1, int(per_minute)))
+
+
+class TokenBucketLimiter:
+    """进程内令牌桶；长时间不用、已经回满的桶会被定期清理，内存不会随 key 数量无限增长"""
+
+    def __init__(self, gc_every: int = 10000):
+        self._buckets: dict[str, tuple[float, float]] = {}  # key -> (令牌数, 上次更新时间)
+        self._gc_every = gc_every
+        self._calls = 0
+
+    def _refill(self, key: str, limit: RateLimit, now: float) -> float:
+        tokens, updated = self._buckets.get(key, (float(limit.burst), now))
+        return min(float(limit.burst), tokens + (now - updated) * limit.per_second)
+
+    def try_acquire(self, rules: Sequence[tuple[str, RateLimit]], cost: float = 1.0) -> float:
+        """全部桶都有令牌时扣减并返回 0，否则不扣减，返回需要等待的秒数"""
+        now = time.monotonic()
+        self._calls += 1
+        if self._calls % self._gc_every == 0:
+            self._gc(now)
+
+        levels = [self._refill(key, limit, now) for key, limit in rules]
+        retry_after = max(
+            ((cost - tokens) / limit.per_second for (_, limit), tokens in zip(rules, levels) if tokens < cost),
+            default=0.0,
+        )
+        if retry_after > 0:
+            return retry_after
+        for (key, _), tokens in zip(rules, levels):
+            self._buckets[key] = (tokens - cost, now)
+        return 0.0
+
+    async def acquire(self, rules: Sequence[tuple[str, RateLimit]], cost: float = 1.0) -> float:
+        return self.try_acquire(rules, cost)
+
+    def _gc(self, now: float, idle_seconds: float = 600.0):
+        # 闲置超过 idle_seconds 的桶一般早已回满，删掉等价于重新创建一个满桶
+        for key in [key for key, (_, updated) in self._buckets.items() if now - updated > idle_seconds]:
+            del self._buckets[key]
+
+    def stats(self):
+        return {"backend": "memory", "buckets": len(self._buckets)}
+
+    async def close(self):
+        pass
+
+
+# KEYS: 各个桶；ARGV: cost, 然后每个桶依次是 (每秒速率, 容量)
+# 先计算所有桶的令牌数，全部足够才一起扣减；返回需要等待的秒数 (字符串，避免 Lua 数字被截断成整数)
+_TOKEN_BUCKET_LUA = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local cost = tonumber(ARGV[1])
+local levels = {}
+local retry = 0
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[i * 2])
+    local burst = tonumber(ARGV[i * 2 + 1])
+    local data = redis.call('HMGET', key, 'tokens', 'ts')
+    local tokens = tonumber(data[1]) or burst
+    local ts = tonumber(data[2]) or now
+    tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+    levels[i] = tokens
+    if tokens < cost then
+        retry = math.max(retry, (cost - tokens) / rate)
+    end
+end
+if retry == 0 then
+    for i, key in ipairs(KEYS) do
+        local rate = tonumber(ARGV[i * 2])
+        local burst = tonumber(ARGV[i * 2 + 1])
+        redis.call('HSET', key, 'tokens', levels[i] - cost, 'ts', now)
+        redis.call('PEXPIRE', key, math.ceil(burst / rate * 1000) + 1000)
+    end
+end
+return tostring(retry)
+"""
+
+
+class RedisTokenBucketLimiter:
+    def __init__(self, url: str, prefix: str = "turtlesoup:rl"):
+        if aioredis is None:
+            raise RuntimeError("RATE_LIMIT_BACKEND=redis 需要先 pip install redis")
+        self.client = aioredis.Redis.from_url(url)
+        self.prefix = prefix
+        self._script = self.client.register_script(_TOKEN_BUCKET_LUA)
+
+    async def acquire(self, rules: Sequence[tuple[str, RateLimit]], cost: float = 1.0) -> float:
+        if not rules:
+            return 0.0
+        keys = [f"{self.prefix}:{key}" for key, _ in rules]
+        args = [cost]
+        for _, limit in rules:
+            args.extend([limit.per_second, limit.burst])
+        result = await self._script(keys=keys, args=args)
+        return float(result)
+
+    def stats(self):
+        return {"backend": "redis"}
+
+    async def close(self):
+        await self.client.aclose()
+
+
+def create_rate_limiter(backend: str = "memory", *, redis_url: str = "redis://localhost:6379/0"):
+    """按配置创建限流器: memory / redis"""
+    if backend == "memory":
+        return TokenBucketLimiter()
+    if backend == "redis":
+        return RedisTokenBucketLimiter(redis_url)
+    raise ValueError(f"Unknown rate limit backend: {backend}")
+
+
+class AdmissionTicket:
+    """准入凭证，release 可以重复调用 (只生效一次)"""
+
+    def __init__(self, queue: "AdmissionQueue"):
+        self._queue = queue
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self._queue._release()
+
+
+class AdmissionQueue:
+    """最多 max_inflight 个请求同时处理，最多 max_waiting 个请求排队，排队超过 wait_timeout 秒放弃"""
+
+    def __init__(self, max_inflight: int, max_waiting: int, wait_timeout: float):
+        self.max_inflight = max_inflight
+        self.max_waiting = max_waiting
+        self.wait_timeout = wait_timeout
+        self._semaphore = asyncio.Semaphore(max_inflight)
+        self.inflight = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+
+    async def acquire(self) -> Optional[AdmissionTicket]:
+        """拿到名额返回凭证；队列已满或排队超时返回 None"""
+        if self._semaphore.locked() and self.waiting >= self.max_waiting:
+            self.rejected += 1
+            return None
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), self.wait_timeout)
+        except asyncio.TimeoutError:
+            self.timed_out += 1
+            return None
+        finally:
+            self.waiting -= 1
+        self.inflight += 1
+        self.admitted += 1
+        return AdmissionTicket(self)
+
+    def _release(self):
+        self.inflight -= 1
+        self._semaphore.release()
+
+    def stats(self):
+        return {
+            "inflight": self.inflight,
+            "waiting": self.waiting,
+            "max_inflight": self.max_inflight,
+            "max_waiting": self.max_waiting,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+        }
@@ -1,34 +1,72 @@
 import os
 import sys
 import asyncio
+import atexit
+import logging
+import queue
+import gzip
+import hashlib
+import importlib
+import math
+import pickle
+import random
+import re
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from logging.handlers import QueueHandler, QueueListener
 from datetime import datetime, timedelta
-from typing import TypedDict, List, Optional
+from typing import Annotated, Callable, NamedTuple, TypedDict, List, Optional
 from dotenv import load_dotenv
 
-from fastapi import FastAPI, Depends, HTTPException, status
+from fastapi import FastAPI, Depends, Header, HTTPException, Query, Request, Response, status
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from starlette.background import BackgroundTask
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from pydantic import BaseModel
+import httpx
+import openai
 
 # --- Database & Auth Imports (New) ---
-from sqlalchemy import create_engine, Column, Integer, String, Boolean
+from sqlalchemy import case, func, select, update, Column, Index, Integer, String, Text, Boolean, DateTime, Float
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, Session
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+from sqlalchemy.orm import sessionmaker
 from passlib.context import CryptContext
 from jose import JWTError, jwt
 
 # Langchain imports... (保留你原有的导入)
 from langchain_openai import ChatOpenAI
-from langchain_core.messages import HumanMessage, BaseMessage, AIMessage
+from langchain_core.messages import HumanMessage, BaseMessage, AIMessage, RemoveMessage
 from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.runnables import RunnableConfig
 from langgraph.graph import StateGraph, END
-from langgraph.checkpoint.memory import MemorySaver
+from langgraph.graph.message import REMOVE_ALL_MESSAGES, add_messages
+from langgraph.config import get_stream_writer
 from langchain_community.callbacks import get_openai_callback
 
 import json  # 确保导入了 json
 import uuid  # 确保导入了 uuid
 from pathlib import Path  # 推荐使用 Path 处理路径
 
+from batch_writer import BatchWriter
+from checkpointer import CheckpointConflict, DeltaCheckpointSaver, SQLiteBackend, create_checkpointer
+from database import create_engines
+from host_output import VERDICT_SOLVED, HostOutputParser
+from metrics import MetricsRegistry
+from ratelimit import AdmissionQueue, parse_rate_limit, create_rate_limiter
+
+try:
+    import brotli  # 可选: 安装后 /puzzles 额外提供 br 压缩
+except ImportError:
+    brotli = None
+
 PENDING_DIR = Path("pending_puzzles")
 PENDING_DIR.mkdir(exist_ok=True)
 
@@ -42,28 +80,75 @@ class PuzzleUpload(BaseModel):
 
 load_dotenv(dotenv_path=r"./.env", override=True)
 
+# --- 日志 ---
+# 请求路径上的日志先放进内存队列，由 QueueListener 的后台线程写到 stdout；
+# 终端输出慢或管道被塞满时不会卡住事件循环
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+logger = logging.getLogger("turtlesoup")
+logger.setLevel(LOG_LEVEL)
+logger.propagate = False
+_log_queue = queue.SimpleQueue()
+logger.addHandler(QueueHandler(_log_queue))
+_log_handler = logging.StreamHandler(sys.stdout)
+_log_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+_log_listener = QueueListener(_log_queue, _log_handler)
+_log_listener.start()
+atexit.register(_log_listener.stop)  # 退出前把队列里剩下的日志写完
+
+# --- 指标 ---
+# /metrics 以 Prometheus 文本格式输出；observe 只做几次加法，可以放在热路径上
+metrics_registry = MetricsRegistry()
+turn_stage_seconds = metrics_registry.histogram(
+    "turtlesoup_turn_stage_seconds",
+    "Latency of each stage of a chat turn",
+    ["stage", "model"],
+)
+http_request_seconds = metrics_registry.histogram(
+    "turtlesoup_http_request_seconds",
+    "HTTP request latency by route (streaming responses until the last byte)",
+    ["method", "route", "status"],
+)
+turns_total = metrics_registry.counter(
+    "turtlesoup_turns_total",
+    "Chat turns by intent and how they were answered (llm / cache / local / error)",
+    ["intent", "source"],
+)
+host_verdicts_total = metrics_registry.counter(
+    "turtlesoup_host_verdicts_total",
+    "Host verdicts parsed from structured output (unknown: reply was not valid JSON)",
+    ["intent", "verdict"],
+)
+
 # --- 配置与常量 (New) ---
 SECRET_KEY = "YOUR_SUPER_SECRET_KEY_CHANGE_THIS"  # 请在生产环境中修改
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
-SQLALCHEMY_DATABASE_URL = "sqlite:///./sql_app.db"
+SQLALCHEMY_DATABASE_URL = os.environ.get("DATABASE_URL", "sqlite:///./sql_app.db")
 
 # --- 数据库设置 (New) ---
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
+# 接口里统一用异步会话 (AsyncSessionLocal)；同步的 SessionLocal 留给启动建表、管理脚本和线程池里的批量任务
+# DB_POOL_SIZE / DB_MAX_OVERFLOW: 每个引擎常驻 / 额外允许的连接数；DB_POOL_TIMEOUT: 等连接的最长时间 (秒)
+engine, async_engine = create_engines(
+    SQLALCHEMY_DATABASE_URL,
+    pool_size=int(os.environ.get("DB_POOL_SIZE", "5")),
+    max_overflow=int(os.environ.get("DB_MAX_OVERFLOW", "10")),
+    pool_timeout=float(os.environ.get("DB_POOL_TIMEOUT", "30")),
+    pool_recycle=int(os.environ.get("DB_POOL_RECYCLE", "1800")),
 )
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+AsyncSessionLocal = async_sessionmaker(async_engine, expire_on_commit=False)
 Base = declarative_base()
 
+# cached_input: 命中供应商前缀缓存部分的输入单价 (未配置时按普通输入价计算)
 MODEL_PRICING = {
-    "deepseek-ai/DeepSeek-V3.2-Exp": {"input": 0.2000, "output": 0.300},
-    "deepseek-ai/DeepSeek-V3.2-Exp-thinking": {"input": 0.2000, "output": 0.300},
-    "gemini-2.5-flash": {"input": 0.3000, "output": 2.5200},
-    "gemini-2.5-pro": {"input": 1.2500, "output": 10.00},
-    "gemini-3-pro-preview": {"input": 2.0000, "output": 12.000},
-    "gpt-4o": {"input": 5.0000, "output": 20.00},
-    "gpt-5.1": {"input": 2.5000, "output": 20.00},
-    "claude-3-7-sonnet-latest": {"input": 4.5000, "output": 22.5000},
+    "deepseek-ai/DeepSeek-V3.2-Exp": {"input": 0.2000, "output": 0.300, "cached_input": 0.0200},
+    "deepseek-ai/DeepSeek-V3.2-Exp-thinking": {"input": 0.2000, "output": 0.300, "cached_input": 0.0200},
+    "gemini-2.5-flash": {"input": 0.3000, "output": 2.5200, "cached_input": 0.0300},
+    "gemini-2.5-pro": {"input": 1.2500, "output": 10.00, "cached_input": 0.1250},
+    "gemini-3-pro-preview": {"input": 2.0000, "output": 12.000, "cached_input": 0.2000},
+    "gpt-4o": {"input": 5.0000, "output": 20.00, "cached_input": 2.5000},
+    "gpt-5.1": {"input": 2.5000, "output": 20.00, "cached_input": 0.2500},
+    "claude-3-7-sonnet-latest": {"input": 4.5000, "output": 22.5000, "cached_input": 0.4500},
 }
 
 
@@ -80,6 +165,90 @@ class InviteCode(Base):
     is_used = Column(Boolean, default=False)
 
 
+class UsageRecord(Base):
+    """用量账本: 每次 LLM 调用一行，只追加"""
+
+    __tablename__ = "usage_ledger"
+    id = Column(Integer, primary_key=True)
+    created_at = Column(DateTime, index=True)
+    day = Column(String, index=True)  # UTC 日期 YYYY-MM-DD
+    username = Column(String, index=True)  # 未登录为空串
+    thread_id = Column(String)
+    puzzle_id = Column(String)
+    model = Column(String)
+    kind = Column(String)  # turn / summary / abandoned
+    prompt_tokens = Column(Integer)
+    cached_tokens = Column(Integer)
+    completion_tokens = Column(Integer)
+    total_tokens = Column(Integer)
+    cost = Column(Float)
+    latency_ms = Column(Float)
+
+
+class UsageDaily(Base):
+    """按 (日期, 模型, 用户) 预聚合的用量，账本落库时同一事务内累加，报表直接查这张表"""
+
+    __tablename__ = "usage_daily"
+    day = Column(String, primary_key=True)
+    model = Column(String, primary_key=True)
+    username = Column(String, primary_key=True)
+    calls = Column(Integer, default=0)
+    prompt_tokens = Column(Integer, default=0)
+    cached_tokens = Column(Integer, default=0)
+    completion_tokens = Column(Integer, default=0)
+    total_tokens = Column(Integer, default=0)
+    cost = Column(Float, default=0.0)
+    latency_ms = Column(Float, default=0.0)  # 累计耗时，平均值 = latency_ms / calls
+
+
+class PuzzleProgress(Base):
+    """每个用户在每道题上的进度: 一行一题，玩过即有记录，猜中后写入 solved_at"""
+
+    __tablename__ = "puzzle_progress"
+    username = Column(String, primary_key=True)
+    puzzle_id = Column(String, primary_key=True)
+    played_at = Column(DateTime)
+    solved_at = Column(DateTime, nullable=True)
+
+
+class GameTurn(Base):
+    """对局历史: 登录用户每一轮的一问一答，只追加"""
+
+    __tablename__ = "game_turns"
+    id = Column(Integer, primary_key=True)  # 自增，同一局内按 id 排序即轮次顺序，也用作分页游标
+    created_at = Column(DateTime)
+    username = Column(String, nullable=False)
+    thread_id = Column(String, nullable=False)
+    puzzle_id = Column(String)
+    turn = Column(Integer)
+    question = Column(Text)
+    reply = Column(Text)
+    intent = Column(String)
+    model = Column(String)
+
+    __table_args__ = (
+        # 回放某一局 / 列出我的对局；带上 id 后按游标翻页不需要额外排序
+        Index("ix_game_turns_user_thread", "username", "thread_id", "id"),
+        # 某道题我玩过几局
+        Index("ix_game_turns_user_puzzle", "username", "puzzle_id"),
+    )
+
+
+class GameSummary(Base):
+    """每局一行的汇总，game_turns 落库时同一事务内更新，/history 对局列表直接分页这张表"""
+
+    __tablename__ = "game_summaries"
+    username = Column(String, primary_key=True)
+    thread_id = Column(String, primary_key=True)
+    puzzle_id = Column(String)
+    turns = Column(Integer, default=0)
+    started_at = Column(DateTime)
+    last_played_at = Column(DateTime)
+    last_id = Column(Integer)  # 这局最后一轮的 game_turns.id，按它倒序即最近玩过的在前，也用作分页游标
+
+    __table_args__ = (Index("ix_game_summaries_user_last", "username", "last_id"),)
+
+
 Base.metadata.create_all(bind=engine)  # 自动创建表
 
 
@@ -106,6 +275,8 @@ init_invite_codes()
 # --- 安全工具 (New) ---
 pwd_context = CryptContext(schemes=["pbkdf2_sha256"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
+# 游戏接口不强制登录，带了 token 就按用户限流，没带就按 IP
+oauth2_scheme_optional = OAuth2PasswordBearer(tokenUrl="token", auto_error=False)
 
 
 def verify_password(plain_password, hashed_password):
@@ -116,6 +287,114 @@ def get_password_hash(password):
     return pwd_context.hash(password)
 
 
+# pbkdf2 故意算得很慢 (几十毫秒 CPU)，放在事件循环上算时一波登录就会卡住所有正在进行的对局。
+# 交给一个固定大小的线程池 (hashlib 计算期间会释放 GIL)，同时也限制了最多占用几个核
+PASSWORD_HASH_WORKERS = int(
+    os.environ.get("PASSWORD_HASH_WORKERS", str(min(4, os.cpu_count() or 1)))
+)
+password_executor = ThreadPoolExecutor(
+    max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="password-hash"
+)
+
+
+async def verify_password_async(plain_password, hashed_password) -> bool:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        password_executor, verify_password, plain_password, hashed_password
+    )
+
+
+async def get_password_hash_async(password) -> str:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(password_executor, get_password_hash, password)
+
+
+def decode_token(token: str) -> Optional[dict]:
+    """校验 JWT 并返回 payload，无效或过期返回 None"""
+    try:
+        return jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except JWTError:
+        return None
+
+
+def decode_username(token: str) -> Optional[str]:
+    """从 JWT 中取出用户名，无效或过期返回 None"""
+    payload = decode_token(token)
+    return payload.get("sub") if payload else None
+
+
+# --- 已验证 token 缓存 ---
+# read_users_me / get_optional_username 每次都要验签 + 查一次用户表；同一个 token 在短时间内反复出现
+# (上传题目、每轮对话)，缓存 token -> 用户信息，过期时间不超过 token 本身的 exp
+TOKEN_CACHE_TTL = float(os.environ.get("TOKEN_CACHE_TTL", "60"))
+TOKEN_CACHE_SIZE = int(os.environ.get("TOKEN_CACHE_SIZE", "10000"))
+
+
+class TokenCache:
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: OrderedDict[str, tuple[float, dict]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, token: str) -> Optional[dict]:
+        entry = self._entries.get(token)
+        if entry is None or entry[0] < time.time():
+            if entry is not None:
+                del self._entries[token]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(token)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, token: str, user: dict, token_exp: Optional[float] = None):
+        expires = time.time() + self.ttl
+        if token_exp is not None:
+            expires = min(expires, token_exp)
+        self._entries[token] = (expires, user)
+        self._entries.move_to_end(token)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def stats(self):
+        return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+token_cache = TokenCache(TOKEN_CACHE_SIZE, TOKEN_CACHE_TTL)
+
+
+async def resolve_token_user(token: str, db: AsyncSession) -> Optional[dict]:
+    """token 缓存未命中时: 验签并确认用户仍然存在，通过后写入缓存；token 无效或用户不存在返回 None"""
+    payload = decode_token(token)
+    username = payload.get("sub") if payload else None
+    if username is None:
+        return None
+    user = await db.scalar(select(User).where(User.username == username))
+    if user is None:
+        return None
+    current_user = {"username": user.username, "id": user.id}
+    token_cache.put(token, current_user, payload.get("exp"))
+    return current_user
+
+
+async def get_optional_username(
+    token: Optional[str] = Depends(oauth2_scheme_optional),
+) -> Optional[str]:
+    """可选登录: 和 read_users_me 同样的校验，只是失败时按未登录处理而不是 401
+
+    只在 token 缓存未命中时临时开一个会话查用户表，不会在 /chat 等待模型期间占着连接。
+    """
+    if not token:
+        return None
+    cached = token_cache.get(token)
+    if cached is None:
+        async with AsyncSessionLocal() as db:
+            cached = await resolve_token_user(token, db)
+    return cached["username"] if cached else None
+
+
 def create_access_token(data: dict, expires_delta: timedelta | None = None):
     to_encode = data.copy()
     if expires_delta:
@@ -127,13 +406,10 @@ def create_access_token(data: dict, expires_delta: timedelta | None = None):
     return encoded_jwt
 
 
-# 依赖项：获取数据库会话
-def get_db():
-    db = SessionLocal()
-    try:
+# 依赖项：获取数据库会话 (异步，查询期间不阻塞事件循环)
+async def get_db():
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 
 # --- Pydantic Models (New & Existing) ---
@@ -150,8 +426,7 @@ class Token(BaseModel):
 
 class InitRequest(BaseModel):
     thread_id: str
-    story: str
-    truth: str
+    puzzle_id: str  # 汤面 / 汤底由服务端按题目 id 从题库中读取，不再由浏览器上传
     model: str = "gemini-2.5-flash"
 
 
@@ -160,22 +435,515 @@ class ChatRequest(BaseModel):
     message: str
 
 
+class GiveUpRequest(BaseModel):
+    thread_id: str
+
+
+# --- LLM 并发限制 ---
+# 每个上游模型一个信号量，限制同时在途的请求数，避免单个 worker 把某个供应商打爆
+# LLM_MAX_CONCURRENCY: 每个模型的默认上限
+# LLM_MODEL_CONCURRENCY: 按模型覆盖，例如 "gpt-4o=8,gemini-2.5-pro=16"
+
+
+def parse_model_map(raw: str, cast=int) -> dict:
+    """解析 "model_a=1,model_b=2" 形式的按模型配置"""
+    return {
+        name.strip(): cast(value)
+        for name, value in (item.rsplit("=", 1) for item in raw.split(",") if "=" in item)
+    }
+
+
+LLM_MAX_CONCURRENCY = int(os.environ.get("LLM_MAX_CONCURRENCY", "64"))
+LLM_MODEL_CONCURRENCY = parse_model_map(os.environ.get("LLM_MODEL_CONCURRENCY", ""))
+_model_semaphores: dict[str, asyncio.Semaphore] = {}
+
+
+def get_model_semaphore(model_name: str) -> asyncio.Semaphore:
+    semaphore = _model_semaphores.get(model_name)
+    if semaphore is None:
+        limit = LLM_MODEL_CONCURRENCY.get(model_name, LLM_MAX_CONCURRENCY)
+        semaphore = _model_semaphores[model_name] = asyncio.Semaphore(limit)
+    return semaphore
+
+
+# --- LLM 客户端池 ---
+# 每个模型只创建一次 ChatOpenAI，并挂一个长连接的 httpx 连接池，
+# 后续每轮对话复用同一个客户端，省掉重复建连 / TLS 握手
+LLM_POOL_MAX_CONNECTIONS = int(os.environ.get("LLM_POOL_MAX_CONNECTIONS", "100"))
+LLM_POOL_MAX_KEEPALIVE = int(os.environ.get("LLM_POOL_MAX_KEEPALIVE", "20"))
+LLM_POOL_KEEPALIVE_EXPIRY = float(os.environ.get("LLM_POOL_KEEPALIVE_EXPIRY", "60"))
+LLM_TIMEOUT = float(os.environ.get("LLM_TIMEOUT", "120"))
+# 建连超时 / 读超时 (两次收到数据之间的最长间隔)：上游卡死时尽快放弃，不必等满 LLM_TIMEOUT
+LLM_CONNECT_TIMEOUT = float(os.environ.get("LLM_CONNECT_TIMEOUT", "5"))
+LLM_READ_TIMEOUT = float(os.environ.get("LLM_READ_TIMEOUT", "30"))
+LLM_HTTP_TIMEOUT = httpx.Timeout(
+    LLM_TIMEOUT, connect=LLM_CONNECT_TIMEOUT, read=LLM_READ_TIMEOUT
+)
+
+_llm_clients: dict[str, ChatOpenAI] = {}
+llm_pool_stats = {"hits": 0, "misses": 0}  # 按模型名查找客户端 (每个客户端独占一个 HTTP 连接池)
+chain_cache_stats = {"hits": 0, "misses": 0}  # 预编译的 prompt | llm 链，单独统计，不计入客户端复用率
+
+
 def create_llm_instance(model_name: str):
     api_key = os.environ.get("OPENAI_API_KEY")
     base_url = os.environ.get("BASE_URL")
     if not api_key or not base_url:
         raise ValueError("Check .env")
 
+    http_async_client = httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=LLM_POOL_MAX_CONNECTIONS,
+            max_keepalive_connections=LLM_POOL_MAX_KEEPALIVE,
+            keepalive_expiry=LLM_POOL_KEEPALIVE_EXPIRY,
+        ),
+        timeout=LLM_HTTP_TIMEOUT,
+    )
+
     # 动态实例化
+    # stream_usage=True: 流式输出时也让服务端在最后一个 chunk 里返回 usage，保证计费准确
     return ChatOpenAI(
-        model=model_name, api_key=api_key, base_url=base_url, temperature=0.3
+        model=model_name,
+        api_key=api_key,
+        base_url=base_url,
+        temperature=0.3,
+        stream_usage=True,
+        timeout=LLM_HTTP_TIMEOUT,
+        # 重试由 call_with_retries / 模型路由自己控制 (只在首个 token 之前重试)
+        max_retries=0,
+        http_async_client=http_async_client,
     )
 
 
+def get_llm(model_name: str) -> ChatOpenAI:
+    """按模型名取池中的长连接客户端，没有则创建一个"""
+    llm = _llm_clients.get(model_name)
+    if llm is not None:
+        llm_pool_stats["hits"] += 1
+        return llm
+
+    llm_pool_stats["misses"] += 1
+    llm = _llm_clients[model_name] = create_llm_instance(model_name)
+    return llm
+
+
+async def close_llm_clients():
+    for llm in _llm_clients.values():
+        await llm.http_async_client.aclose()
+    _llm_clients.clear()
+    _chains.clear()
+
+
+# --- LLM 重试 ---
+# 超时、连接错误、429 和 5xx 视为可重试，按“全抖动”指数退避: sleep(random(0, min(上限, 基数 * 2^n)))
+LLM_MAX_RETRIES = int(os.environ.get("LLM_MAX_RETRIES", "2"))
+LLM_RETRY_BASE_DELAY = float(os.environ.get("LLM_RETRY_BASE_DELAY", "0.5"))
+LLM_RETRY_MAX_DELAY = float(os.environ.get("LLM_RETRY_MAX_DELAY", "4"))
+llm_retry_stats = {"retries": 0}
+
+
+def is_retryable_llm_error(error: BaseException) -> bool:
+    if isinstance(error, (openai.APIConnectionError, httpx.TransportError)):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in (408, 409, 429) or error.status_code >= 500
+    return False
+
+
+def retry_delay(attempt: int) -> float:
+    return random.uniform(0, min(LLM_RETRY_MAX_DELAY, LLM_RETRY_BASE_DELAY * 2**attempt))
+
+
+async def call_with_retries(model_name: str, make_call):
+    """在模型并发名额内执行一次非流式调用，可重试的错误按抖动退避重试 (退避期间不占名额)"""
+    attempt = 0
+    while True:
+        try:
+            async with get_model_semaphore(model_name):
+                return await make_call()
+        except Exception as e:
+            if attempt >= LLM_MAX_RETRIES or not is_retryable_llm_error(e):
+                raise
+            delay = retry_delay(attempt)
+            attempt += 1
+            llm_retry_stats["retries"] += 1
+            logger.warning(f"⚠️ {model_name} failed ({type(e).__name__}), retry {attempt} in {delay:.2f}s")
+            await asyncio.sleep(delay)
+
+
+def get_llm_pool_stats():
+    lookups = llm_pool_stats["hits"] + llm_pool_stats["misses"]
+    return {
+        "clients": len(_llm_clients),
+        "hits": llm_pool_stats["hits"],
+        "misses": llm_pool_stats["misses"],
+        "hit_rate": llm_pool_stats["hits"] / lookups if lookups else 0.0,
+        "max_connections": LLM_POOL_MAX_CONNECTIONS,
+        "max_keepalive_connections": LLM_POOL_MAX_KEEPALIVE,
+        "retries": llm_retry_stats["retries"],
+        "chains": {"entries": len(_chains), **chain_cache_stats},
+    }
+
+
+# --- 模型路由: 延迟感知的降级 & 对冲请求 ---
+# 每个模型记录最近的首 token 延迟和成功 / 失败情况:
+#   - 主模型在 ROUTER_FIRST_TOKEN_TIMEOUT 内没有吐出首个 token 或直接报错时，
+#     依次换用 ROUTER_FALLBACK_MODELS 里健康的模型 (按 p50 延迟排序)
+#   - 配置了 ROUTER_HEDGE_MODEL 时，主模型超过对冲阈值还没出首 token，
+#     就并行向这个更便宜更快的模型再发一次，谁先出首 token 就用谁，另一个取消
+#   - 最近 ROUTER_WINDOW_SECONDS 内错误率超过 ROUTER_MAX_ERROR_RATE 的模型视为不健康，暂时跳过
+#   - 成功 / 失败按整个流是否正常结束计，首 token 之后中途出错同样算失败
+#   - 已经发到上游又被取消的请求 (对冲输家、首 token 超时) 照样会按输入 token 计费，
+#     通过 on_abandoned 回调交给调用方记账
+ROUTER_FALLBACK_MODELS = [
+    name.strip()
+    for name in os.environ.get(
+        "ROUTER_FALLBACK_MODELS", "gemini-2.5-flash,deepseek-ai/DeepSeek-V3.2-Exp"
+    ).split(",")
+    if name.strip()
+]
+ROUTER_MAX_FALLBACKS = int(os.environ.get("ROUTER_MAX_FALLBACKS", "2"))
+ROUTER_FIRST_TOKEN_TIMEOUT = float(os.environ.get("ROUTER_FIRST_TOKEN_TIMEOUT", "20"))
+ROUTER_HEDGE_MODEL = os.environ.get("ROUTER_HEDGE_MODEL", "")
+# 对冲阈值 (秒)；0 表示使用主模型滚动 p95 首 token 延迟 (样本不足时按 2 秒)
+ROUTER_HEDGE_AFTER = float(os.environ.get("ROUTER_HEDGE_AFTER", "0"))
+ROUTER_WINDOW_SECONDS = float(os.environ.get("ROUTER_WINDOW_SECONDS", "60"))
+ROUTER_MAX_ERROR_RATE = float(os.environ.get("ROUTER_MAX_ERROR_RATE", "0.5"))
+ROUTER_MIN_SAMPLES = 5
+ROUTER_LATENCY_SAMPLES = 200
+
+
+class ModelHealth:
+    def __init__(self):
+        self.latencies = deque(maxlen=ROUTER_LATENCY_SAMPLES)  # 首 token 延迟 (秒)
+        self.outcomes = deque()  # (时间戳, 是否成功)，只保留窗口内的
+        self.requests = 0
+        self.errors = 0
+
+    def record(self, ok: bool, latency: Optional[float] = None):
+        now = time.monotonic()
+        self.requests += 1
+        if not ok:
+            self.errors += 1
+        if latency is not None:
+            self.latencies.append(latency)
+        self.outcomes.append((now, ok))
+        while self.outcomes and self.outcomes[0][0] < now - ROUTER_WINDOW_SECONDS:
+            self.outcomes.popleft()
+
+    def record_latency(self, latency: float):
+        """被对冲取消的慢请求: 没有结果，但已等待的时长是首 token 延迟的下限"""
+        self.latencies.append(latency)
+
+    def percentile(self, q: float) -> Optional[float]:
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+    def error_rate(self) -> float:
+        cutoff = time.monotonic() - ROUTER_WINDOW_SECONDS
+        recent = [ok for ts, ok in self.outcomes if ts >= cutoff]
+        if len(recent) < ROUTER_MIN_SAMPLES:
+            return 0.0
+        return recent.count(False) / len(recent)
+
+    def healthy(self) -> bool:
+        return self.error_rate() <= ROUTER_MAX_ERROR_RATE
+
+
+class _StreamAttempt:
+    """在独立任务里跑一次流式调用，chunk 放进队列；first 在首个 chunk / 结束 / 出错时完成"""
+
+    def __init__(self, model_name: str, prompt_template: ChatPromptTemplate, inputs: dict):
+        self.model = model_name
+        self.started = time.monotonic()
+        self.first_token_latency = None
+        self.sent = False  # 拿到并发名额、请求已发往上游
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.first = asyncio.get_running_loop().create_future()
+        self.task = asyncio.create_task(self._run(prompt_template, inputs))
+
+    def _signal_first(self, error: Optional[BaseException] = None):
+        if not self.first.done():
+            if error is None:
+                self.first_token_latency = time.monotonic() - self.started
+            self.first.set_result(error)
+
+    async def _run(self, prompt_template, inputs):
+        try:
+            chain = get_chain(prompt_template, self.model)
+            retry = 0
+            while True:
+                try:
+                    # 只在真正占用上游连接的这段时间持有该模型的并发名额
+                    async with get_model_semaphore(self.model):
+                        self.sent = True
+                        async for chunk in chain.astream(inputs):
+                            self._signal_first()
+                            self.queue.put_nowait(chunk)
+                    break
+                except Exception as e:
+                    # 已经输出过 token 就不能重试了，否则玩家会看到重复的内容
+                    if (
+                        self.first.done()
+                        or retry >= LLM_MAX_RETRIES
+                        or not is_retryable_llm_error(e)
+                    ):
+                        raise
+                    delay = retry_delay(retry)
+                    retry += 1
+                    llm_retry_stats["retries"] += 1
+                    logger.warning(f"⚠️ {self.model} failed ({type(e).__name__}), retry {retry} in {delay:.2f}s")
+                    await asyncio.sleep(delay)
+            self._signal_first()
+            self.queue.put_nowait(None)
+        except Exception as e:
+            self._signal_first(e)
+            self.queue.put_nowait(e)
+
+    def cancel(self):
+        self.task.cancel()
+
+    async def chunks(self):
+        while True:
+            item = await self.queue.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+
+class ModelRouter:
+    def __init__(self):
+        self.health: dict[str, ModelHealth] = {}
+        self.fallbacks = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.abandoned = 0
+
+    def _health(self, model_name: str) -> ModelHealth:
+        health = self.health.get(model_name)
+        if health is None:
+            health = self.health[model_name] = ModelHealth()
+        return health
+
+    def candidates(self, primary: str) -> List[str]:
+        """主模型 (健康时) + 健康的备选模型，备选按 p50 首 token 延迟从快到慢"""
+        fallbacks = [
+            name
+            for name in ROUTER_FALLBACK_MODELS
+            if name != primary and self._health(name).healthy()
+        ]
+        fallbacks.sort(key=lambda name: self._health(name).percentile(0.5) or 0.0)
+        fallbacks = fallbacks[:ROUTER_MAX_FALLBACKS]
+        if self._health(primary).healthy() or not fallbacks:
+            return [primary] + fallbacks
+        return fallbacks
+
+    def hedge_delay(self, model_name: str) -> float:
+        if ROUTER_HEDGE_AFTER > 0:
+            return ROUTER_HEDGE_AFTER
+        health = self._health(model_name)
+        if len(health.latencies) < ROUTER_MIN_SAMPLES:
+            return 2.0
+        return health.percentile(0.95)
+
+    async def astream(
+        self,
+        prompt_template: ChatPromptTemplate,
+        primary: str,
+        inputs: dict,
+        on_abandoned: Optional[Callable[[str, float], None]] = None,
+    ):
+        """按路由策略流式调用，依次产出 (实际使用的模型, chunk)
+
+        只在首个 token 之前做降级 / 对冲；一旦开始输出，后续出错直接抛给调用方。
+        on_abandoned(模型, 已等待秒数) 在路由主动取消一个已发出的请求时调用，用于记账。
+        """
+        last_error: Optional[BaseException] = None
+        for index, model_name in enumerate(self.candidates(primary)):
+            if index > 0:
+                self.fallbacks += 1
+                logger.warning(f"⚠️ Falling back to {model_name}")
+            winner = await self._race(
+                prompt_template, model_name, inputs, hedge=index == 0, on_abandoned=on_abandoned
+            )
+            if isinstance(winner, _StreamAttempt):
+                try:
+                    async for chunk in winner.chunks():
+                        yield winner.model, chunk
+                except Exception:
+                    self._health(winner.model).record(False)
+                    raise
+                else:
+                    self._health(winner.model).record(True)
+                finally:
+                    # 调用方中途放弃 (例如客户端断开) 时不再继续占用上游连接
+                    winner.cancel()
+                return
+            last_error = winner
+        raise last_error or RuntimeError("No model available")
+
+    def _abandon(self, attempt: _StreamAttempt, on_abandoned):
+        attempt.cancel()
+        if attempt.sent:
+            self.abandoned += 1
+            if on_abandoned is not None:
+                on_abandoned(attempt.model, time.monotonic() - attempt.started)
+
+    async def _race(self, prompt_template, model_name: str, inputs: dict, hedge: bool, on_abandoned=None):
+        """等第一个吐出首 token 的请求；都失败 / 超时则返回最后一个错误
+
+        这里只记录首 token 延迟和首 token 之前的失败，赢家的成败由 astream 在流结束时记录。
+        """
+        attempts = [_StreamAttempt(model_name, prompt_template, inputs)]
+        hedge_model = ROUTER_HEDGE_MODEL
+        can_hedge = (
+            hedge
+            and hedge_model
+            and hedge_model != model_name
+            and self._health(hedge_model).healthy()
+        )
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        hedge_at = started + self.hedge_delay(model_name)
+        deadline = started + ROUTER_FIRST_TOKEN_TIMEOUT
+        last_error: BaseException = asyncio.TimeoutError(
+            f"{model_name}: no first token in {ROUTER_FIRST_TOKEN_TIMEOUT}s"
+        )
+
+        while attempts:
+            wake_at = hedge_at if can_hedge else deadline
+            try:
+                done, _ = await asyncio.wait(
+                    [attempt.first for attempt in attempts],
+                    timeout=max(0.0, wake_at - loop.time()),
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+            except asyncio.CancelledError:
+                # 玩家断开连接时，尚未出首 token 的请求一并取消
+                for attempt in attempts:
+                    attempt.cancel()
+                raise
+            if not done:
+                if can_hedge:
+                    can_hedge = False
+                    self.hedges += 1
+                    logger.info(f"⏱️ Hedging {model_name} with {hedge_model}")
+                    attempts.append(_StreamAttempt(hedge_model, prompt_template, inputs))
+                    continue
+                break
+
+            for attempt in [a for a in attempts if a.first.done()]:
+                error = attempt.first.result()
+                if error is None:
+                    self._health(attempt.model).record_latency(attempt.first_token_latency)
+                    if attempt.model != model_name:
+                        self.hedge_wins += 1
+                    for other in attempts:
+                        if other is not attempt:
+                            self._health(other.model).record_latency(
+                                time.monotonic() - other.started
+                            )
+                            self._abandon(other, on_abandoned)
+                    return attempt
+                self._health(attempt.model).record(False)
+                logger.warning(f"LLM Invocation Error ({attempt.model}): {error}")
+                attempts.remove(attempt)
+                last_error = error
+
+        # 超时: 还在等首 token 的请求记为失败并取消
+        for attempt in attempts:
+            self._health(attempt.model).record(False)
+            self._abandon(attempt, on_abandoned)
+        return last_error
+
+    def stats(self):
+        models = {}
+        for name, health in self.health.items():
+            p50, p95 = health.percentile(0.5), health.percentile(0.95)
+            models[name] = {
+                "requests": health.requests,
+                "errors": health.errors,
+                "error_rate": round(health.error_rate(), 4),
+                "healthy": health.healthy(),
+                "p50_first_token_ms": round(p50 * 1000, 1) if p50 is not None else None,
+                "p95_first_token_ms": round(p95 * 1000, 1) if p95 is not None else None,
+            }
+        return {
+            "fallbacks": self.fallbacks,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "abandoned": self.abandoned,
+            "models": models,
+        }
+
+
+model_router = ModelRouter()
+
+
 if sys.platform.startswith("win"):
     asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await asyncio.to_thread(puzzle_catalog.refresh)
+    # 预先加载各模型的 tokenizer (可能需要下载词表)，避免第一轮对话卡住
+    for model_name in MODEL_PRICING:
+        await asyncio.to_thread(get_token_counter, model_name)
+    usage_writer.start()
+    game_turn_writer.start()
+    progress_writer.start()
+    sweeper = asyncio.create_task(session_manager.run_sweeper(SESSION_SWEEP_INTERVAL))
+    puzzle_watcher = asyncio.create_task(
+        puzzle_catalog.run_watcher(PUZZLE_REFRESH_INTERVAL)
+    )
+    yield
+    sweeper.cancel()
+    puzzle_watcher.cancel()
+    await summary_queue.close()
+    await close_llm_clients()
+    await rate_limiter.close()
+    await usage_writer.close()
+    await game_turn_writer.close()
+    await progress_writer.close()
+    password_executor.shutdown(wait=False)
+    await async_engine.dispose()
+    if hasattr(checkpointer, "close"):
+        checkpointer.close()
+
+
+class MetricsMiddleware:
+    """按路由模板 (而不是实际路径，避免题目 id 等把时间序列撑爆) 统计每个接口的耗时"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        started = time.perf_counter()
+        status_code = 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = getattr(scope.get("route"), "path", "unmatched")
+            http_request_seconds.observe(
+                time.perf_counter() - started, scope["method"], route, str(status_code)
+            )
+
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(MetricsMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -185,36 +953,61 @@ app.add_middleware(
 )
 
 
+@app.exception_handler(CheckpointConflict)
+async def checkpoint_conflict_handler(request: Request, exc: CheckpointConflict):
+    # 同一局的两个请求落在不同 worker 上、基于同一状态并发写入: 后到的一方放弃，由客户端重试
+    logger.warning(f"⚠️ Checkpoint conflict: {exc}")
+    return JSONResponse(status_code=409, content={"detail": "对局状态已被另一个请求更新，请重试"})
+
+
 # --- 1. 定义 Prompt 模板 (核心修改) ---
 
-HOST_PROMPT = """
+# 主持人 Prompt 按“静态规则 → 本题数据 → 本轮输入”的顺序拆成三段:
+# 前两段作为 system 消息，在同一局 (规则部分甚至跨局) 的每一轮都完全相同，
+# 这样 OpenAI 兼容接口 / DeepSeek / Gemini 的前缀缓存都能命中，只有最后的 user 消息每轮变化。
+
+# 第一段: 静态规则 (所有对局共用，不能包含任何占位符；JSON 示例里的花括号要写成 {{ }})
+# 主持人按 {"verdict", "reply"} 输出 JSON，由 host_output.HostOutputParser 边流式边解析，
+# 猜中与否直接读 verdict 字段，不再匹配回复文字。
+# 分支编号 (1 提示 / 2 猜真相 / 3 复合提问 / 4 普通提问) 由 classify_intent 的结果决定，见 INTENT_BRANCHES。
+# 玩家输入的类型 (提示 / 猜真相 / 提问) 由本地预分类器 classify_intent 事先判断，
+# 每种类型只发送对应的那部分规则，Prompt 更短；同一类型的规则仍然逐字相同，前缀缓存照常命中。
+HOST_ROLE_PROMPT = """
 # Role: 海龟汤主持人
 
 你是一个严谨且富有悬疑感的侧向思维解谜游戏（海龟汤）主持人。你的目标是引导用户通过提问还原故事真相。
+下文会给出本局的 [汤面] 和 [汤底]，用户每轮的输入在最后的用户消息中。
+"""
 
-## 游戏数据
-### [汤面] (公开给用户的故事)
-{story}
-
-### [汤底] (绝对机密，仅供判断使用)
-{truth}
+# 普通提问 / 复合提问
+HOST_QUESTION_RULES = """
+## 任务指令
+用户的输入是“是/否”提问，请依据 [汤底] 严格判断：
+1. **是**：与汤底事实一致。
+   - *特殊技巧*：如果是关键信息，可回复“是（这是关键点）”。
+2. **不是**：与汤底事实相反。
+3. **无关**：提问内容在故事中不存在，或对解谜无逻辑帮助。
+4. **是又不是**：问题包含正确和错误的部分，或存在歧义（需用户澄清）。
 
-## 当前状态
-### 用户已确认的信息 (摘要)
-{summary}
+如果一个输入中包含多个独立问题，务必**逐条回答**，严禁合并。
+- 格式：“1. 是的。 2. 不是。 3. 与此无关。”
 
-### [近期对话上下文]
-{recent_history}
+## 注意事项
+- **严禁剧透**：绝不能直接输出完整汤底。
+- **语气控制**：保持客观、简练，不要废话。
+- **前缀识别**：如果用户是在用一段长描述猜测真相，尽量按普通提问（是/否）处理，或者提示用户“如果你想猜测真相，请以‘真相：’开头”。
 
-### 用户当前输入
-{user_question}
+## 输出格式
+只输出一个 JSON 对象，字段顺序固定为 verdict、reply，不要输出 JSON 以外的任何内容：
+{{"verdict": "no", "reply": "不是。"}}
+- verdict：1 为 "yes"，2 为 "no"，3 为 "irrelevant"，4 为 "partial"；逐条回答多个问题时为 "multiple"。
+- reply：给用户看的回复内容。
+"""
 
+# 请求提示
+HOST_HINT_RULES = """
 ## 任务指令
-请分析用户的输入意图，并严格按以下优先级逻辑分支进行回复：
-
-### 分支 1：用户请求提示
-**触发条件**：用户明确询问“有没有提示？”、“给个提示”、“卡住了”或“hint”。
-**执行逻辑**：
+用户在请求提示。
 1. 对比 [汤底] 和 [用户已确认的信息]。
 2. 找出一个用户尚未触及、但对解开谜题至关重要的**关键线索**（如：人物关系、作案动机、物理环境、关键物品）。
 3. 生成一个**隐晦的引导**。不要直接告诉答案，而是引导思考方向。
@@ -222,38 +1015,59 @@ HOST_PROMPT = """
    - *正确示范*：“提示：你注意到了他提到的那个包裹，但你是否考虑过包裹里装的东西和他的职业有什么联系？”
    - *正确示范*：“提示：试试从‘声音’这个角度去提问。”
 
-### 分支 2：试图还原真相（猜测汤底）
-**触发条件**：用户输入以 **“真相：”** 或 **“真相:”** 开头（例如：“真相：是因为他杀了人...”）。
-**执行逻辑**：
-1. 提取“真相：”后面的内容，将其与 [汤底] 进行比对。
-2. **完全猜对**：涵盖核心诡计、因果逻辑、关键细节（相似度>80%）。
-   - 回复：“🎉 **恭喜你，猜对了！** \n\n真相是：{truth}”
-3. **非常接近**：核心诡计正确，但缺少关键细节。
+## 注意事项
+- **严禁剧透**：绝不能直接输出完整汤底。
+- **语气控制**：保持客观、简练，不要废话。
+
+## 输出格式
+只输出一个 JSON 对象，字段顺序固定为 verdict、reply，不要输出 JSON 以外的任何内容：
+{{"verdict": "hint", "reply": "提示：……"}}
+- verdict 固定为 "hint"。
+- reply：给用户看的提示内容。
+"""
+
+# 以“真相：”开头的猜测
+HOST_GUESS_RULES = """
+## 任务指令
+用户以“真相：”开头，试图还原真相。提取“真相：”后面的内容，将其与 [汤底] 进行比对：
+1. **完全猜对**：涵盖核心诡计、因果逻辑、关键细节（相似度>80%）。
+   - 回复：“🎉 **恭喜你，猜对了！** \n\n真相是：[完整复述汤底]”
+2. **非常接近**：核心诡计正确，但缺少关键细节。
    - 回复：“**非常接近了！** 大方向是对的，但在 [指出具体的错误点或缺失点] 上还需要再推敲一下。”
-4. **猜错**：核心逻辑错误。
+3. **猜错**：核心逻辑错误。
    - 回复：“很遗憾，这不是真相。请继续提问。”
 
-### 分支 3：复合提问（一次问多个问题）
-**触发条件**：一个输入中包含多个独立问题。
-**执行逻辑**：
-- 务必**逐条回答**，严禁合并。
-- 格式：“1. 是的。 2. 不是。 3. 与此无关。”
+## 注意事项
+- **严禁剧透**：除非完全猜对，否则绝不能直接输出完整汤底。
 
-### 分支 4：普通提问
-**触发条件**：常规的“是/否”提问。
-**执行逻辑**：依据 [汤底] 严格判断：
-1. **是**：与汤底事实一致。
-   - *特殊技巧*：如果是关键信息，可回复“是（这是关键点）”。
-2. **不是**：与汤底事实相反。
-3. **无关**：提问内容在故事中不存在，或对解谜无逻辑帮助。
-4. **是又不是**：问题包含正确和错误的部分，或存在歧义（需用户澄清）。
+## 输出格式
+只输出一个 JSON 对象，字段顺序固定为 verdict、reply，不要输出 JSON 以外的任何内容：
+{{"verdict": "wrong", "reply": "很遗憾，这不是真相。请继续提问。"}}
+- verdict：1 为 "solved"，2 为 "close"，3 为 "wrong"。
+- reply：给用户看的回复内容（即上面对应分支的回复）。
+"""
 
-## 注意事项
-- **严禁剧透**：除非用户触发 [分支 2] 且猜对，否则绝不能直接输出完整汤底。
-- **语气控制**：保持客观、简练，不要废话。
-- **前缀识别**：对于 [分支 2]，必须严格检查“真相：”前缀，没有前缀的即使是一段长描述，也尽量按普通提问（是/否）处理，或者提示用户“如果你想猜测真相，请以‘真相：’开头”。
+# 第二段: 本题数据 (同一局内不变)
+HOST_PUZZLE_PROMPT = """
+## 游戏数据
+### [汤面] (公开给用户的故事)
+{story}
+
+### [汤底] (绝对机密，仅供判断使用)
+{truth}
+"""
+
+# 第三段: 本轮输入 (每轮变化，放在最后)
+HOST_TURN_PROMPT = """
+## 当前状态
+### 用户已确认的信息 (摘要)
+{summary}
+
+### [近期对话上下文]
+{recent_history}
 
-请直接输出回复内容。
+### 用户当前输入
+{user_question}
 """
 
 SUMMARY_PROMPT = """
@@ -272,11 +1086,11 @@ SUMMARY_PROMPT = """
 ### 之前的摘要
 {summary}
 
-### 最近 10 轮问答记录
+### 上次摘要之后的问答记录
 {recent_history}
 
 ## 任务指令
-请整合 [之前的摘要] 和 [最近 10 轮问答记录]，生成一个新的、简练的**“已知线索清单”**。
+请整合 [之前的摘要] 和 [上次摘要之后的问答记录]，生成一个新的、简练的**“已知线索清单”**。
 1. **筛选有效信息**：只保留用户已经猜对（主持人回答“是”）的关键事实。
 2. **记录排除项**：如果用户排除了重要的错误路径（主持人回答“不是”），简要记录。
 3. **严禁剧透**：不要把用户还没猜出来的汤底细节写进摘要。
@@ -284,25 +1098,607 @@ SUMMARY_PROMPT = """
 请直接输出一段纯文本摘要。
 """
 
-# --- 2. LangGraph State ---
+# Prompt 模板在启动时解析一次，之后每轮直接复用
+# 意图 -> 主持人 system 规则；未列出的意图使用普通提问的规则
+HOST_RULES_BY_INTENT = {
+    "hint": HOST_ROLE_PROMPT + HOST_HINT_RULES,
+    "guess": HOST_ROLE_PROMPT + HOST_GUESS_RULES,
+    "question": HOST_ROLE_PROMPT + HOST_QUESTION_RULES,
+}
+HOST_PROMPT_TEMPLATES = {
+    intent: ChatPromptTemplate.from_messages(
+        [
+            ("system", rules + HOST_PUZZLE_PROMPT),
+            ("human", HOST_TURN_PROMPT),
+        ]
+    )
+    for intent, rules in HOST_RULES_BY_INTENT.items()
+}
+# 主持人模板额外打开接口的 JSON 模式 (response_format)，模型输出必定是合法 JSON；
+# 上游不支持 response_format 时置空，只靠 Prompt 约束，解析失败的回复按纯文本处理
+HOST_RESPONSE_FORMAT = os.environ.get("HOST_RESPONSE_FORMAT", "json_object")
+_JSON_TEMPLATE_IDS = {id(template) for template in HOST_PROMPT_TEMPLATES.values()}
+SUMMARY_PROMPT_TEMPLATE = ChatPromptTemplate.from_template(SUMMARY_PROMPT)
+
+# (prompt 模板, 模型名) -> 预先拼好的 prompt | llm 链
+_chains = {}
+
+
+def get_chain(prompt_template: ChatPromptTemplate, model_name: str):
+    key = (id(prompt_template), model_name)
+    chain = _chains.get(key)
+    if chain is None:
+        chain_cache_stats["misses"] += 1
+        llm = get_llm(model_name)
+        if HOST_RESPONSE_FORMAT and key[0] in _JSON_TEMPLATE_IDS:
+            llm = llm.bind(response_format={"type": HOST_RESPONSE_FORMAT})
+        chain = _chains[key] = prompt_template | llm
+    else:
+        chain_cache_stats["hits"] += 1
+    return chain
+
+
+# --- 意图预分类 ---
+# 在调用主持人模型之前，先用本地规则判断玩家输入属于哪一类:
+#   empty     空输入 / 只有标点        -> 直接提示，不调用模型
+#   duplicate 普通是非题且与上一个问题完全相同 -> 直接复述上一轮的回答，不调用模型
+#             (提示和猜测每次都要重新生成 / 比对，不做去重)
+#   guess     以“真相：”开头的猜测     -> 只发送“比对真相”的规则
+#   hint      请求提示                 -> 只发送“给提示”的规则
+#   compound  一次问了多个问题         -> 普通提问的规则 (要求逐条回答)
+#   question  普通是非题               -> 普通提问的规则，可走答案缓存
+# 规则之外还可以挂自定义分类器 (例如本地小模型)，见 register_intent_classifier。
+INTENT_EMPTY = "empty"
+INTENT_DUPLICATE = "duplicate"
+INTENT_GUESS = "guess"
+INTENT_HINT = "hint"
+INTENT_COMPOUND = "compound"
+INTENT_QUESTION = "question"
+# 主持人规则的分支编号，所有意图统一编码；本地直接回复的 (空输入 / 重复提问) 没有分支
+INTENT_BRANCHES = {INTENT_HINT: 1, INTENT_GUESS: 2, INTENT_COMPOUND: 3, INTENT_QUESTION: 4}
+
+_HINT_RE = re.compile(
+    r"(给|来|要|求|有没有|有无)(个|点|一个|一点|些)?(提示|线索)|提示一下|卡住了|卡关|^hint\b",
+    re.IGNORECASE,
+)
+_COMPOUND_RE = re.compile(r"[；;]|(^|\s)\d[.、)）]")
+
+# 自定义分类器，签名 fn(text: str) -> Optional[str]，返回 None 表示交给下一个分类器 / 内置规则
+_intent_classifiers = []
+
+
+def register_intent_classifier(classifier):
+    _intent_classifiers.append(classifier)
+    return classifier
+
+
+# INTENT_CLASSIFIER: 以 "模块:函数" 的形式指定一个额外的分类器，启动时加载
+if os.environ.get("INTENT_CLASSIFIER"):
+    _module_name, _func_name = os.environ["INTENT_CLASSIFIER"].split(":", 1)
+    register_intent_classifier(getattr(importlib.import_module(_module_name), _func_name))
+
+
+def rule_based_intent(text: str) -> str:
+    text = text.strip()
+    if text.startswith(("真相：", "真相:")):
+        return INTENT_GUESS
+    if _HINT_RE.search(text):
+        return INTENT_HINT
+    if len(re.findall(r"[?？]", text)) > 1 or _COMPOUND_RE.search(text):
+        return INTENT_COMPOUND
+    return INTENT_QUESTION
+
+
+def classify_intent(text: str, previous_question: Optional[str] = None) -> str:
+    if not normalize_search_text(text):
+        return INTENT_EMPTY
+    intent = None
+    for classifier in _intent_classifiers:
+        try:
+            intent = classifier(text)
+        except Exception as e:
+            logger.warning(f"⚠️ Intent classifier {classifier.__name__} failed: {e}")
+            continue
+        if intent is not None:
+            break
+    if intent is None:
+        intent = rule_based_intent(text)
+    # 先分类再去重: 连续两次“给个提示”应该得到新的提示，而不是复述上一条
+    if (
+        intent == INTENT_QUESTION
+        and previous_question is not None
+        and normalize_question(text) == normalize_question(previous_question)
+    ):
+        return INTENT_DUPLICATE
+    return intent
+
+
+# --- Token 计数 & 上下文预算 ---
+# 主持人 Prompt 的输入 token 由 4 部分组成: 固定前缀 (规则 + 本题汤面汤底)、摘要、近期对话、本轮提问。
+# 每个模型有一个输入 token 预算，近期对话只保留预算放得下的部分；
+# 未总结的对话快占满近期对话窗口时触发后台总结 (代替原来固定的每 10 轮一次)。
+# CONTEXT_TOKEN_BUDGET: 默认预算；MODEL_CONTEXT_BUDGETS: 按模型覆盖，例如 "gpt-4o=4000"
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", "6000"))
+MODEL_CONTEXT_BUDGETS = parse_model_map(os.environ.get("MODEL_CONTEXT_BUDGETS", ""))
+# 给下一轮提问预留的 token 数
+CONTEXT_QUESTION_RESERVE = int(os.environ.get("CONTEXT_QUESTION_RESERVE", "256"))
+# 近期对话窗口有两个上限: token 预算和 TRANSCRIPT_MAX_LINES 行数，哪个先到都会把最旧的行挤出去。
+# 未总结的对话达到任一上限的这个比例时触发总结，赶在它们被挤出窗口之前写进摘要
+CONTEXT_COMPACT_RATIO = float(os.environ.get("CONTEXT_COMPACT_RATIO", "0.75"))
+# 近期对话最多保留多少行 (一问一答算两行)，保证每轮开销有上限
+TRANSCRIPT_MAX_LINES = int(os.environ.get("TRANSCRIPT_MAX_LINES", "40"))
+
+
+def window_nearly_full(unsummarized_tokens: int, unsummarized_lines: int, history_budget: int) -> bool:
+    """未总结的对话是否快要被挤出近期对话窗口 (token 预算和行数上限，哪个先到算哪个)"""
+    return (
+        unsummarized_tokens >= history_budget * CONTEXT_COMPACT_RATIO
+        or unsummarized_lines >= TRANSCRIPT_MAX_LINES * CONTEXT_COMPACT_RATIO
+    )
+
+
+def estimate_tokens(text: str) -> int:
+    """没有本地 tokenizer 时的保守估算: 中文约 1 字 1 token，英文约 3 字符 1 token"""
+    return len(text.encode("utf-8")) // 3 + 1
+
+
+@lru_cache(maxsize=None)
+def load_encoding(encoding_name: str):
+    """加载 tiktoken 词表，失败 (未安装 / 离线下载不到词表) 时返回 None，只尝试一次"""
+    try:
+        import tiktoken
+
+        return tiktoken.get_encoding(encoding_name)
+    except Exception as e:
+        logger.warning(f"⚠️ Tokenizer {encoding_name} unavailable, using estimate: {type(e).__name__}")
+        return None
+
+
+@lru_cache(maxsize=None)
+def get_token_counter(model_name: str):
+    """每个模型只解析一次 tokenizer；tiktoken 不认识的模型 (Gemini / Claude / DeepSeek)
+    用 o200k_base 近似，词表加载失败时退回字符估算"""
+    try:
+        from tiktoken.model import encoding_name_for_model
+
+        encoding_name = encoding_name_for_model(model_name)
+    except (ImportError, KeyError):
+        encoding_name = "o200k_base"
+    encoding = load_encoding(encoding_name)
+    if encoding is None:
+        return estimate_tokens
+    return lambda text: len(encoding.encode(text, disallowed_special=()))
+
+
+def count_tokens(model_name: str, text: str) -> int:
+    return get_token_counter(model_name)(text)
+
+
+def get_context_budget(model_name: str) -> int:
+    return MODEL_CONTEXT_BUDGETS.get(model_name, CONTEXT_TOKEN_BUDGET)
+
+
+@lru_cache(maxsize=1024)
+def count_prefix_tokens(model_name: str, intent: str, story: str, truth: str) -> int:
+    """固定前缀 (system 消息) 的 token 数，同一局同一类输入每轮都一样，缓存起来"""
+    # 本轮输入模板自身的文字 (标题等) 也每轮固定，一并算进来
+    rules = HOST_RULES_BY_INTENT.get(intent, HOST_RULES_BY_INTENT[INTENT_QUESTION])
+    prefix = rules + HOST_PUZZLE_PROMPT.format(story=story, truth=truth)
+    return count_tokens(model_name, prefix + HOST_TURN_PROMPT)
+
+
+def render_transcript_line(msg: BaseMessage) -> str:
+    role = "用户" if isinstance(msg, HumanMessage) else "主持人"
+    return f"{role}: {msg.content}"
+
+
+def append_transcript(lines: List[str], line_tokens: List[int], new_lines, budget: int):
+    """向近期对话环形缓冲追加若干 (行, token 数)，返回 (行列表, token 列表, 渲染文本, 总 token 数)
+
+    从最旧的行开始丢弃，直到总 token 数不超过 budget 且行数不超过 TRANSCRIPT_MAX_LINES
+    (至少保留本轮的一问一答)；每轮的开销与对局长度无关。
+    渲染结果缓存在 state 里，主持人节点直接拿来用，不再逐条拼接历史消息。
+    """
+    lines = lines + [line for line, _ in new_lines]
+    line_tokens = line_tokens + [tokens for _, tokens in new_lines]
+    total = sum(line_tokens)
+    start = max(0, len(lines) - TRANSCRIPT_MAX_LINES)
+    total -= sum(line_tokens[:start])
+    while total > budget and start < len(lines) - len(new_lines):
+        total -= line_tokens[start]
+        start += 1
+    lines, line_tokens = lines[start:], line_tokens[start:]
+    return lines, line_tokens, "".join(f"{line}\n" for line in lines), total
+
+
+# --- 用量账本 ---
+# 每次 LLM 调用 (主持人回答 / 后台总结) 记一行，先进内存缓冲，由 BatchWriter 在后台批量写入 SQLite，
+# 同一事务里累加 usage_daily 汇总表。热路径上只有一次 deque.append。
+USAGE_FLUSH_INTERVAL = float(os.environ.get("USAGE_FLUSH_INTERVAL", "2"))
+USAGE_FLUSH_BATCH = int(os.environ.get("USAGE_FLUSH_BATCH", "500"))
+# 各 BatchWriter 共用: 一批连续写入失败多少次后改为逐条重写，写不进去的记录移入死信
+FLUSH_MAX_RETRIES = int(os.environ.get("FLUSH_MAX_RETRIES", "8"))
+USAGE_ROLLUP_FIELDS = (
+    "calls",
+    "prompt_tokens",
+    "cached_tokens",
+    "completion_tokens",
+    "total_tokens",
+    "cost",
+    "latency_ms",
+)
+
+
+def compute_cost(model: str, prompt_tokens: int, cached_tokens: int, completion_tokens: int) -> float:
+    """按模型单价计算费用，命中前缀缓存的输入 token 按缓存价计算"""
+    pricing = MODEL_PRICING.get(model, {"input": 0, "output": 0})
+    input_cost = (
+        (prompt_tokens - cached_tokens) * pricing["input"]
+        + cached_tokens * pricing.get("cached_input", pricing["input"])
+    ) / 1_000_000
+    return input_cost + completion_tokens * pricing["output"] / 1_000_000
+
+
+def dialect_insert(table):
+    """INSERT ... ON CONFLICT 的写法 SQLite 和 PostgreSQL 相同，但要用各自方言的 insert"""
+    if engine.dialect.name == "postgresql":
+        return postgresql_insert(table)
+    return sqlite_insert(table)
+
+
+def write_usage_batch(records: list[dict]):
+    rollup: dict[tuple, dict] = {}
+    for record in records:
+        row = rollup.setdefault(
+            (record["day"], record["model"], record["username"]),
+            dict.fromkeys(USAGE_ROLLUP_FIELDS, 0),
+        )
+        row["calls"] += 1
+        for field in USAGE_ROLLUP_FIELDS[1:]:
+            row[field] += record[field]
+
+    table = UsageDaily.__table__
+    with engine.begin() as conn:
+        conn.execute(UsageRecord.__table__.insert(), records)
+        for (day, model, username), row in rollup.items():
+            stmt = dialect_insert(table).values(day=day, model=model, username=username, **row)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=["day", "model", "username"],
+                set_={field: table.c[field] + stmt.excluded[field] for field in row},
+            )
+            conn.execute(stmt)
+
+
+usage_writer = BatchWriter(
+    "usage",
+    write_usage_batch,
+    max_batch=USAGE_FLUSH_BATCH,
+    flush_interval=USAGE_FLUSH_INTERVAL,
+    max_retries=FLUSH_MAX_RETRIES,
+)
+
+
+def record_usage(kind: str, model: str, state: dict, thread_id: str, cb, cost: float, latency: float):
+    add_usage_record(
+        kind,
+        model,
+        state,
+        thread_id,
+        cb.prompt_tokens,
+        cb.prompt_tokens_cached,
+        cb.completion_tokens,
+        cost,
+        latency,
+    )
+
+
+def add_usage_record(
+    kind: str,
+    model: str,
+    state: dict,
+    thread_id: str,
+    prompt_tokens: int,
+    cached_tokens: int,
+    completion_tokens: int,
+    cost: float,
+    latency: float,
+):
+    now = datetime.utcnow()
+    usage_writer.add(
+        {
+            "created_at": now,
+            "day": now.strftime("%Y-%m-%d"),
+            "username": state.get("username") or "",
+            "thread_id": thread_id,
+            "puzzle_id": state.get("puzzle_id"),
+            "model": model,
+            "kind": kind,
+            "prompt_tokens": prompt_tokens,
+            "cached_tokens": cached_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "cost": cost,
+            "latency_ms": latency * 1000,
+        }
+    )
+
+
+# --- 对局历史 ---
+# 登录用户的每一轮一问一答追加到 game_turns，和用量账本一样走 BatchWriter 后台批量插入，
+# /chat 路径上只有一次内存追加。/history 查询最多比实际进度落后 HISTORY_FLUSH_INTERVAL 秒。
+HISTORY_FLUSH_INTERVAL = float(os.environ.get("HISTORY_FLUSH_INTERVAL", "1"))
+HISTORY_FLUSH_BATCH = int(os.environ.get("HISTORY_FLUSH_BATCH", "500"))
+
+
+def write_game_turns(records: list[dict]):
+    turns = GameTurn.__table__
+    table = GameSummary.__table__
+    with engine.begin() as conn:
+        # 批量插入同时取回自增 id，按局汇总后累加到 game_summaries
+        inserted = conn.execute(
+            turns.insert().returning(
+                turns.c.id, turns.c.username, turns.c.thread_id, turns.c.puzzle_id, turns.c.created_at,
+                sort_by_parameter_order=True,
+            ),
+            records,
+        ).all()
+        rollup: dict[tuple, dict] = {}
+        for row in inserted:
+            game = rollup.setdefault(
+                (row.username, row.thread_id),
+                {"puzzle_id": row.puzzle_id, "turns": 0, "started_at": row.created_at},
+            )
+            game["turns"] += 1
+            game["last_played_at"] = row.created_at
+            game["last_id"] = row.id
+        for (username, thread_id), game in rollup.items():
+            stmt = dialect_insert(table).values(username=username, thread_id=thread_id, **game)
+            # 多 worker 时各自的批次可能交错落库，last_id / last_played_at 取两者中较大的
+            stmt = stmt.on_conflict_do_update(
+                index_elements=["username", "thread_id"],
+                set_={
+                    "turns": table.c.turns + stmt.excluded.turns,
+                    "last_id": case(
+                        (stmt.excluded.last_id > table.c.last_id, stmt.excluded.last_id),
+                        else_=table.c.last_id,
+                    ),
+                    "last_played_at": case(
+                        (stmt.excluded.last_played_at > table.c.last_played_at, stmt.excluded.last_played_at),
+                        else_=table.c.last_played_at,
+                    ),
+                },
+            )
+            conn.execute(stmt)
+
+
+def backfill_game_summaries():
+    """game_summaries 是后加的表: 为空而 game_turns 已有数据时，从对局历史聚合一次"""
+    with engine.begin() as conn:
+        if conn.execute(select(GameSummary.username).limit(1)).first() is not None:
+            return
+        if conn.execute(select(GameTurn.id).limit(1)).first() is None:
+            return
+        conn.execute(
+            GameSummary.__table__.insert().from_select(
+                ["username", "thread_id", "puzzle_id", "turns", "started_at", "last_played_at", "last_id"],
+                select(
+                    GameTurn.username,
+                    GameTurn.thread_id,
+                    func.min(GameTurn.puzzle_id),
+                    func.count(),
+                    func.min(GameTurn.created_at),
+                    func.max(GameTurn.created_at),
+                    func.max(GameTurn.id),
+                ).group_by(GameTurn.username, GameTurn.thread_id),
+            )
+        )
+        logger.info("📚 已从 game_turns 补齐 game_summaries")
+
+
+backfill_game_summaries()
+
+
+game_turn_writer = BatchWriter(
+    "game_turns",
+    write_game_turns,
+    max_batch=HISTORY_FLUSH_BATCH,
+    flush_interval=HISTORY_FLUSH_INTERVAL,
+    max_retries=FLUSH_MAX_RETRIES,
+)
+
+
+def record_game_turn(
+    state: dict, thread_id: str, turn: int, question: str, reply: str, intent: str, model: str
+):
+    # 未登录的对局无法归属到个人，不记录
+    if not state.get("username"):
+        return
+    game_turn_writer.add(
+        {
+            "created_at": datetime.utcnow(),
+            "username": state["username"],
+            "thread_id": thread_id,
+            "puzzle_id": state.get("puzzle_id"),
+            "turn": turn,
+            "question": question,
+            "reply": reply,
+            "intent": intent,
+            "model": model,
+        }
+    )
+
+
+# --- 已玩 / 已解开状态 ---
+# 大厅要给每道题标上“玩过 / 解开”，还要支持“只看未玩”。每个用户在内存里有两个题目 id 集合，
+# 首次访问时从 puzzle_progress 读一次，之后每道题的判断都是一次集合查找；
+# /init 和猜中真相时先更新内存，再经 BatchWriter 批量写回数据库。
+# 还没写进数据库的标记单独记一份，从数据库加载时合并进去，不会读到缺了刚刚猜中的旧数据；
+# 缓存的集合 PROGRESS_CACHE_TTL 秒后重新加载，多 worker 时其他进程写入的进度也会在这段时间内可见。
+# 大厅列表本身是所有人共用的预压缩缓存，进度由 /me/progress 单独返回、在前端合并。
+PROGRESS_CACHE_USERS = int(os.environ.get("PROGRESS_CACHE_USERS", "10000"))
+PROGRESS_CACHE_TTL = float(os.environ.get("PROGRESS_CACHE_TTL", "30"))
+PROGRESS_FLUSH_INTERVAL = float(os.environ.get("PROGRESS_FLUSH_INTERVAL", "1"))
+
+
+def write_progress_batch(records: list[dict]):
+    table = PuzzleProgress.__table__
+    stmt = dialect_insert(table)
+    # 已有记录时保留最早的 played_at；solved_at 一旦写入就不再变
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["username", "puzzle_id"],
+        set_={"solved_at": func.coalesce(table.c.solved_at, stmt.excluded.solved_at)},
+    )
+    with engine.begin() as conn:
+        conn.execute(stmt, records)
+
+
+class PuzzleProgressIndex:
+    """用户 -> (玩过的题目 id 集合, 解开的题目 id 集合)，按需加载，TTL 过期 + LRU 淘汰"""
+
+    def __init__(self, max_users: int, ttl_seconds: float):
+        self.max_users = max_users
+        self.ttl_seconds = ttl_seconds
+        # username -> (played, solved, 加载时间)
+        self._users: OrderedDict[str, tuple[set, set, float]] = OrderedDict()
+        # 已提交给 BatchWriter 但还没写进数据库的标记: username -> puzzle_id -> [未落库条数, 是否猜中]
+        self._pending: dict[str, dict[str, list]] = {}
+        self.loads = 0
+
+    async def get(self, username: str) -> tuple[set, set]:
+        entry = self._users.get(username)
+        if entry is not None and time.monotonic() - entry[2] < self.ttl_seconds:
+            self._users.move_to_end(username)
+            return entry[0], entry[1]
+
+        async with AsyncSessionLocal() as db:
+            rows = (
+                await db.execute(
+                    select(PuzzleProgress.puzzle_id, PuzzleProgress.solved_at).where(
+                        PuzzleProgress.username == username
+                    )
+                )
+            ).all()
+        self.loads += 1
+        played = {row.puzzle_id for row in rows}
+        solved = {row.puzzle_id for row in rows if row.solved_at is not None}
+        # 合并还在写入缓冲区里的标记 (查询期间新增的也在这里)
+        for puzzle_id, (_, pending_solved) in self._pending.get(username, {}).items():
+            played.add(puzzle_id)
+            if pending_solved:
+                solved.add(puzzle_id)
+
+        self._users[username] = (played, solved, time.monotonic())
+        self._users.move_to_end(username)
+        while len(self._users) > self.max_users:
+            self._users.popitem(last=False)
+        return played, solved
+
+    def _mark(self, username: str, puzzle_id: str, solved: bool):
+        entry = self._users.get(username)
+        if entry is not None:
+            entry[0].add(puzzle_id)
+            if solved:
+                entry[1].add(puzzle_id)
+        pending = self._pending.setdefault(username, {}).setdefault(puzzle_id, [0, False])
+        pending[0] += 1
+        pending[1] = pending[1] or solved
+        now = datetime.utcnow()
+        progress_writer.add(
+            {
+                "username": username,
+                "puzzle_id": puzzle_id,
+                "played_at": now,
+                "solved_at": now if solved else None,
+            }
+        )
+
+    def mark_played(self, username: str, puzzle_id: str):
+        entry = self._users.get(username)
+        if entry is not None and puzzle_id in entry[0]:
+            return  # 重开同一道题不必再写库
+        self._mark(username, puzzle_id, solved=False)
+
+    def mark_solved(self, username: str, puzzle_id: str):
+        entry = self._users.get(username)
+        if entry is not None and puzzle_id in entry[1]:
+            return
+        self._mark(username, puzzle_id, solved=True)
+
+    def on_flushed(self, records: list[dict]):
+        """BatchWriter 写入成功后回调: 这些标记已经能从数据库读到了"""
+        for record in records:
+            user_pending = self._pending.get(record["username"])
+            pending = user_pending.get(record["puzzle_id"]) if user_pending else None
+            if pending is None:
+                continue
+            pending[0] -= 1
+            if pending[0] <= 0:
+                del user_pending[record["puzzle_id"]]
+                if not user_pending:
+                    del self._pending[record["username"]]
+
+    def stats(self):
+        return {
+            "users": len(self._users),
+            "loads": self.loads,
+            "pending_users": len(self._pending),
+        }
+
+
+progress_index = PuzzleProgressIndex(PROGRESS_CACHE_USERS, PROGRESS_CACHE_TTL)
+progress_writer = BatchWriter(
+    "puzzle_progress",
+    write_progress_batch,
+    flush_interval=PROGRESS_FLUSH_INTERVAL,
+    max_retries=FLUSH_MAX_RETRIES,
+    on_flushed=progress_index.on_flushed,
+)
+
+# 主持人判定猜中时的固定开头 (见 HOST_GUESS_RULES)，只在模型没有按 JSON 输出时兜底使用
+SOLVED_MARKER = "恭喜你，猜对了"
+
+
+def is_solved_turn(intent: str, verdict: Optional[str], reply: str) -> bool:
+    if intent != INTENT_GUESS:
+        return False
+    if verdict is not None:
+        return verdict == VERDICT_SOLVED
+    return SOLVED_MARKER in reply
 
 
 class GameState(TypedDict):
-    story: str
-    truth: str
-    history: List[BaseMessage]
+    puzzle_id: str  # 只存题目 id，汤面 / 汤底统一从 puzzle_catalog 读取
+    # add_messages: /chat 只需传入本轮新消息，由 reducer 追加，不再整表拷贝
+    history: Annotated[List[BaseMessage], add_messages]
+    transcript: List[str]  # 近期对话的渲染行 (环形缓冲，受 token 预算和 TRANSCRIPT_MAX_LINES 限制)
+    transcript_tokens: List[int]  # transcript 每行的 token 数
+    recent_history_text: str  # transcript 渲染后的缓存文本
+    unsummarized_tokens: int  # 上次总结之后新增对话的 token 数
+    unsummarized_lines: int  # 上次总结之后新增的近期对话行数
+    needs_compaction: bool  # 未总结的对话快超出预算，需要后台总结
     summary: str
     turn_count: int
     model: str  # <--- 存入 State
     last_cost: float  # <--- 存入单次费用
     last_tokens: int  # <--- 存入单次Token
+    last_cached_tokens: int  # 单次命中前缀缓存的输入 Token
+    last_prompt_tokens: int  # 调用前本地估算的 Prompt Token
+    last_model: str  # 本轮实际回答的模型 (可能被路由降级 / 对冲到其他模型)
+    username: str  # 开局的登录用户 (未登录为空串)，用于用量账本
+    last_verdict: str  # 本轮主持人的判定 (solved / close / wrong / yes / no ...)，未知为空串
+    last_branch: Optional[int]  # 本轮输入对应的规则分支 (1 提示 / 2 猜真相 / 3 复合提问 / 4 普通提问，见 INTENT_BRANCHES)
+    solved: bool  # 本局是否已经猜中真相
+    last_question: str  # 上一轮交给主持人回答的提问，用于识别重复提问
+    last_reply: str  # 上一轮主持人的回答
+    given_up: bool  # 玩家已经放弃并查看了汤底，之后再猜中也不计入进度
 
 
 # --- 3. 节点逻辑 ---
 
 
-def host_node(state: GameState):
+async def host_node(state: GameState, config: RunnableConfig):
     """主持人回答节点"""
+    node_started = time.perf_counter()
     current_history_msgs = state.get("history", [])
     summary = state.get("summary", "暂无信息")
     # 使用 .get() 设置默认值，防止 KeyError
@@ -310,21 +1706,20 @@ def host_node(state: GameState):
     turn_count = state.get("turn_count", 0)
 
     # --- 关键修复：检查状态是否丢失 ---
-    # 如果 story 不存在，说明服务器重启过，内存中的 thread_id 丢失
-    story = state.get("story")
-    truth = state.get("truth")
+    # 如果题目不存在，说明服务器重启过 (内存中的 thread_id 丢失)，或者题目已被下架
+    puzzle = puzzle_catalog.by_id.get(state.get("puzzle_id"))
 
-    if not story or not truth:
-        print(f"⚠️ Error: State missing for thread. Likely due to server restart.")
+    if puzzle is None:
+        logger.warning(f"⚠️ Error: State missing for thread. Likely due to server restart.")
         return {
-            "history": current_history_msgs
-            + [
+            "history": [
                 AIMessage(
                     content="⚠️ **系统连接中断** \n\n服务器可能刚刚进行了更新或重启，导致当前会话记忆丢失。请点击页面上方的 **[刷新]** 或 **[← 返回大厅]** 重新开始游戏。"
                 )
             ],
             "turn_count": 0,
         }
+    story, truth = puzzle["question"], puzzle["answer"]
     # --------------------------------
 
     if not current_history_msgs:
@@ -333,150 +1728,1041 @@ def host_node(state: GameState):
     last_message = current_history_msgs[-1]
     user_question = last_message.content
 
-    # 2. 提取之前的对话作为上下文
-    previous_msgs = current_history_msgs[:-1]
-    recent_history_text = ""
-    display_msgs = previous_msgs[-20:] if len(previous_msgs) > 20 else previous_msgs
-    if not display_msgs:
-        recent_history_text = "（暂无近期对话）"
-    else:
-        for msg in display_msgs:
-            role = "用户" if isinstance(msg, HumanMessage) else "主持人"
-            recent_history_text += f"{role}: {msg.content}\n"
-
-    # 1. 动态获取 LLM
-    try:
-        llm_instance = create_llm_instance(selected_model)
-    except Exception as e:
-        # 处理模型初始化失败的情况
+    # 流式输出：/chat/stream 通过 stream_mode="custom" 接收这里写出的 token；
+    # 普通 /chat 调用时 writer 是空操作
+    writer = get_stream_writer()
+
+    # 0. 本地预分类: 空输入和重复提问直接回复，不调用模型，也不计入轮数
+    transcript = state.get("transcript", [])
+    intent = classify_intent(user_question, state.get("last_question") or None)
+    if intent in (INTENT_EMPTY, INTENT_DUPLICATE):
+        if intent == INTENT_EMPTY:
+            reply_text = "请输入你的问题。"
+        else:
+            reply_text = f"这个问题刚刚问过啦，上一轮的回答是：{state.get('last_reply', '')}"
+        logger.info(f"Skip LLM ({intent}): {user_question!r}")
+        turns_total.inc(intent, "local")
+        # 回复只通过流推给调用方，不进 history: 既不增加 checkpoint 写入，也不会被当成线索交给总结；
+        # 本轮的输入消息一并撤回
+        writer({"type": "token", "content": reply_text})
         return {
-            "history": current_history_msgs
-            + [AIMessage(content=f"❌ 模型初始化失败: {str(e)}")],
-            "turn_count": turn_count,
+            "history": [RemoveMessage(id=last_message.id)],
+            "last_cost": 0.0,
+            "last_tokens": 0,
+            "last_cached_tokens": 0,
+            "last_prompt_tokens": 0,
+            "last_verdict": "",
+            "last_branch": None,
         }
 
-    prompt = ChatPromptTemplate.from_template(HOST_PROMPT)
-    chain = prompt | llm_instance
+    # 2. 之前的对话上下文: 直接使用上一轮缓存好的渲染文本
+    recent_history_text = state.get("recent_history_text") or "（暂无近期对话）"
+
+    # 调用前估算本轮 Prompt 的 token 数
+    budget = get_context_budget(selected_model)
+    prefix_tokens = count_prefix_tokens(selected_model, intent, story, truth)
+    summary_tokens = count_tokens(selected_model, summary)
+    question_line = render_transcript_line(last_message)
+    question_tokens = count_tokens(selected_model, question_line)
+    prompt_tokens = (
+        prefix_tokens
+        + summary_tokens
+        + sum(state.get("transcript_tokens", []))
+        + question_tokens
+    )
 
     # 这里原本报错的地方，现在使用了安全的 turn_count 变量
-    print(f"\n--- Turn {turn_count + 1} [{selected_model}] ---")
-    print(f"User Question: {user_question}")
+    logger.info(f"--- Turn {turn_count + 1} [{selected_model}] ---")
+    logger.info(f"User Question: {user_question} (Intent: {intent})")
+
+    turn_stage_seconds.observe(time.perf_counter() - node_started, "prompt_build", selected_model)
+
+    # 1. 同一道题的普通是非题先查答案缓存，命中时不调用模型
+    cached_reply = None
+    verdict = None
+    branch = INTENT_BRANCHES.get(intent)
+    if intent == INTENT_QUESTION:
+        cached_reply = answer_cache.get(puzzle, user_question)
+    if cached_reply is not None:
+        reply_text, verdict = cached_reply
+        logger.info(f"Answer Cache Hit (verdict={verdict}): {reply_text}")
+        turns_total.inc(intent, "cache")
+        host_verdicts_total.inc(intent, verdict or "unknown")
+        writer({"type": "token", "content": reply_text})
+        response = AIMessage(content=reply_text)
+        total_cost, total_tokens, cached_tokens, prompt_tokens = 0.0, 0, 0, 0
+        answered_model = selected_model
+    else:
+        logger.info(f"Prompt Tokens (本地估算): {prompt_tokens} / 预算 {budget}")
 
-    # 2. 使用 Callback 捕获 Token
-    try:
-        with get_openai_callback() as cb:
-            response = chain.invoke(
-                {
-                    "story": story,  # 使用上面安全获取的变量
-                    "truth": truth,  # 使用上面安全获取的变量
-                    "summary": summary,
-                    "recent_history": recent_history_text,
-                    "user_question": user_question,
-                }
+        prompt_template = HOST_PROMPT_TEMPLATES.get(
+            intent, HOST_PROMPT_TEMPLATES[INTENT_QUESTION]
+        )
+
+        # 被路由取消的请求 (对冲输家 / 首 token 超时) 拿不到用量回调，
+        # 按本地估算的输入 token 记一笔 abandoned，避免账本漏掉这部分费用
+        def record_abandoned(model_name: str, waited: float):
+            cost = compute_cost(model_name, prompt_tokens, 0, 0)
+            logger.info(f"Abandoned [{model_name}] after {waited:.2f}s, ~{prompt_tokens} prompt tokens (${cost:.6f})")
+            add_usage_record(
+                "abandoned",
+                model_name,
+                state,
+                config["configurable"]["thread_id"],
+                prompt_tokens,
+                0,
+                0,
+                cost,
+                waited,
             )
 
-            # 3. 计算实际费用
-            pricing = MODEL_PRICING.get(selected_model, {"input": 0, "output": 0})
-            input_cost = (cb.prompt_tokens / 1_000_000) * pricing["input"]
-            output_cost = (cb.completion_tokens / 1_000_000) * pricing["output"]
-            total_cost = input_cost + output_cost
+        # 2. 经模型路由调用 (超时 / 出错时降级到备选模型)，使用 Callback 捕获 Token
+        try:
+            with get_openai_callback() as cb:
+                started = time.perf_counter()
+                # 模型输出的是 JSON，只把 reply 字段的文字推给玩家
+                parser = HostOutputParser()
+                first_token = True
+                async for answered_model, chunk in model_router.astream(
+                    prompt_template,
+                    selected_model,
+                    {
+                        "story": story,  # 使用上面安全获取的变量
+                        "truth": truth,  # 使用上面安全获取的变量
+                        "summary": summary,
+                        "recent_history": recent_history_text,
+                        "user_question": user_question,
+                    },
+                    on_abandoned=record_abandoned,
+                ):
+                    if chunk.content:
+                        if first_token:
+                            first_token = False
+                            turn_stage_seconds.observe(
+                                time.perf_counter() - started, "llm_first_token", answered_model
+                            )
+                        text = parser.feed(chunk.content)
+                        if text:
+                            writer({"type": "token", "content": text})
+                text = parser.close()
+                if text:
+                    writer({"type": "token", "content": text})
+                reply_text, verdict, _ = parser.output
+                host_verdicts_total.inc(intent, verdict or "unknown")
+                response = AIMessage(content=reply_text)
+                latency = time.perf_counter() - started
+                turn_stage_seconds.observe(latency, "llm_total", answered_model)
+                turns_total.inc(intent, "llm")
+
+                # 3. 计算实际费用 (按实际回答的模型计价，命中前缀缓存的输入 token 按缓存价计算)
+                cached_tokens = cb.prompt_tokens_cached
+                total_cost = compute_cost(
+                    answered_model, cb.prompt_tokens, cached_tokens, cb.completion_tokens
+                )
+                total_tokens = cb.total_tokens
+                record_usage(
+                    "turn",
+                    answered_model,
+                    state,
+                    config["configurable"]["thread_id"],
+                    cb,
+                    total_cost,
+                    latency,
+                )
 
-            print(f"Host Reply: {response.content}")
-            print(
-                f"Tokens: {cb.total_tokens} (In: {cb.prompt_tokens}, Out: {cb.completion_tokens})"
-            )
-            print(f"Cost: ${total_cost:.6f}")
+                logger.info(f"Host Reply [{answered_model}] (verdict={verdict}, branch={branch}): {response.content}")
+                logger.info(
+                    f"Tokens: {cb.total_tokens} (In: {cb.prompt_tokens}, Cached: {cached_tokens}, Out: {cb.completion_tokens})"
+                )
+                logger.info(f"Cost: ${total_cost:.6f}")
+
+        except Exception as e:
+            logger.error(f"LLM Invocation Error: {e}")
+            turns_total.inc(intent, "error")
+            return {
+                "history": [AIMessage(content="🤖 主持人暂时掉线了（LLM调用错误），请重试。")],
+                "turn_count": turn_count,
+                "last_verdict": "",
+                "last_branch": branch,
+            }
+
+        if intent == INTENT_QUESTION:
+            answer_cache.put(puzzle, user_question, reply_text, verdict)
+
+    # 4. 把本轮一问一答追加到近期对话，按剩余预算裁掉最旧的行
+    reply_line = render_transcript_line(response)
+    reply_tokens = count_tokens(selected_model, reply_line)
+    history_budget = max(
+        0, budget - prefix_tokens - summary_tokens - CONTEXT_QUESTION_RESERVE
+    )
+    transcript, transcript_tokens, recent_history_text, _ = append_transcript(
+        transcript,
+        state.get("transcript_tokens", []),
+        [(question_line, question_tokens), (reply_line, reply_tokens)],
+        history_budget,
+    )
+    unsummarized_tokens = (
+        state.get("unsummarized_tokens", 0) + question_tokens + reply_tokens
+    )
+    unsummarized_lines = state.get("unsummarized_lines", 0) + 2
+    solved = is_solved_turn(intent, verdict, response.content) and not state.get("given_up")
+    if solved and state.get("username"):
+        progress_index.mark_solved(state["username"], state["puzzle_id"])
+    record_game_turn(
+        state,
+        config["configurable"]["thread_id"],
+        turn_count + 1,
+        user_question,
+        response.content,
+        intent,
+        answered_model,
+    )
+
+    return {
+        "history": [response],
+        "transcript": transcript,
+        "transcript_tokens": transcript_tokens,
+        "recent_history_text": recent_history_text,
+        "unsummarized_tokens": unsummarized_tokens,
+        "unsummarized_lines": unsummarized_lines,
+        "needs_compaction": window_nearly_full(
+            unsummarized_tokens, unsummarized_lines, history_budget
+        ),
+        "last_prompt_tokens": prompt_tokens,
+        "turn_count": turn_count + 1,
+        "last_cost": total_cost,
+        "last_tokens": total_tokens,
+        "last_cached_tokens": cached_tokens,
+        "last_verdict": verdict or "",
+        "last_branch": branch,
+        "solved": state.get("solved", False) or solved,
+        "last_model": answered_model,
+        "last_question": user_question,
+        "last_reply": response.content,
+    }
+
+
+# --- 4. 构建图 ---
+# 总结不再是图里的节点: 主持人回复返回给玩家之后，由 SummaryQueue 在后台异步完成，
+# 第 10 轮的玩家不必再等第二次 LLM 调用。
+
+workflow = StateGraph(GameState)
+
+workflow.add_node("host", host_node)
+
+workflow.set_entry_point("host")
+
+workflow.add_edge("host", END)
+
+# 游戏状态持久化: 默认写入 SQLite (WAL)，重启 / 部署后对局不丢失，多个 worker 共享
+# CHECKPOINT_BACKEND: sqlite (默认) / redis / memory
+# history 按消息逐条存储，每轮只写入新增的消息，写入量不随对局变长而增长
+CHECKPOINT_APPEND_CHANNELS = ("history",)
+checkpointer = create_checkpointer(
+    os.environ.get("CHECKPOINT_BACKEND", "sqlite"),
+    sqlite_path=os.environ.get("CHECKPOINT_SQLITE_PATH", "./checkpoints.db"),
+    redis_url=os.environ.get("REDIS_URL", "redis://localhost:6379/0"),
+    append_channels=CHECKPOINT_APPEND_CHANNELS,
+)
+
+
+def instrument_checkpointer(saver):
+    """给 checkpoint 读写计时: aget_tuple 计入 state_load，aput 计入 checkpoint_write"""
+    for method_name, stage in (("aget_tuple", "state_load"), ("aput", "checkpoint_write")):
+        original = getattr(saver, method_name)
+
+        async def timed(*args, _original=original, _stage=stage, **kwargs):
+            with turn_stage_seconds.time(_stage, ""):
+                return await _original(*args, **kwargs)
+
+        setattr(saver, method_name, timed)
 
-        new_history = current_history_msgs + [response]
 
+instrument_checkpointer(checkpointer)
+app_graph = workflow.compile(checkpointer=checkpointer)
+
+
+# --- 对局锁 ---
+# 同一个 thread 的对话轮次与后台总结的写回必须串行，否则两次写入基于同一个父 checkpoint，
+# 后写的会覆盖先写的 (双击发送 / 客户端重试时两轮都会读到同一份 history，各自调用一次 LLM)。
+THREAD_LOCK_SHARDS = int(os.environ.get("THREAD_LOCK_SHARDS", "64"))
+
+
+class ThreadLockTable:
+    """按 thread_id 哈希分片的锁表
+
+    每个条目记录 [锁, 持有 + 等待的请求数]，最后一个使用者退出时立即删除，
+    锁表大小只和当前活跃的对局数有关，不依赖 GC 回收。
+    """
+
+    def __init__(self, shards: int):
+        self._shards: list[dict[str, list]] = [{} for _ in range(shards)]
+        self.contended = 0  # 拿锁时需要排队的次数 (同一局的并发请求)
+
+    def _shard(self, thread_id: str) -> dict:
+        return self._shards[hash(thread_id) % len(self._shards)]
+
+    @asynccontextmanager
+    async def hold(self, thread_id: str):
+        shard = self._shard(thread_id)
+        entry = shard.get(thread_id)
+        if entry is None:
+            entry = shard[thread_id] = [asyncio.Lock(), 0]
+        elif entry[0].locked():
+            self.contended += 1
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del shard[thread_id]
+
+    def stats(self):
+        entries = [entry for shard in self._shards for entry in shard.values()]
         return {
-            "history": new_history,
-            "turn_count": turn_count + 1,
-            "last_cost": total_cost,
-            "last_tokens": cb.total_tokens,
+            "active": len(entries),
+            "waiting": sum(refs - 1 for lock, refs in entries if lock.locked()),
+            "largest_shard": max(len(shard) for shard in self._shards),
+            "contended": self.contended,
         }
 
-    except Exception as e:
-        print(f"LLM Invocation Error: {e}")
+
+thread_locks = ThreadLockTable(THREAD_LOCK_SHARDS)
+
+
+# --- 后台总结 ---
+
+
+def should_summarize(state: dict) -> bool:
+    # 由主持人节点按近期对话窗口的 token 预算和行数上限判断 (见 CONTEXT_COMPACT_RATIO)
+    return state.get("needs_compaction", False)
+
+
+async def summarize_thread(thread_id: str) -> bool:
+    """为一局游戏生成新的摘要并写回 state，返回是否写入成功"""
+    config = {"configurable": {"thread_id": thread_id}}
+    state = (await app_graph.aget_state(config)).values
+    history_msgs = state.get("history", [])
+    puzzle = puzzle_catalog.by_id.get(state.get("puzzle_id"))
+    if not history_msgs or puzzle is None:
+        return False
+
+    selected_model = state.get("model", "gpt-3.5-turbo")
+    chain = get_chain(SUMMARY_PROMPT_TEMPLATE, selected_model)
+
+    # transcript 会按预算裁剪，不一定覆盖全部未总结的对话，这里从 history 渲染
+    # (history 只含上次总结之后的消息，且在后台执行，不影响玩家的响应时间)
+    lines = [render_transcript_line(msg) for msg in history_msgs]
+    summarized_tokens = sum(count_tokens(selected_model, line) for line in lines)
+    with get_openai_callback() as cb:
+        started = time.perf_counter()
+        response = await call_with_retries(
+            selected_model,
+            lambda: chain.ainvoke(
+                {
+                    "story": puzzle["question"],
+                    "truth": puzzle["answer"],
+                    "summary": state.get("summary", "暂无信息"),
+                    "recent_history": "".join(f"{line}\n" for line in lines),
+                }
+            ),
+        )
+    cost = compute_cost(selected_model, cb.prompt_tokens, cb.prompt_tokens_cached, cb.completion_tokens)
+    record_usage("summary", selected_model, state, thread_id, cb, cost, time.perf_counter() - started)
+
+    logger.info(f">>> 触发自动总结: {response.content} <<<")
+
+    async with thread_locks.hold(thread_id):
+        # LLM 调用期间玩家可能已经重新开局，或者对局已被淘汰，这时丢弃这次总结
+        current = (await app_graph.aget_state(config)).values
+        current_ids = {msg.id for msg in current.get("history", [])}
+        if any(msg.id not in current_ids for msg in history_msgs):
+            return False
+
+        # 总结后清空已总结的 history 消息，依赖 summary；
+        # 总结期间新产生的消息保留，transcript 是定长环形缓冲，也保留下来以保持对话连贯性
+        await app_graph.aupdate_state(
+            config,
+            {
+                "summary": response.content,
+                "history": [RemoveMessage(id=msg.id) for msg in history_msgs],
+                "unsummarized_tokens": max(
+                    0, current.get("unsummarized_tokens", 0) - summarized_tokens
+                ),
+                "unsummarized_lines": max(
+                    0, current.get("unsummarized_lines", 0) - len(lines)
+                ),
+                "needs_compaction": False,
+            },
+        )
+    return True
+
+
+class SummaryQueue:
+    """按 thread 合并的后台总结队列
+
+    每个 thread 同时最多只有一个总结任务；任务运行期间再次触发时只标记“需要重跑”，
+    无论触发多少次，当前任务结束后都只会基于最新状态再跑一次。
+    下一轮对话直接读取 state 中已经写好的 summary。
+    """
+
+    def __init__(self):
+        self._tasks = {}
+        self._rerun = set()
+        self.completed = 0
+        self.coalesced = 0
+        self.failed = 0
+
+    def schedule(self, thread_id: str):
+        if thread_id in self._tasks:
+            self._rerun.add(thread_id)
+            self.coalesced += 1
+            return
+        self._tasks[thread_id] = asyncio.create_task(self._run(thread_id))
+
+    async def _run(self, thread_id: str):
+        try:
+            while True:
+                self._rerun.discard(thread_id)
+                try:
+                    if await summarize_thread(thread_id):
+                        self.completed += 1
+                except Exception as e:
+                    self.failed += 1
+                    logger.warning(f"⚠️ Summary failed for {thread_id}: {e}")
+                if thread_id not in self._rerun:
+                    break
+        finally:
+            self._tasks.pop(thread_id, None)
+
+    async def close(self):
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stats(self):
         return {
-            "history": current_history_msgs
-            + [AIMessage(content="🤖 主持人暂时掉线了（LLM调用错误），请重试。")],
-            "turn_count": turn_count,
+            "pending": len(self._tasks),
+            "completed": self.completed,
+            "coalesced": self.coalesced,
+            "failed": self.failed,
         }
 
 
-def summarize_node(state: GameState):
-    """总结节点"""
-    summary = state.get("summary", "暂无信息")
-    history_msgs = state["history"]
+summary_queue = SummaryQueue()
+
+
+# --- 会话管理: 闲置淘汰 & 内存上限 ---
+# 玩家 /init 后直接关掉页面的对局永远不会再被访问，定期淘汰闲置超过 SESSION_TTL_SECONDS 的对局:
+#   - sqlite / redis 存储: checkpoint 写入时存储里记下最后写入时间，直接按时间查询闲置对局，
+#     多个 worker / 多台机器看到的是同一份数据，重启后也不会漏掉
+#   - memory 存储: 状态本来就只在本进程里，在进程内记录最后访问时间，
+#     并额外按 SESSION_MEMORY_BUDGET_MB 做 LRU 淘汰
+# 如果设置了 SESSION_SPILL_PATH，被淘汰的对局会先转存到该 SQLite 文件，玩家回来时再加载回来。
+SESSION_TTL_SECONDS = int(os.environ.get("SESSION_TTL_SECONDS", str(6 * 3600)))
+SESSION_MEMORY_BUDGET_MB = float(os.environ.get("SESSION_MEMORY_BUDGET_MB", "256"))
+SESSION_SWEEP_INTERVAL = int(os.environ.get("SESSION_SWEEP_INTERVAL", "60"))
+SESSION_SPILL_PATH = os.environ.get("SESSION_SPILL_PATH", "")
+SESSION_SWEEP_BATCH = 500
+
+
+def approx_state_bytes(values: dict) -> int:
+    """粗略估算一局游戏状态占用的内存 (只统计文本，足够用来做容量规划)"""
+    size = 0
+    for value in values.values():
+        if isinstance(value, str):
+            size += sys.getsizeof(value)
+    for msg in values.get("history", []):
+        size += sys.getsizeof(msg.content)
+    for line in values.get("transcript", []):
+        size += sys.getsizeof(line)
+    return size
+
+
+async def copy_thread_checkpoint(src, dst, thread_id: str, overwrite: bool) -> bool:
+    """把 thread 的最新 checkpoint 从一个 checkpointer 拷贝到另一个
+
+    overwrite 为 False 时，目标里已经有这个 thread (例如别的 worker 已经恢复过并继续玩了) 就保留目标，返回 False。
+    """
+    config = {"configurable": {"thread_id": thread_id, "checkpoint_ns": ""}}
+    saved = await src.aget_tuple(config)
+    if saved is None:
+        return False
+    if overwrite:
+        await dst.adelete_thread(thread_id)
+    parent_id = (saved.parent_config or {}).get("configurable", {}).get("checkpoint_id")
+    if parent_id:
+        config["configurable"]["checkpoint_id"] = parent_id
+    try:
+        await dst.aput(
+            config,
+            saved.checkpoint,
+            saved.metadata,
+            saved.checkpoint["channel_versions"],
+        )
+    except CheckpointConflict:
+        return False
+    return True
+
+
+class SessionManager:
+    def __init__(self, saver, ttl_seconds: int, memory_budget_bytes: int, spill=None):
+        self.saver = saver
+        self.ttl_seconds = ttl_seconds
+        self.memory_budget_bytes = memory_budget_bytes
+        self.spill = spill
+        # 持久化存储自己记录最后写入时间；只有 memory 存储才需要下面的进程内表
+        self.persistent = isinstance(saver, DeltaCheckpointSaver)
+        # thread_id -> [最后访问时间, 估算字节数]，按访问顺序排列 (LRU 在最前)
+        self.sessions: OrderedDict[str, list] = OrderedDict()
+        self.total_bytes = 0
+        self.counters = {"evicted_idle": 0, "evicted_lru": 0, "spilled": 0, "restored": 0}
+
+    async def touch(self, thread_id: str):
+        """访问一个 thread；如果它之前被转存到磁盘，先加载回来"""
+        if not self.persistent:
+            entry = self.sessions.get(thread_id)
+            if entry is not None:
+                entry[0] = time.monotonic()
+                self.sessions.move_to_end(thread_id)
+                return
+
+        if self.spill is not None and await copy_thread_checkpoint(
+            self.spill, self.saver, thread_id, overwrite=False
+        ):
+            await self.spill.adelete_thread(thread_id)
+            self.counters["restored"] += 1
+        if not self.persistent:
+            self.sessions[thread_id] = [time.monotonic(), 0]
+
+    def record(self, thread_id: str, values: dict):
+        """一轮结束后更新该 thread 的访问时间和大小 (持久化存储在写 checkpoint 时已经记下了)"""
+        if self.persistent:
+            return
+        entry = self.sessions.setdefault(thread_id, [0.0, 0])
+        size = approx_state_bytes(values)
+        self.total_bytes += size - entry[1]
+        entry[0], entry[1] = time.monotonic(), size
+        self.sessions.move_to_end(thread_id)
+
+    async def evict(self, thread_id: str, reason: str):
+        _, size = self.sessions.pop(thread_id)
+        self.total_bytes -= size
+        if self.spill is not None and await copy_thread_checkpoint(
+            self.saver, self.spill, thread_id, overwrite=True
+        ):
+            self.counters["spilled"] += 1
+        await self.saver.adelete_thread(thread_id)
+        self.counters[reason] += 1
+
+    async def sweep_persistent(self):
+        """按存储里的最后写入时间分批查出闲置对局并删除"""
+        deadline = time.time() - self.ttl_seconds
+        while True:
+            thread_ids = await self.saver.alist_idle_threads(deadline, SESSION_SWEEP_BATCH)
+            evicted = 0
+            for thread_id in thread_ids:
+                spilled = self.spill is not None and await copy_thread_checkpoint(
+                    self.saver, self.spill, thread_id, overwrite=True
+                )
+                # 查询之后又有写入 (玩家回来了 / 别的 worker 刚处理过) 的对局保留
+                if not await self.saver.adelete_idle_thread(thread_id, deadline):
+                    if spilled:
+                        await self.spill.adelete_thread(thread_id)
+                    continue
+                if spilled:
+                    self.counters["spilled"] += 1
+                self.counters["evicted_idle"] += 1
+                evicted += 1
+            # 整批都没删掉时停下，避免反复查到同一批
+            if len(thread_ids) < SESSION_SWEEP_BATCH or not evicted:
+                return
+
+    async def sweep(self):
+        if self.persistent:
+            await self.sweep_persistent()
+            return
+
+        deadline = time.monotonic() - self.ttl_seconds
+        # OrderedDict 按最后访问排序，从头开始扫到第一个未过期的即可
+        while self.sessions:
+            thread_id, (last_access, _) = next(iter(self.sessions.items()))
+            if last_access > deadline:
+                break
+            await self.evict(thread_id, "evicted_idle")
+
+        while self.sessions and self.total_bytes > self.memory_budget_bytes:
+            await self.evict(next(iter(self.sessions)), "evicted_lru")
+
+    async def run_sweeper(self, interval: int):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.sweep()
+            except Exception as e:
+                logger.warning(f"Session sweep failed: {e}")
+
+    async def stats(self):
+        if self.persistent:
+            # 持久化存储下进程内不跟踪各对局，对局数和占用直接问存储 (所有 worker 共享的数字)
+            live, approx_bytes = await self.saver.astorage_stats()
+        else:
+            live, approx_bytes = len(self.sessions), self.total_bytes
+        return {
+            "store": "persistent" if self.persistent else "memory",
+            "live": live,
+            "approx_bytes": approx_bytes,
+            "memory_budget_bytes": self.memory_budget_bytes,
+            "ttl_seconds": self.ttl_seconds,
+            **self.counters,
+        }
 
-    # 将对话记录转为文本
-    history_text = ""
-    for msg in history_msgs:
-        role = "用户" if isinstance(msg, HumanMessage) else "主持人"
-        history_text += f"{role}: {msg.content}\n"
 
-    prompt = ChatPromptTemplate.from_template(SUMMARY_PROMPT)
-    chain = prompt | llm
+session_manager = SessionManager(
+    checkpointer,
+    ttl_seconds=SESSION_TTL_SECONDS,
+    memory_budget_bytes=int(SESSION_MEMORY_BUDGET_MB * 1024 * 1024),
+    spill=(
+        DeltaCheckpointSaver(
+            SQLiteBackend(SESSION_SPILL_PATH), append_channels=CHECKPOINT_APPEND_CHANNELS
+        )
+        if SESSION_SPILL_PATH
+        else None
+    ),
+)
 
-    response = chain.invoke(
-        {
-            "story": state["story"],
-            "truth": state["truth"],
-            "summary": summary,
-            "recent_history": history_text,
-        }
-    )
+# --- 题库缓存 ---
+# 题库在启动时加载一次，之后由后台任务按 mtime 检查增量刷新 (只重新解析变化过的文件)；
+# 解析结果和搜索索引会写入快照文件，重启时题库没变就直接从快照恢复，不必逐个 json.load、重建索引。
+# 接口响应预先序列化并压缩好，带 ETag，老玩家再次进入大厅直接拿到 304。
+PUZZLES_DIR = os.environ.get("PUZZLES_DIR", os.path.join(os.getcwd(), "puzzles"))
+PUZZLE_SNAPSHOT_PATH = os.environ.get("PUZZLE_SNAPSHOT_PATH", "./puzzle_catalog.snapshot")
+PUZZLE_REFRESH_INTERVAL = int(os.environ.get("PUZZLE_REFRESH_INTERVAL", "10"))
+PUZZLE_SUMMARY_LENGTH = 60  # 列表里只返回汤面的前 60 个字
+PUZZLE_PAGE_CACHE_SIZE = 256
 
-    print(f"\n>>> 触发自动总结: {response.content} <<<\n")
 
-    # 总结后，我们可以选择保留一定数量的 history 或者是清空 history
-    # 既然有了 summary，为了节省 token，我们可以清空之前的 history
-    # 但保留最后 2 条以保持对话连贯性（可选）
+_NON_WORD_RE = re.compile(r"[\W_]+")
 
-    return {
-        "summary": response.content,
-        "history": [],
-    }  # 简单起见，清空历史列表，依赖 summary
 
+def normalize_search_text(text: str) -> str:
+    """搜索用的归一化: 转小写并去掉标点和空白"""
+    return _NON_WORD_RE.sub("", text.lower())
 
-# --- 4. 构建图 ---
 
+def search_tokens(text: str) -> set:
+    """中文按字切分: 单字 + 相邻两字 (bigram)"""
+    tokens = set(text)
+    tokens.update(text[i : i + 2] for i in range(len(text) - 1))
+    return tokens
 
-def should_summarize(state: GameState):
-    # 每 10 轮触发一次总结 (稍微频繁一点，以便summary更新及时)
-    if state["turn_count"] > 0 and state["turn_count"] % 10 == 0:
-        return "summarize"
-    return END
 
+class PrecompressedJSON:
+    """序列化 + 压缩一次，之后按 Accept-Encoding 直接返回对应字节"""
 
-workflow = StateGraph(GameState)
+    def __init__(self, payload):
+        self.raw = json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode()
+        self.etag = f'"{hashlib.sha1(self.raw).hexdigest()}"'
+        self.gzip = gzip.compress(self.raw, compresslevel=6)
+        self.br = brotli.compress(self.raw) if brotli is not None else None
 
-workflow.add_node("host", host_node)
-workflow.add_node("summarizer", summarize_node)
+    def to_response(self, request: Request) -> Response:
+        headers = {
+            "ETag": self.etag,
+            "Vary": "Accept-Encoding",
+            "Cache-Control": "no-cache",  # 允许浏览器缓存，但每次都用 ETag 校验
+        }
+        if self.etag in request.headers.get("if-none-match", ""):
+            return Response(status_code=304, headers=headers)
+
+        accept_encoding = request.headers.get("accept-encoding", "")
+        if self.br is not None and "br" in accept_encoding:
+            body, headers["Content-Encoding"] = self.br, "br"
+        elif "gzip" in accept_encoding:
+            body, headers["Content-Encoding"] = self.gzip, "gzip"
+        else:
+            body = self.raw
+        return Response(content=body, media_type="application/json", headers=headers)
+
+
+class CatalogSnapshot:
+    """题库的一个只读版本: 题目、摘要、搜索索引以及基于它们的搜索 / 分页缓存
+
+    构建完成后不再修改 (缓存只是派生结果)，刷新时整体换成新的对象；
+    请求处理过程中先取一次 puzzle_catalog.current，之后的下标、摘要都来自同一个版本。
+    """
+
+    def __init__(self, puzzles: list[dict], summaries: list[dict], search_texts: list[str], index: dict):
+        self.puzzles = puzzles
+        self.by_id = {p["id"]: p for p in puzzles}
+        self.summaries = summaries
+        # 倒排索引: 单字 / 两字 -> 题目下标 (升序)
+        self.index = index
+        self.search_texts = search_texts
+        self._search_cache: OrderedDict[str, list[int]] = OrderedDict()
+        self._page_cache: OrderedDict[tuple, PrecompressedJSON] = OrderedDict()
+
+    @classmethod
+    def build(cls, puzzles: list[dict]) -> "CatalogSnapshot":
+        summaries, search_texts, index = [], [], {}
+        for idx, p in enumerate(puzzles):
+            question = p["question"]
+            if len(question) > PUZZLE_SUMMARY_LENGTH:
+                question = question[:PUZZLE_SUMMARY_LENGTH] + "..."
+            summaries.append({"id": p["id"], "title": p["title"], "question": question})
+
+            text = normalize_search_text(p["title"] + " " + p["question"])
+            search_texts.append(text)
+            for token in search_tokens(text):
+                index.setdefault(token, []).append(idx)
+        return cls(puzzles, summaries, search_texts, index)
+
+    def search(self, q: str) -> list[int]:
+        """返回标题或汤面中包含 q 的题目下标"""
+        q = normalize_search_text(q)
+        if not q:
+            return range(len(self.summaries))
+
+        hits = self._search_cache.get(q)
+        if hits is not None:
+            self._search_cache.move_to_end(q)
+            return hits
+
+        if len(q) <= 2:
+            # 单字 / 两字查询直接就是倒排表本身
+            hits = self.index.get(q, [])
+        else:
+            # 取最短的 bigram 倒排表作为候选，再用原文确认是否连续出现
+            shortest = min(
+                (self.index.get(q[i : i + 2], []) for i in range(len(q) - 1)),
+                key=len,
+            )
+            texts = self.search_texts
+            hits = [i for i in shortest if q in texts[i]]
+
+        self._search_cache[q] = hits
+        if len(self._search_cache) > PUZZLE_PAGE_CACHE_SIZE:
+            self._search_cache.popitem(last=False)
+        return hits
+
+    def page(self, q: str, offset: int, limit: int) -> PrecompressedJSON:
+        key = (q, offset, limit)
+        cached = self._page_cache.get(key)
+        if cached is not None:
+            self._page_cache.move_to_end(key)
+            return cached
+
+        body = PrecompressedJSON(self._page_payload(self.search(q), offset, limit))
+        self._page_cache[key] = body
+        if len(self._page_cache) > PUZZLE_PAGE_CACHE_SIZE:
+            self._page_cache.popitem(last=False)
+        return body
+
+    def _page_payload(self, hits, offset: int, limit: int) -> dict:
+        summaries = self.summaries
+        return {
+            "total": len(hits),
+            "offset": offset,
+            "limit": limit,
+            # 下一页的 offset，没有更多时为 null
+            "next_offset": offset + limit if offset + limit < len(hits) else None,
+            "items": [summaries[i] for i in hits[offset : offset + limit]],
+        }
 
-workflow.set_entry_point("host")
+    def unplayed(self, q: str, played: set) -> list[int]:
+        """搜索结果里去掉 played 中的题目；因人而异，不进页面缓存"""
+        summaries = self.summaries
+        return [i for i in self.search(q) if summaries[i]["id"] not in played]
+
+    def page_unplayed(self, q: str, offset: int, limit: int, played: set) -> dict:
+        return self._page_payload(self.unplayed(q, played), offset, limit)
+
+
+class PuzzleCatalog:
+    def __init__(self, puzzles_dir: str, snapshot_path: str):
+        self.puzzles_dir = puzzles_dir
+        self.snapshot_path = snapshot_path
+        # 文件名 -> (mtime_ns, size, 题目)；只由 refresh (后台线程) 读写
+        self.files: dict[str, tuple] = {}
+        # 当前版本；刷新线程构建好新版本后只替换这一个引用 (单次赋值是原子的)
+        self.current = CatalogSnapshot([], [], [], {})
+        self._load_snapshot()
+
+    @property
+    def by_id(self) -> dict[str, dict]:
+        return self.current.by_id
+
+    def _load_snapshot(self):
+        try:
+            with open(self.snapshot_path, "rb") as f:
+                snapshot = pickle.load(f)
+            files = snapshot["files"]
+            current = CatalogSnapshot(
+                snapshot["puzzles"], snapshot["summaries"], snapshot["search_texts"], snapshot["index"]
+            )
+        except Exception:
+            # 快照不存在或格式过期: 忽略，首次 refresh 时全量加载
+            return
+        self.files, self.current = files, current
+
+    def _save_snapshot(self):
+        current = self.current
+        snapshot = {
+            "files": self.files,
+            "puzzles": current.puzzles,
+            "summaries": current.summaries,
+            "search_texts": current.search_texts,
+            "index": current.index,
+        }
+        tmp_path = f"{self.snapshot_path}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.snapshot_path)
+
+    @staticmethod
+    def _parse(path: str, filename: str):
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        # 确保包含必要字段
+        if "question" not in data or "answer" not in data:
+            return None
+        puzzle_id = filename[: -len(".json")]
+        return {
+            "id": puzzle_id,
+            "title": data.get("title") or puzzle_id,
+            "question": data["question"],
+            "answer": data["answer"],
+            "note": data.get("note", ""),
+        }
 
-workflow.add_conditional_edges(
-    "host", should_summarize, {"summarize": "summarizer", END: END}
+    def refresh(self) -> bool:
+        """按 mtime / size 增量刷新，返回题库是否有变化 (阻塞 I/O，需在线程中调用)"""
+        if not os.path.isdir(self.puzzles_dir):
+            logger.warning(f"Directory not found: {self.puzzles_dir}")
+            return False
+
+        changed = False
+        seen = set()
+        with os.scandir(self.puzzles_dir) as it:
+            for entry in it:
+                if not entry.name.endswith(".json") or not entry.is_file():
+                    continue
+                seen.add(entry.name)
+                stat = entry.stat()
+                cached = self.files.get(entry.name)
+                if cached and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+                    continue
+                try:
+                    puzzle = self._parse(entry.path, entry.name)
+                except Exception as e:
+                    logger.warning(f"Error reading {entry.name}: {e}")
+                    puzzle = None
+                self.files[entry.name] = (stat.st_mtime_ns, stat.st_size, puzzle)
+                changed = True
+
+        for name in list(self.files):
+            if name not in seen:
+                del self.files[name]
+                changed = True
+
+        if changed:
+            self._rebuild()
+            self._save_snapshot()
+        return changed
+
+    def _rebuild(self):
+        puzzles = [entry[2] for _, entry in sorted(self.files.items()) if entry[2]]
+        self.current = CatalogSnapshot.build(puzzles)
+        logger.info(f"Puzzle catalog loaded: {len(puzzles)} puzzles")
+
+    def page(self, q: str, offset: int, limit: int) -> PrecompressedJSON:
+        return self.current.page(q, offset, limit)
+
+    def page_unplayed(self, q: str, offset: int, limit: int, played: set) -> dict:
+        return self.current.page_unplayed(q, offset, limit, played)
+
+    async def run_watcher(self, interval: int):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await asyncio.to_thread(self.refresh)
+            except Exception as e:
+                logger.warning(f"Puzzle refresh failed: {e}")
+
+
+puzzle_catalog = PuzzleCatalog(PUZZLES_DIR, PUZZLE_SNAPSHOT_PATH)
+
+
+# --- 答案缓存 ---
+# 同一道题被反复游玩时，玩家问的是非题高度重复 (“他是自杀吗？”)。
+# 这里按 (题目, 归一化后的问题) 缓存主持人的是/否裁决，命中时直接返回，不再调用模型。
+# 只缓存普通是非题，提示请求、“真相：”猜测和一次问多个问题的输入一律绕过。
+# 缓存跨玩家共享，依赖上文的追问 (“那他呢？”“他也是吗？”) 和太短的问题也绕过，
+# 这类问题离开原来的对局就不是同一个问题了。
+# ANSWER_CACHE_SIMILARITY > 0 时，精确匹配失败后再按字 n-gram 的 Jaccard 相似度找近似问题；
+# 注意“他是自杀吗”和“他不是自杀吗”的相似度也很高，阈值不宜设得太低。
+ANSWER_CACHE_SIZE = int(os.environ.get("ANSWER_CACHE_SIZE", "20000"))
+ANSWER_CACHE_SIMILARITY = float(os.environ.get("ANSWER_CACHE_SIMILARITY", "0"))
+ANSWER_CACHE_MAX_QUESTION_LENGTH = 50
+ANSWER_CACHE_MIN_QUESTION_LENGTH = 3  # 归一化之后的字数
+
+# 只去掉句末语气词；句首的“那 / 那么 / 请问”和句末的“呢”是追问的标志，保留下来交给下面的规则判断
+_QUESTION_FILLER_RE = re.compile(r"[吗吧啊呀]+$")
+# 依赖上文的追问: 承接词 / 指示词开头、“呢”结尾、“也是 / 还是”
+_ANAPHORIC_QUESTION_RE = re.compile(
+    r"^(那|请问那|还有|另外|然后|所以|也|又|同样|这|刚才|前面|上面|之前)|呢$|[也还]是"
 )
-workflow.add_edge("summarizer", END)
+# 能缓存的回复必须以是非裁决开头，避免把解释性 / 出错的回复缓存下来
+_CACHEABLE_REPLY_RE = re.compile(r"^(是又不是|不是|是|无关|与此无关)")
+
+
+def normalize_question(text: str) -> str:
+    return _QUESTION_FILLER_RE.sub("", normalize_search_text(text))
+
+
+class CachedAnswer(NamedTuple):
+    reply: str
+    verdict: Optional[str]  # 命中时和模型实际作答一样带回 verdict
+
+
+def is_cacheable_question(text: str) -> bool:
+    """只有单个的、不依赖上文的普通是非题才走缓存 (用内置规则判断，不受自定义分类器影响)"""
+    text = text.strip()
+    if not text or len(text) > ANSWER_CACHE_MAX_QUESTION_LENGTH:
+        return False
+    if rule_based_intent(text) != INTENT_QUESTION:
+        return False
+    if _ANAPHORIC_QUESTION_RE.search(normalize_search_text(text)):
+        return False
+    return len(normalize_question(text)) >= ANSWER_CACHE_MIN_QUESTION_LENGTH
+
+
+class AnswerCache:
+    def __init__(self, capacity: int, similarity: float = 0.0):
+        self.capacity = capacity
+        self.similarity = similarity
+        # key: (puzzle_id, 汤底 hash, 归一化问题)；汤底被修改后旧答案自然失效
+        self._entries: OrderedDict[tuple, CachedAnswer] = OrderedDict()
+        # 近似匹配用的倒排索引: (puzzle_id, 汤底 hash) -> n-gram -> keys
+        self._index: dict[tuple, dict[str, set]] = {}
+        self.hits = 0
+        self.similar_hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _scope(puzzle: dict) -> tuple:
+        return (puzzle["id"], hash(puzzle["answer"]))
+
+    def _lookup_key(self, puzzle: dict, question: str):
+        if not is_cacheable_question(question):
+            return None
+        normalized = normalize_question(question)
+        if not normalized:
+            return None
+        return self._scope(puzzle) + (normalized,)
+
+    def get(self, puzzle: dict, question: str) -> Optional[CachedAnswer]:
+        key = self._lookup_key(puzzle, question)
+        if key is None:
+            self.bypassed += 1
+            return None
+        answer = self._entries.get(key)
+        if answer is None and self.similarity > 0:
+            similar_key = self._find_similar(key)
+            if similar_key is not None:
+                answer = self._entries[similar_key]
+                key = similar_key
+                self.similar_hits += 1
+        if answer is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return answer
+
+    def put(
+        self,
+        puzzle: dict,
+        question: str,
+        reply: str,
+        verdict: Optional[str] = None,
+    ):
+        reply = reply.strip()
+        key = self._lookup_key(puzzle, question)
+        if key is None or not _CACHEABLE_REPLY_RE.match(reply) or len(reply) > 60:
+            return
+        if key not in self._entries:
+            postings = self._index.setdefault(key[:2], {})
+            for token in search_tokens(key[2]):
+                postings.setdefault(token, set()).add(key)
+        self._entries[key] = CachedAnswer(reply, verdict)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.capacity:
+            self._remove(self._entries.popitem(last=False)[0])
+            self.evictions += 1
+
+    def _remove(self, key: tuple):
+        postings = self._index.get(key[:2])
+        if postings is None:
+            return
+        for token in search_tokens(key[2]):
+            keys = postings.get(token)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del postings[token]
+        if not postings:
+            del self._index[key[:2]]
+
+    def _find_similar(self, key: tuple):
+        postings = self._index.get(key[:2])
+        if not postings:
+            return None
+        tokens = search_tokens(key[2])
+        overlap: dict[tuple, int] = {}
+        for token in tokens:
+            for candidate in postings.get(token, ()):
+                overlap[candidate] = overlap.get(candidate, 0) + 1
+        best_key, best_score = None, self.similarity
+        for candidate, shared in overlap.items():
+            score = shared / (len(tokens) + len(search_tokens(candidate[2])) - shared)
+            if score >= best_score:
+                best_key, best_score = candidate, score
+        return best_key
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "similar_hits": self.similar_hits,
+            "misses": self.misses,
+            "bypassed": self.bypassed,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+answer_cache = AnswerCache(ANSWER_CACHE_SIZE, ANSWER_CACHE_SIMILARITY)
 
-memory = MemorySaver()
-app_graph = workflow.compile(checkpointer=memory)
 
 # --- 5. API 接口 ---
 
 
 @app.post("/register", status_code=201)
-def register(user: UserCreate, db: Session = Depends(get_db)):
+async def register(user: UserCreate, db: AsyncSession = Depends(get_db)):
     # A. 校验用户是否存在
-    db_user = db.query(User).filter(User.username == user.username).first()
+    db_user = await db.scalar(select(User).where(User.username == user.username))
     if db_user:
         raise HTTPException(status_code=400, detail="Username already registered")
 
     # B. 校验注册码
-    db_code = db.query(InviteCode).filter(InviteCode.code == user.invite_code).first()
+    db_code = await db.scalar(select(InviteCode).where(InviteCode.code == user.invite_code))
 
     if not db_code:
         raise HTTPException(status_code=400, detail="Invalid registration code")
@@ -485,26 +2771,45 @@ def register(user: UserCreate, db: Session = Depends(get_db)):
         raise HTTPException(
             status_code=400, detail="Registration code has already been used"
         )
+    # 先结束只读事务，哈希期间不占用连接
+    await db.rollback()
+
+    # C. 创建用户 (哈希在线程池里算)
+    hashed_password = await get_password_hash_async(user.password)
+
+    # D. 标记注册码为已使用 (如果你希望注册码只能用一次)
+    # 条件更新: 两个人同时用同一个注册码时只有一个能成功
+    # 如果希望注册码无限次使用，去掉下面这段:
+    claimed = await db.execute(
+        update(InviteCode)
+        .where(InviteCode.code == user.invite_code, InviteCode.is_used == False)  # noqa: E712
+        .values(is_used=True)
+    )
+    if claimed.rowcount == 0:
+        await db.rollback()
+        raise HTTPException(
+            status_code=400, detail="Registration code has already been used"
+        )
 
-    # C. 标记注册码为已使用 (如果你希望注册码只能用一次)
-    # 如果希望注册码无限次使用，注释掉下面这行:
-    db_code.is_used = True
-
-    # D. 创建用户
-    hashed_password = get_password_hash(user.password)
-    new_user = User(username=user.username, hashed_password=hashed_password)
-    db.add(new_user)
-    db.commit()
-    db.refresh(new_user)
+    db.add(User(username=user.username, hashed_password=hashed_password))
+    try:
+        await db.commit()
+    except IntegrityError:
+        # 校验之后被别人抢先注册了同名用户，注册码的占用随事务一起回滚
+        await db.rollback()
+        raise HTTPException(status_code=400, detail="Username already registered")
     return {"message": "User created successfully"}
 
 
 @app.post("/token", response_model=Token)
 async def login_for_access_token(
-    form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)
+    form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_db)
 ):
-    user = db.query(User).filter(User.username == form_data.username).first()
-    if not user or not verify_password(form_data.password, user.hashed_password):
+    user = await db.scalar(select(User).where(User.username == form_data.username))
+    username, hashed_password = (user.username, user.hashed_password) if user else (None, None)
+    # 等待哈希线程池之前先把连接还给连接池，一波并发登录不会把连接池占满
+    await db.close()
+    if not user or not await verify_password_async(form_data.password, hashed_password):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password",
@@ -512,117 +2817,783 @@ async def login_for_access_token(
         )
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_access_token(
-        data={"sub": user.username}, expires_delta=access_token_expires
+        data={"sub": username}, expires_delta=access_token_expires
     )
     return {"access_token": access_token, "token_type": "bearer"}
 
 
 @app.get("/users/me")
 async def read_users_me(
-    token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)
+    token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_db)
 ):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
-            raise credentials_exception
-    except JWTError:
-        raise credentials_exception
-    user = db.query(User).filter(User.username == username).first()
-    if user is None:
+    cached = token_cache.get(token)
+    if cached is not None:
+        return cached
+    current_user = await resolve_token_user(token, db)
+    if current_user is None:
         raise credentials_exception
-    return {"username": user.username, "id": user.id}
+    return current_user
+
+
+# --- 限流 & 准入控制 ---
+# 令牌桶，格式 "每分钟次数/突发容量"，留空表示不限:
+#   RATE_LIMIT_USER: 每个登录用户；RATE_LIMIT_IP: 每个 IP (未登录时只看这个)
+#   RATE_LIMIT_MODEL: 每个模型的全局上限，MODEL_RATE_LIMITS 按模型覆盖，例如 "gpt-4o=60/20"
+# RATE_LIMIT_BACKEND=redis 时多个 worker 共享同一份配额
+RATE_LIMIT_USER = parse_rate_limit(os.environ.get("RATE_LIMIT_USER", "30/10"))
+RATE_LIMIT_IP = parse_rate_limit(os.environ.get("RATE_LIMIT_IP", "60/20"))
+RATE_LIMIT_MODEL = parse_rate_limit(os.environ.get("RATE_LIMIT_MODEL", ""))
+MODEL_RATE_LIMITS = parse_model_map(os.environ.get("MODEL_RATE_LIMITS", ""), cast=parse_rate_limit)
+# 反向代理后面部署时，用 X-Forwarded-For 的第一个地址作为客户端 IP
+RATE_LIMIT_TRUST_FORWARDED = os.environ.get("RATE_LIMIT_TRUST_FORWARDED", "0") == "1"
+
+# 准入队列: 同时处理的对话轮数上限、排队上限、最长排队时间 (秒)
+CHAT_MAX_INFLIGHT = int(os.environ.get("CHAT_MAX_INFLIGHT", "256"))
+CHAT_MAX_QUEUE = int(os.environ.get("CHAT_MAX_QUEUE", "512"))
+CHAT_QUEUE_TIMEOUT = float(os.environ.get("CHAT_QUEUE_TIMEOUT", "10"))
+
+rate_limiter = create_rate_limiter(
+    os.environ.get("RATE_LIMIT_BACKEND", "memory"),
+    redis_url=os.environ.get("REDIS_URL", "redis://localhost:6379/0"),
+)
+chat_admission = AdmissionQueue(CHAT_MAX_INFLIGHT, CHAT_MAX_QUEUE, CHAT_QUEUE_TIMEOUT)
+rate_limit_rejections = 0
+
+# 按模型限流需要知道对局用的模型: /init 时记下 (LRU)，不必每个请求都反序列化整局状态
+THREAD_MODEL_CACHE_SIZE = 100_000
+_thread_models: OrderedDict[str, str] = OrderedDict()
+
+
+def get_client_ip(request: Request) -> str:
+    if RATE_LIMIT_TRUST_FORWARDED:
+        forwarded = request.headers.get("x-forwarded-for")
+        if forwarded:
+            return forwarded.split(",")[0].strip()
+    return request.client.host if request.client else "unknown"
+
+
+async def enforce_rate_limits(request: Request, username: Optional[str], model: Optional[str] = None):
+    """检查用户 / IP / 模型三个令牌桶，任一用完则返回 429 (带 Retry-After)"""
+    global rate_limit_rejections
+    rules = []
+    if username and RATE_LIMIT_USER:
+        rules.append((f"user:{username}", RATE_LIMIT_USER))
+    if RATE_LIMIT_IP:
+        rules.append((f"ip:{get_client_ip(request)}", RATE_LIMIT_IP))
+    model_limit = MODEL_RATE_LIMITS.get(model, RATE_LIMIT_MODEL) if model else None
+    if model_limit:
+        rules.append((f"model:{model}", model_limit))
+    if not rules:
+        return
+
+    retry_after = await rate_limiter.acquire(rules)
+    if retry_after > 0:
+        rate_limit_rejections += 1
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="请求太频繁，请稍后再试",
+            headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+        )
+
+
+async def admit_chat():
+    """进入准入队列；排队已满或等待超时返回 503，让客户端稍后重试而不是继续往上游堆请求"""
+    ticket = await chat_admission.acquire()
+    if ticket is None:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="服务器繁忙，请稍后再试",
+            headers={"Retry-After": str(max(1, math.ceil(CHAT_QUEUE_TIMEOUT)))},
+        )
+    return ticket
+
+
+def remember_thread_model(thread_id: str, model: str):
+    _thread_models[thread_id] = model
+    _thread_models.move_to_end(thread_id)
+    while len(_thread_models) > THREAD_MODEL_CACHE_SIZE:
+        _thread_models.popitem(last=False)
+
+
+async def get_thread_model(thread_id: str) -> Optional[str]:
+    """只有配置了按模型限流时才查；缓存未命中 (重启后 / 其他 worker 开的局) 才读一次对局状态"""
+    if not (RATE_LIMIT_MODEL or MODEL_RATE_LIMITS):
+        return None
+    model = _thread_models.get(thread_id)
+    if model is None:
+        config = {"configurable": {"thread_id": thread_id}}
+        model = (await app_graph.aget_state(config)).values.get("model")
+        if model:
+            remember_thread_model(thread_id, model)
+    else:
+        _thread_models.move_to_end(thread_id)
+    return model
 
 
 @app.post("/init")
-async def init_game(req: InitRequest):
+async def init_game(
+    req: InitRequest,
+    request: Request,
+    username: Optional[str] = Depends(get_optional_username),
+):
     config = {"configurable": {"thread_id": req.thread_id}}
 
+    await enforce_rate_limits(request, username)
+    get_puzzle_or_404(req.puzzle_id)
+
     # 校验模型是否存在，不存在则回退
     model_to_use = req.model if req.model in MODEL_PRICING else "gpt-3.5-turbo"
 
     initial_state = {
-        "story": req.story,
-        "truth": req.truth,
-        "history": [],
+        "puzzle_id": req.puzzle_id,
+        # 同一个 thread_id 重新开局时清掉旧的消息 (history 走 add_messages 追加)
+        "history": [RemoveMessage(id=REMOVE_ALL_MESSAGES)],
+        "transcript": [],
+        "transcript_tokens": [],
+        "recent_history_text": "",
+        "unsummarized_tokens": 0,
+        "unsummarized_lines": 0,
+        "needs_compaction": False,
         "summary": "游戏开始。",
         "turn_count": 0,
         "model": model_to_use,  # 保存模型选择
+        "username": username or "",
         "last_cost": 0.0,
         "last_tokens": 0,
+        "last_cached_tokens": 0,
+        "last_prompt_tokens": 0,
+        "last_verdict": "",
+        "last_branch": None,
+        "solved": False,
+        "given_up": False,
+        "last_question": "",
+        "last_reply": "",
     }
-    print(f"New Game Initialized with Model: {model_to_use}")
-    app_graph.update_state(config, initial_state)
+    logger.info(f"New Game Initialized with Model: {model_to_use}")
+    await app_graph.aupdate_state(config, initial_state)
+    session_manager.record(req.thread_id, initial_state)
+    remember_thread_model(req.thread_id, model_to_use)
+    if username:
+        progress_index.mark_played(username, req.puzzle_id)
     return {"status": "ok", "message": "Game initialized", "model": model_to_use}
 
 
-@app.post("/chat")
-async def chat(req: ChatRequest):
-    config = {"configurable": {"thread_id": req.thread_id}}
-
-    current_state_dict = app_graph.get_state(config).values
-    current_history = current_state_dict.get("history", [])
-
-    new_message = HumanMessage(content=req.message)
-    inputs = {"history": current_history + [new_message]}
+def host_reply(update: dict, streamed: List[str]) -> str:
+    """host 节点这一步的主持人回复: 写进 history 的 AIMessage；
+    本地直接回复的轮次 (空输入 / 重复提问) 不写 history，用流里推送过的文字"""
+    msgs = (update or {}).get("history") or []
+    if msgs and isinstance(msgs[-1], AIMessage):
+        return msgs[-1].content
+    return "".join(streamed)
 
-    ai_reply = ""
-
-    # 执行图
-    async for event in app_graph.astream(inputs, config=config):
-        if "host" in event:
-            msgs = event["host"]["history"]
-            if msgs:
-                ai_reply = msgs[-1].content
-
-    # 获取最新状态 (包含了 host_node 计算的 cost)
-    final_state = app_graph.get_state(config).values
 
+def build_chat_response(ai_reply: str, final_state: dict):
+    """/chat 与 /chat/stream 共用的返回体"""
     return {
         "reply": ai_reply,
         "summary": final_state.get("summary", ""),
         "turn_count": final_state.get("turn_count", 0),
+        # 主持人的结构化判定: verdict 为空表示本轮没有判定 (本地回复 / 缓存 / 模型没按 JSON 输出)
+        "verdict": final_state.get("last_verdict") or None,
+        "branch": final_state.get("last_branch"),
+        "solved": final_state.get("solved", False),
         # 返回费用信息
         "cost_data": {
             "tokens": final_state.get("last_tokens", 0),
+            "cached_tokens": final_state.get("last_cached_tokens", 0),
+            "prompt_tokens": final_state.get("last_prompt_tokens", 0),
             "cost": final_state.get("last_cost", 0.0),
-            "model": final_state.get("model", "unknown"),
+            "model": final_state.get("last_model") or final_state.get("model", "unknown"),
         },
     }
 
 
-@app.get("/puzzles")
-async def get_puzzles():
-    """获取所有题目列表"""
-    puzzles = []
-    puzzles_dir = os.path.join(os.getcwd(), "puzzles")
-    print(f"Searching for puzzles in: {puzzles_dir}")
+async def build_chat_inputs(req: ChatRequest):
+    config = {"configurable": {"thread_id": req.thread_id}}
+
+    await session_manager.touch(req.thread_id)
+
+    # history 的 reducer 负责追加，这里只传本轮的新消息；
+    # 消息 id 预先生成，本轮被取消时靠它从检查点里撤回这条提问
+    inputs = {"history": [HumanMessage(content=req.message, id=str(uuid.uuid4()))]}
+    return config, inputs
+
+
+# --- 幂等键 ---
+# 客户端每次发送带一个 Idempotency-Key，重试 / 双击产生的重复请求直接返回第一次的结果，
+# 不会再调用一次上游模型。键按 thread 隔离，只缓存成功完成的轮次。
+IDEMPOTENCY_TTL_SECONDS = int(os.environ.get("IDEMPOTENCY_TTL_SECONDS", "600"))
+IDEMPOTENCY_MAX_KEYS = int(os.environ.get("IDEMPOTENCY_MAX_KEYS", "10000"))
+
+
+class IdempotencyCache:
+    """(thread_id, 幂等键) -> 响应，LRU + TTL"""
+
+    def __init__(self, max_keys: int, ttl: float):
+        self.max_keys = max_keys
+        self.ttl = ttl
+        self._entries: OrderedDict[tuple, tuple[float, str, dict]] = OrderedDict()
+        self.replays = 0
+
+    def get(self, thread_id: str, key: str, message: str) -> Optional[dict]:
+        entry = self._entries.get((thread_id, key))
+        if entry is None:
+            return None
+        expires, stored_message, response = entry
+        if expires < time.monotonic():
+            del self._entries[(thread_id, key)]
+            return None
+        if stored_message != message:
+            # 同一个键配了不同的问题，多半是客户端 bug，不能把别的回答当成这次的结果
+            raise HTTPException(
+                status_code=422,
+                detail="Idempotency-Key 已用于另一条消息",
+            )
+        self.replays += 1
+        return response
+
+    def put(self, thread_id: str, key: str, message: str, response: dict):
+        self._entries[(thread_id, key)] = (time.monotonic() + self.ttl, message, response)
+        self._entries.move_to_end((thread_id, key))
+        while len(self._entries) > self.max_keys:
+            self._entries.popitem(last=False)
+
+    def stats(self):
+        return {"keys": len(self._entries), "replays": self.replays}
+
+
+idempotency_cache = IdempotencyCache(IDEMPOTENCY_MAX_KEYS, IDEMPOTENCY_TTL_SECONDS)
+
+
+def lookup_idempotent(req: ChatRequest, key: Optional[str]) -> Optional[dict]:
+    return idempotency_cache.get(req.thread_id, key, req.message) if key else None
+
+
+def remember_idempotent(req: ChatRequest, key: Optional[str], response: dict):
+    if key:
+        idempotency_cache.put(req.thread_id, key, req.message, response)
+
+
+def finish_chat_turn(thread_id: str, final_state: dict):
+    """一轮对话结束后的收尾: 记录会话访问，必要时排队后台总结"""
+    session_manager.record(thread_id, final_state)
+    if should_summarize(final_state):
+        summary_queue.schedule(thread_id)
+
+
+# 非流式 /chat 检查客户端是否断开的间隔 (秒)
+DISCONNECT_POLL_INTERVAL = float(os.environ.get("DISCONNECT_POLL_INTERVAL", "0.5"))
+
+
+async def cancel_on_disconnect(request: Request, coro):
+    """执行 coro，期间客户端断开则取消它 (连带取消进行中的 LLM 调用) 并返回 None"""
+    task = asyncio.ensure_future(coro)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=DISCONNECT_POLL_INTERVAL)
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                logger.info("🔌 Client disconnected, cancelling graph run")
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+                return None
+    finally:
+        if not task.done():
+            task.cancel()
+
+
+async def iterate_in_task(aiterator, on_cancel: Optional[Callable[[asyncio.Task], None]] = None):
+    """在独立任务里消费异步迭代器，逐个转交给调用方；调用方提前退出 (例如被取消) 时取消该任务
+
+    StreamingResponse 在客户端断开时取消的是响应任务，LangGraph 在这种情况下不一定会取消
+    正在运行的节点；把图放到自己的任务里，就能在 finally 中明确地取消它。
+    取消后调用 on_cancel(该任务)，调用方可以在后台等它真正结束再收尾。
+    """
+    queue: asyncio.Queue = asyncio.Queue()
+    done = object()
+
+    async def pump():
+        try:
+            async for item in aiterator:
+                queue.put_nowait(item)
+        finally:
+            queue.put_nowait(done)
+
+    task = asyncio.create_task(pump())
+    try:
+        while (item := await queue.get()) is not done:
+            yield item
+        await task  # 把图里抛出的异常传给调用方
+    finally:
+        if not task.done():
+            logger.info("🔌 Client disconnected, cancelling graph run")
+            task.cancel()
+            if on_cancel is not None:
+                on_cancel(task)
+
+
+# 进行中的撤回任务，保留引用以免被 GC 回收
+_rollback_tasks: set[asyncio.Task] = set()
+
+
+def rollback_cancelled_turn(config: dict, inputs: dict, graph_task: Optional[asyncio.Task] = None):
+    """本轮被取消时撤回已写进检查点、却没有得到回复的玩家消息
+
+    图在开始执行节点之前就把输入写进了检查点，中途取消会在历史里留下一条孤立的提问，
+    下一轮的上下文和 /history 都会带上它。撤回放在后台任务里做: 被取消的请求里
+    再 await 并不可靠 (StreamingResponse 的取消会反复投递)。
+    """
+    thread_id = config["configurable"]["thread_id"]
+    message_id = inputs["history"][-1].id
+
+    async def run():
+        if graph_task is not None:
+            await asyncio.wait({graph_task})
+        async with thread_locks.hold(thread_id):
+            history = (await app_graph.aget_state(config)).values.get("history", [])
+            for index, msg in enumerate(history):
+                if msg.id != message_id:
+                    continue
+                # 主持人已经回复过 (取消发生在图跑完之后) 就保留
+                if index + 1 < len(history) and isinstance(history[index + 1], AIMessage):
+                    return
+                await app_graph.aupdate_state(
+                    config, {"history": [RemoveMessage(id=message_id)]}, as_node="host"
+                )
+                logger.info(f"↩️ Rolled back unanswered message in {thread_id}")
+                return
+
+    task = asyncio.create_task(run())
+    _rollback_tasks.add(task)
+    task.add_done_callback(_rollback_tasks.discard)
 
-    if not os.path.exists(puzzles_dir):
-        print(f"Directory not found: {puzzles_dir}")
-        return []
 
-    import json
+REPLAYED_HEADERS = {"Idempotent-Replayed": "true"}
 
-    for filename in os.listdir(puzzles_dir):
-        if filename.endswith(".json"):
+
+@app.post("/chat")
+async def chat(
+    req: ChatRequest,
+    request: Request,
+    username: Optional[str] = Depends(get_optional_username),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
+):
+    # 重复请求不占限流配额，也不排队
+    cached = lookup_idempotent(req, idempotency_key)
+    if cached is not None:
+        return JSONResponse(cached, headers=REPLAYED_HEADERS)
+
+    await enforce_rate_limits(request, username, await get_thread_model(req.thread_id))
+
+    async def run_turn():
+        async with thread_locks.hold(req.thread_id):
+            # 重复请求可能一直在等第一次请求释放锁，拿到锁后再查一次
+            cached = lookup_idempotent(req, idempotency_key)
+            if cached is not None:
+                return cached, True
+
+            config, inputs = await build_chat_inputs(req)
+
+            ai_reply = ""
+            streamed: List[str] = []
+
+            # 执行图
             try:
-                with open(
-                    os.path.join(puzzles_dir, filename), "r", encoding="utf-8"
-                ) as f:
-                    data = json.load(f)
-                    # 确保包含必要字段
-                    if "title" in data and "question" in data:
-                        puzzles.append(data)
-            except Exception as e:
-                print(f"Error reading {filename}: {e}")
+                async for mode, event in app_graph.astream(
+                    inputs, config=config, stream_mode=["custom", "updates"]
+                ):
+                    if mode == "custom":
+                        streamed.append(event.get("content", ""))
+                    elif "host" in event:
+                        ai_reply = host_reply(event["host"], streamed)
+            except asyncio.CancelledError:
+                rollback_cancelled_turn(config, inputs)
+                raise
+
+            # 获取最新状态 (包含了 host_node 计算的 cost)
+            final_state = (await app_graph.aget_state(config)).values
+            response = build_chat_response(ai_reply, final_state)
+            remember_idempotent(req, idempotency_key, response)
+        finish_chat_turn(req.thread_id, final_state)
+        return response, False
+
+    ticket = await admit_chat()
+    try:
+        result = await cancel_on_disconnect(request, run_turn())
+    finally:
+        ticket.release()
+    if result is None:
+        # 客户端已经走了，响应不会被读取 (499: Client Closed Request)
+        return Response(status_code=499)
+    response, replayed = result
+    with turn_stage_seconds.time("serialize", ""):
+        return JSONResponse(response, headers=REPLAYED_HEADERS if replayed else None)
+
+
+def replay_stream(response: dict):
+    """重复的流式请求: 不再推送 token，直接给出第一次请求的 final 行"""
+
+    async def event_stream():
+        yield json.dumps({"type": "final", **response}, ensure_ascii=False) + "\n"
+
+    return StreamingResponse(
+        event_stream(), media_type="application/x-ndjson", headers=REPLAYED_HEADERS
+    )
+
+
+@app.post("/chat/stream")
+async def chat_stream(
+    req: ChatRequest,
+    request: Request,
+    username: Optional[str] = Depends(get_optional_username),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
+):
+    """流式版 /chat：按 NDJSON 逐行推送主持人回复的 token，最后一行是与 /chat 相同的完整结果
+
+    每行格式:
+      {"type": "token", "content": "..."}
+      {"type": "final", "reply": ..., "summary": ..., "turn_count": ..., "cost_data": {...}}
+    """
+
+    cached = lookup_idempotent(req, idempotency_key)
+    if cached is not None:
+        return replay_stream(cached)
+
+    await enforce_rate_limits(request, username, await get_thread_model(req.thread_id))
+    # 在返回响应之前拿到名额，这样排队满了还能返回 503 而不是一个已经开始的流
+    ticket = await admit_chat()
+
+    # 客户端断开时 StreamingResponse 会取消这个生成器，iterate_in_task 随之取消进行中的图和 LLM 调用
+    async def event_stream():
+        ai_reply = ""
+        streamed: List[str] = []
+        try:
+            async with thread_locks.hold(req.thread_id):
+                cached = lookup_idempotent(req, idempotency_key)
+                if cached is not None:
+                    yield json.dumps({"type": "final", **cached}, ensure_ascii=False) + "\n"
+                    return
+
+                config, inputs = await build_chat_inputs(req)
+                async for mode, event in iterate_in_task(
+                    app_graph.astream(inputs, config=config, stream_mode=["custom", "updates"]),
+                    on_cancel=lambda task: rollback_cancelled_turn(config, inputs, task),
+                ):
+                    if mode == "custom":
+                        streamed.append(event.get("content", ""))
+                        yield json.dumps(event, ensure_ascii=False) + "\n"
+                    elif "host" in event:
+                        ai_reply = host_reply(event["host"], streamed)
+
+                final_state = (await app_graph.aget_state(config)).values
+                response = build_chat_response(ai_reply, final_state)
+                remember_idempotent(req, idempotency_key, response)
+        finally:
+            ticket.release()
+        finish_chat_turn(req.thread_id, final_state)
+        with turn_stage_seconds.time("serialize", ""):
+            line = json.dumps({"type": "final", **response}, ensure_ascii=False) + "\n"
+        yield line
+
+    # X-Accel-Buffering: 防止 Nginx 反向代理把流式响应攒成一整块再发
+    return StreamingResponse(
+        event_stream(),
+        media_type="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        # 生成器从未开始迭代 (例如客户端在首字节前就断开) 时也要归还名额；release 可重复调用
+        background=BackgroundTask(ticket.release),
+    )
+
+
+@app.get("/stats")
+async def get_stats():
+    """运行时统计，用于观察客户端池等资源的使用情况"""
+    return {
+        "llm_pool": get_llm_pool_stats(),
+        "sessions": await session_manager.stats(),
+        "summaries": summary_queue.stats(),
+        "router": model_router.stats(),
+        "answer_cache": answer_cache.stats(),
+        "rate_limit": {**rate_limiter.stats(), "rejected": rate_limit_rejections},
+        "admission": chat_admission.stats(),
+        "thread_locks": thread_locks.stats(),
+        "idempotency": idempotency_cache.stats(),
+        "usage_writer": usage_writer.stats(),
+        "game_turn_writer": game_turn_writer.stats(),
+        "progress": {**progress_index.stats(), "writer": progress_writer.stats()},
+        "token_cache": token_cache.stats(),
+    }
+
+
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus 抓取接口"""
+    return PlainTextResponse(
+        metrics_registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
 
-    return puzzles
+# --- 对局历史接口 ---
+# 都按 id 做游标分页 (WHERE id < / > cursor LIMIT n)，不用 OFFSET，翻到多深都只读一页的数据:
+# 对局列表分页 game_summaries 的 (username, last_id) 索引，单局回放走 game_turns 的 (username, thread_id, id) 索引
+HISTORY_PAGE_SIZE = 50
+HISTORY_EXPORT_BATCH = 200
+
+
+def serialize_turn(turn: GameTurn) -> dict:
+    return {
+        "id": turn.id,
+        "turn": turn.turn,
+        "question": turn.question,
+        "reply": turn.reply,
+        "intent": turn.intent,
+        "model": turn.model,
+        "created_at": turn.created_at.isoformat() if turn.created_at else None,
+    }
+
+
+@app.get("/history")
+async def list_games(
+    cursor: Optional[int] = Query(None, description="上一页返回的 next_cursor"),
+    limit: int = Query(20, ge=1, le=100),
+    current_user: dict = Depends(read_users_me),
+    db: AsyncSession = Depends(get_db),
+):
+    """我玩过的对局，按最近一轮倒序"""
+    query = (
+        select(GameSummary)
+        .where(GameSummary.username == current_user["username"])
+        .order_by(GameSummary.last_id.desc())
+        .limit(limit)
+    )
+    if cursor is not None:
+        query = query.where(GameSummary.last_id < cursor)
+
+    games = []
+    for row in (await db.execute(query)).scalars():
+        puzzle = puzzle_catalog.by_id.get(row.puzzle_id)
+        games.append(
+            {
+                "thread_id": row.thread_id,
+                "puzzle_id": row.puzzle_id,
+                "title": puzzle["title"] if puzzle else None,
+                "turns": row.turns,
+                "started_at": row.started_at.isoformat(),
+                "last_played_at": row.last_played_at.isoformat(),
+            }
+        )
+        cursor = row.last_id
+    return {"games": games, "next_cursor": cursor if len(games) == limit else None}
+
+
+@app.get("/history/{thread_id}")
+async def get_game_history(
+    thread_id: str,
+    after: int = Query(0, ge=0, description="上一页返回的 next_cursor"),
+    limit: int = Query(HISTORY_PAGE_SIZE, ge=1, le=500),
+    current_user: dict = Depends(read_users_me),
+    db: AsyncSession = Depends(get_db),
+):
+    """按轮次顺序分页回放某一局"""
+    turns = (
+        await db.scalars(
+            select(GameTurn)
+            .where(
+                GameTurn.username == current_user["username"],
+                GameTurn.thread_id == thread_id,
+                GameTurn.id > after,
+            )
+            .order_by(GameTurn.id)
+            .limit(limit)
+        )
+    ).all()
+    if not turns and after == 0:
+        raise HTTPException(status_code=404, detail="Game not found")
+    return {
+        "thread_id": thread_id,
+        "puzzle_id": turns[0].puzzle_id if turns else None,
+        "turns": [serialize_turn(turn) for turn in turns],
+        "next_cursor": turns[-1].id if len(turns) == limit else None,
+    }
+
+
+@app.get("/history/{thread_id}/export")
+async def export_game_history(thread_id: str, current_user: dict = Depends(read_users_me)):
+    """整局导出为 NDJSON (每行一轮)，服务端按批读取，内存占用与对局长度无关"""
+
+    async def rows():
+        after = 0
+        while True:
+            # 每批单独开一个会话，流式发送期间不长时间占用连接
+            async with AsyncSessionLocal() as db:
+                turns = (
+                    await db.scalars(
+                        select(GameTurn)
+                        .where(
+                            GameTurn.username == current_user["username"],
+                            GameTurn.thread_id == thread_id,
+                            GameTurn.id > after,
+                        )
+                        .order_by(GameTurn.id)
+                        .limit(HISTORY_EXPORT_BATCH)
+                    )
+                ).all()
+            for turn in turns:
+                yield json.dumps(serialize_turn(turn), ensure_ascii=False) + "\n"
+            if len(turns) < HISTORY_EXPORT_BATCH:
+                return
+            after = turns[-1].id
+
+    return StreamingResponse(rows(), media_type="application/x-ndjson")
+
+
+# --- 管理接口 ---
+# ADMIN_USERNAMES: 允许访问管理接口的用户名，逗号分隔
+ADMIN_USERNAMES = {
+    name.strip() for name in os.environ.get("ADMIN_USERNAMES", "").split(",") if name.strip()
+}
+
+
+async def require_admin(token: str = Depends(oauth2_scheme)) -> str:
+    username = decode_username(token)
+    if username is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Could not validate credentials",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    if username not in ADMIN_USERNAMES:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Admin only")
+    return username
+
+
+def query_usage_rollups(since: str) -> dict:
+    """从 usage_daily 汇总表按天 / 模型 / 用户聚合，不扫描明细账本"""
+    columns = [func.sum(getattr(UsageDaily, field)).label(field) for field in USAGE_ROLLUP_FIELDS]
+
+    def rows(db, *group_by):
+        query = db.query(*group_by, *columns).filter(UsageDaily.day >= since)
+        if group_by:
+            query = query.group_by(*group_by).order_by(*group_by)
+        result = []
+        for row in query.all():
+            item = row._asdict()
+            latency_ms = item.pop("latency_ms") or 0.0
+            item["cost"] = round(item["cost"] or 0.0, 6)
+            item["avg_latency_ms"] = round(latency_ms / item["calls"], 1) if item["calls"] else 0.0
+            result.append(item)
+        return result
+
+    db = SessionLocal()
+    try:
+        return {
+            "since": since,
+            "totals": rows(db)[0],
+            "by_day": rows(db, UsageDaily.day),
+            "by_model": rows(db, UsageDaily.model),
+            "by_user": rows(db, UsageDaily.username),
+        }
+    finally:
+        db.close()
+
+
+@app.get("/admin/usage")
+async def admin_usage(
+    days: int = Query(7, ge=1, le=366), admin: str = Depends(require_admin)
+):
+    """最近 days 天 (UTC) 的费用与 token 汇总；尚未落库的记录见 pending (最多延迟 USAGE_FLUSH_INTERVAL 秒)"""
+    since = (datetime.utcnow().date() - timedelta(days=days - 1)).isoformat()
+    report = await asyncio.to_thread(query_usage_rollups, since)
+    report["pending"] = usage_writer.stats()["buffered"]
+    return report
+
+
+@app.get("/puzzles")
+async def get_puzzles(
+    request: Request,
+    offset: int = Query(0, ge=0),
+    limit: int = Query(50, ge=1, le=200),
+    q: str = "",
+    unplayed: bool = Query(False, description="只看未玩 (需要登录)"),
+    username: Optional[str] = Depends(get_optional_username),
+):
+    """分页 / 搜索题目列表，只返回 id、标题和汤面摘要 (不含汤底)
+
+    所有人共用同一份预压缩的页面缓存；登录用户的“玩过 / 解开”标记见 /me/progress。
+    “只看未玩”在服务端按 PuzzleProgressIndex 过滤后再分页，每页都是满的，这种请求不走页面缓存。
+    """
+    if unplayed and username:
+        played, _ = await progress_index.get(username)
+        return puzzle_catalog.page_unplayed(q.strip(), offset, limit, played)
+    return puzzle_catalog.page(q.strip(), offset, limit).to_response(request)
+
+
+@app.get("/puzzles/random")
+async def get_random_puzzles(
+    count: int = Query(6, ge=1, le=50),
+    unplayed: bool = Query(False, description="只从未玩过的题里抽 (需要登录)"),
+    username: Optional[str] = Depends(get_optional_username),
+):
+    """大厅“换一批”: 从整个题库随机抽取 count 道题的摘要"""
+    catalog = puzzle_catalog.current
+    summaries = catalog.summaries
+    if unplayed and username:
+        played, _ = await progress_index.get(username)
+        if played:
+            summaries = [summaries[i] for i in catalog.unplayed("", played)]
+    return {
+        "total": len(summaries),
+        "items": random.sample(summaries, min(count, len(summaries))),
+    }
+
+
+@app.get("/me/progress")
+async def get_my_progress(current_user: dict = Depends(read_users_me)):
+    """当前用户玩过 / 解开的题目 id，前端和 /puzzles 的列表合并显示"""
+    played, solved = await progress_index.get(current_user["username"])
+    return {"played": sorted(played), "solved": sorted(solved)}
+
+
+def get_puzzle_or_404(puzzle_id: str) -> dict:
+    puzzle = puzzle_catalog.by_id.get(puzzle_id)
+    if puzzle is None:
+        raise HTTPException(status_code=404, detail="Puzzle not found")
+    return puzzle
+
+
+@app.get("/puzzles/{puzzle_id}")
+async def get_puzzle(puzzle_id: str):
+    """单个题目的详情 (不含汤底)"""
+    puzzle = get_puzzle_or_404(puzzle_id)
+    return {
+        "id": puzzle["id"],
+        "title": puzzle["title"],
+        "question": puzzle["question"],
+        "note": puzzle["note"],
+    }
+
+
+@app.post("/give_up")
+async def give_up(req: GiveUpRequest, current_user: dict = Depends(read_users_me)):
+    """放弃本局并查看汤底: 只对自己开的局生效；已经猜中的局直接返回汤底，不再记为放弃"""
+    config = {"configurable": {"thread_id": req.thread_id}}
+    async with thread_locks.hold(req.thread_id):
+        state = (await app_graph.aget_state(config)).values
+        if not state or state.get("username") != current_user["username"]:
+            raise HTTPException(status_code=404, detail="对局不存在或已过期")
+        puzzle = get_puzzle_or_404(state["puzzle_id"])
+        if not state.get("solved") and not state.get("given_up"):
+            await app_graph.aupdate_state(config, {"given_up": True})
+    return {"id": puzzle["id"], "answer": puzzle["answer"], "solved": state.get("solved", False)}
 
 
 @app.post("/upload_puzzle")
@@ -658,7 +3629,7 @@ async def upload_puzzle(
         return {"status": "success", "message": "上传成功", "file_id": file_id}
 
     except Exception as e:
-        print(f"Upload failed: {e}")
+        logger.error(f"Upload failed: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
@@ -74,6 +74,7 @@ function App() {
         <Game
           puzzle={currentPuzzle}
           model={selectedModel} // 将选中的模型传递给游戏组件
+          token={user?.token} // 带上登录态，后端按用户限流
           onBack={() => setView('menu')}
         />
       )}
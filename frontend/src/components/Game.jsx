@@ -3,7 +3,7 @@ import { useState, useEffect, useRef } from 'react';
 import ReactMarkdown from 'react-markdown';
 import { v4 as uuidv4 } from 'uuid';
 
-function Game({ puzzle, onBack, model }) {
+function Game({ puzzle, onBack, model, token }) {
     const [messages, setMessages] = useState([]);
     const [input, setInput] = useState('');
     const [isLoading, setIsLoading] = useState(false);
@@ -16,11 +16,23 @@ function Game({ puzzle, onBack, model }) {
     // 统计数据
     const [stats, setStats] = useState({
         lastTokens: 0,
+        lastCachedTokens: 0,
         lastCost: 0.0,
         totalCost: 0.0
     });
 
+    // 题目详情 (大厅里只有摘要)；汤底只在玩家放弃本局 (或已经猜中) 时才向后端请求
+    const [detail, setDetail] = useState(null);
+    const [answer, setAnswer] = useState(null);
+    const [solved, setSolved] = useState(false);
+
     const threadIdRef = useRef(uuidv4());
+
+    // 登录用户带上 token，后端按用户限流 (未登录按 IP)
+    const jsonHeaders = {
+        'Content-Type': 'application/json',
+        ...(token ? { Authorization: `Bearer ${token}` } : {})
+    };
     const chatEndRef = useRef(null);
 
     // === 修复的核心：自动滚动逻辑 ===
@@ -39,23 +51,49 @@ function Game({ puzzle, onBack, model }) {
             role: 'ai',
             content: `你好！我是本局的海龟汤主持人。\n\n**当前接入**: \`${model}\`\n\n请阅读左侧的汤面，然后向我提问。卡关时可以向我索要提示。猜出真相了请以"真相："开头描述你的复盘。`
         }]);
-        setStats({ lastTokens: 0, lastCost: 0.0, totalCost: 0.0 });
+        setStats({ lastTokens: 0, lastCachedTokens: 0, lastCost: 0.0, totalCost: 0.0 });
         setTurnCount(0);
 
-        // 2. 调用后端初始化
+        // 2. 拉取题目详情
+        setAnswer(null);
+        setSolved(false);
+        fetch(`/puzzles/${encodeURIComponent(puzzle.id)}`)
+            .then(res => res.json())
+            .then(data => setDetail(data))
+            .catch(err => console.error("API Error", err));
+
+        // 3. 调用后端初始化 (只传题目 id，汤面 / 汤底由服务端读取)
         fetch('/init', {
             method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
+            headers: jsonHeaders,
             body: JSON.stringify({
                 thread_id: threadIdRef.current,
-                story: puzzle.question,
-                truth: puzzle.answer,
+                puzzle_id: puzzle.id,
                 model: model
             })
         }).catch(err => console.error("API Error", err));
 
     }, [puzzle, model]);
 
+    const handleToggleAnswer = () => {
+        if (!showAnswer && answer === null) {
+            // 查看汤底即放弃本局，之后再猜中也不计入“已解开”
+            if (!solved && !window.confirm('查看汤底将放弃本局，确定吗？')) return;
+            fetch('/give_up', {
+                method: 'POST',
+                headers: jsonHeaders,
+                body: JSON.stringify({ thread_id: threadIdRef.current })
+            })
+                .then(res => res.ok ? res.json() : Promise.reject(res.status))
+                .then(data => setAnswer(data.answer))
+                .catch(err => {
+                    console.error("API Error", err);
+                    setAnswer('汤底获取失败，请重新开局后再试。');
+                });
+        }
+        setShowAnswer(!showAnswer);
+    };
+
     const handleSend = async () => {
         if (!input.trim() || isLoading) return;
         const userText = input.trim();
@@ -66,28 +104,86 @@ function Game({ puzzle, onBack, model }) {
         setIsLoading(true);
 
         try {
-            const res = await fetch('/chat', {
+            const res = await fetch('/chat/stream', {
                 method: 'POST',
-                headers: { 'Content-Type': 'application/json' },
+                // 每条消息一个幂等键，重复提交时后端直接返回第一次的结果
+                headers: { ...jsonHeaders, 'Idempotency-Key': uuidv4() },
                 body: JSON.stringify({
                     thread_id: threadIdRef.current,
                     message: userText
                 })
             });
-            const data = await res.json();
+            // 429: 提问太频繁；503: 服务器排队已满。按 Retry-After 提示玩家稍后再试
+            if (res.status === 429 || res.status === 503) {
+                const wait = res.headers.get('Retry-After') || '几';
+                const reason = res.status === 429 ? '提问太快了' : '服务器繁忙';
+                setMessages(prev => [...prev, { role: 'system', content: `⏳ ${reason}，请 ${wait} 秒后再试。` }]);
+                return;
+            }
+            if (!res.ok || !res.body) throw new Error(`Status: ${res.status}`);
+
+            // 逐行读取 NDJSON：token 行实时拼接到最后一条 AI 消息，final 行携带完整结果
+            const reader = res.body.getReader();
+            const decoder = new TextDecoder();
+            let buffer = '';
+            let started = false;
+
+            const appendToken = (text) => {
+                if (!started) {
+                    started = true;
+                    setIsLoading(false); // 首个 token 到达即隐藏加载动画
+                    setMessages(prev => [...prev, { role: 'ai', content: text }]);
+                } else {
+                    setMessages(prev => {
+                        const next = [...prev];
+                        const last = next[next.length - 1];
+                        next[next.length - 1] = { ...last, content: last.content + text };
+                        return next;
+                    });
+                }
+            };
 
-            // 显示 AI 回复
-            setMessages(prev => [...prev, { role: 'ai', content: data.reply }]);
+            const handleFinal = (data) => {
+                // 以服务端的完整回复为准（也覆盖了错误提示等非流式回复）
+                if (!started) {
+                    started = true;
+                    setMessages(prev => [...prev, { role: 'ai', content: data.reply }]);
+                } else {
+                    setMessages(prev => {
+                        const next = [...prev];
+                        next[next.length - 1] = { role: 'ai', content: data.reply };
+                        return next;
+                    });
+                }
 
-            if (data.turn_count) setTurnCount(data.turn_count);
+                if (data.turn_count) setTurnCount(data.turn_count);
+                if (data.solved) setSolved(true);
 
-            // 更新 Token 统计
-            if (data.cost_data) {
-                setStats(prev => ({
-                    lastTokens: data.cost_data.tokens,
-                    lastCost: data.cost_data.cost,
-                    totalCost: prev.totalCost + data.cost_data.cost
-                }));
+                // 更新 Token 统计
+                if (data.cost_data) {
+                    setStats(prev => ({
+                        lastTokens: data.cost_data.tokens,
+                        lastCachedTokens: data.cost_data.cached_tokens || 0,
+                        lastCost: data.cost_data.cost,
+                        totalCost: prev.totalCost + data.cost_data.cost
+                    }));
+                }
+            };
+
+            while (true) {
+                const { done, value } = await reader.read();
+                if (done) break;
+                buffer += decoder.decode(value, { stream: true });
+
+                let newlineIdx;
+                while ((newlineIdx = buffer.indexOf('\n')) >= 0) {
+                    const line = buffer.slice(0, newlineIdx).trim();
+                    buffer = buffer.slice(newlineIdx + 1);
+                    if (!line) continue;
+                    const event = JSON.parse(line);
+                    if (event.type === 'token') appendToken(event.content);
+                    else if (event.type === 'final') handleFinal(event);
+                }
             }
         } catch (e) {
             setMessages(prev => [...prev, { role: 'system', content: "❌ 发送失败，请检查后端。" }]);
@@ -117,17 +213,17 @@ function Game({ puzzle, onBack, model }) {
                     </div>
 
                     <div className="puzzle-title">{puzzle.title}</div>
-                    <div className="puzzle-content">{puzzle.question}</div>
+                    <div className="puzzle-content">{detail ? detail.question : puzzle.question}</div>
 
                     {showAnswer && (
                         <div className="answer-section show" style={{ display: 'block' }}>
                             <strong style={{ color: 'var(--accent)' }}>汤底：</strong>
-                            <p style={{ marginTop: 10 }}>{puzzle.answer}</p>
+                            <p style={{ marginTop: 10 }}>{answer ?? '加载中...'}</p>
                         </div>
                     )}
 
                     <div className="controls">
-                        <button className="btn-reveal" onClick={() => setShowAnswer(!showAnswer)}>
+                        <button className="btn-reveal" onClick={handleToggleAnswer}>
                             {showAnswer ? '🙈 隐藏汤底' : '👁 偷看汤底'}
                         </button>
                     </div>
@@ -163,6 +259,10 @@ function Game({ puzzle, onBack, model }) {
                         <span>本轮 Token:</span>
                         <span style={{ fontFamily: 'monospace', color: '#e2e8f0' }}>{stats.lastTokens}</span>
                     </div>
+                    <div style={{ display: 'flex', justifyContent: 'space-between' }}>
+                        <span>缓存命中:</span>
+                        <span style={{ fontFamily: 'monospace', color: '#e2e8f0' }}>{stats.lastCachedTokens}</span>
+                    </div>
                     <div style={{ display: 'flex', justifyContent: 'space-between' }}>
                         <span>本轮费用:</span>
                         <span style={{ fontFamily: 'monospace', color: '#e2e8f0' }}>${stats.lastCost.toFixed(5)}</span>
@@ -1,26 +1,103 @@
 // File: frontend/src/components/Menu.jsx
 import { useState, useEffect } from 'react';
-import { PUZZLE_DATA, AVAILABLE_MODELS } from '../data';
+import { AVAILABLE_MODELS } from '../data';
 import UploadModal from './UploadModal'; // 导入新创建的上传组件
 
+const PAGE_SIZE = 50; // 列表每页条数 (后端上限 200)
+const RANDOM_COUNT = 6; // 换一批每次显示的题数
+
 function Menu({ onStartGame, user, onLogout, selectedModel, onSelectModel }) {
-    const [puzzles, setPuzzles] = useState([]);
+    const [puzzles, setPuzzles] = useState([]); // 当前显示的题目摘要 (不含汤底)
+    const [total, setTotal] = useState(0);
+    const [nextOffset, setNextOffset] = useState(null); // 列表模式下一页的 offset，null 表示没有更多
+    const [listQuery, setListQuery] = useState(null); // 列表模式对应的搜索词；null 表示当前是随机推荐
+    const [loadingMore, setLoadingMore] = useState(false);
+    const [query, setQuery] = useState('');
+    const [onlyUnplayed, setOnlyUnplayed] = useState(false); // 只看未玩 (需要登录)
+    const [progress, setProgress] = useState(null); // { played: Set, solved: Set } 已玩 / 已解开的题目 id
     const [showUpload, setShowUpload] = useState(false); // 控制上传弹窗显示状态
 
-    // 初始化时加载题目
+    // “只看未玩”由后端按进度过滤后再分页 / 抽取，需要带上登录 token
+    const unplayedRequest = (unplayed) => ({
+        params: unplayed ? { unplayed: 'true' } : {},
+        headers: unplayed && user?.token ? { Authorization: `Bearer ${user.token}` } : {},
+    });
+
+    // 从后端分页加载题目摘要 (所有人共用同一份缓存，后端带 ETag，重复进入大厅走浏览器缓存)
+    // offset 为 0 时替换列表，否则追加到已加载的题目后面
+    const loadPage = async (q, offset = 0, unplayed = onlyUnplayed) => {
+        const extra = unplayedRequest(unplayed);
+        const params = new URLSearchParams({ limit: PAGE_SIZE, offset, q, ...extra.params });
+        const res = await fetch(`/puzzles?${params}`, { headers: extra.headers });
+        const data = await res.json();
+        setPuzzles(prev => offset === 0 ? data.items : [...prev, ...data.items]);
+        setTotal(data.total);
+        setNextOffset(data.next_offset);
+        setListQuery(q);
+    };
+
+    // 随机推荐: 由后端从整个题库里抽取
+    const loadRandom = async (unplayed = onlyUnplayed) => {
+        const extra = unplayedRequest(unplayed);
+        const params = new URLSearchParams({ count: RANDOM_COUNT, ...extra.params });
+        const res = await fetch(`/puzzles/random?${params}`, { headers: extra.headers });
+        const data = await res.json();
+        setPuzzles(data.items);
+        setTotal(data.total);
+        setNextOffset(null);
+        setListQuery(null);
+    };
+
+    // 个人进度单独请求，和列表在前端合并
+    const loadProgress = async () => {
+        if (!user?.token) return;
+        const res = await fetch('/me/progress', { headers: { Authorization: `Bearer ${user.token}` } });
+        if (!res.ok) return;
+        const data = await res.json();
+        setProgress({ played: new Set(data.played), solved: new Set(data.solved) });
+    };
+
+    // 初始化时加载随机推荐和进度
     useEffect(() => {
-        refreshPuzzles();
+        loadRandom().catch(err => console.error("API Error", err));
+        loadProgress().catch(err => console.error("API Error", err));
     }, []);
 
-    // 随机刷新题目逻辑
+    // 搜索标题 / 汤面
+    const handleSearch = () => {
+        loadPage(query.trim()).catch(err => console.error("API Error", err));
+    };
+
+    // 换一批 (随机)
     const refreshPuzzles = () => {
-        // 随机打乱并取前6个，保持界面整洁
-        const shuffled = [...PUZZLE_DATA].sort(() => 0.5 - Math.random());
-        setPuzzles(shuffled.slice(0, 6));
+        loadRandom().catch(err => console.error("API Error", err));
+    };
+
+    // 显示所有题目 (分页)
+    const handleViewAll = () => {
+        setQuery('');
+        loadPage('').catch(err => console.error("API Error", err));
     };
 
-    // 显示所有题目
-    const handleViewAll = () => setPuzzles(PUZZLE_DATA);
+    // 加载下一页
+    const handleLoadMore = () => {
+        if (nextOffset === null || loadingMore) return;
+        setLoadingMore(true);
+        loadPage(listQuery, nextOffset)
+            .catch(err => console.error("API Error", err))
+            .finally(() => setLoadingMore(false));
+    };
+
+    // 切换“只看未玩”: 按新的过滤条件重新加载当前视图 (随机推荐或列表第一页)
+    const handleToggleUnplayed = () => {
+        const next = !onlyUnplayed;
+        setOnlyUnplayed(next);
+        const reload = listQuery === null ? loadRandom(next) : loadPage(listQuery, 0, next);
+        reload.catch(err => console.error("API Error", err));
+    };
+
+    const isPlayed = (p) => progress?.played.has(p.id);
+    const isSolved = (p) => progress?.solved.has(p.id);
 
     // 打开上传弹窗
     const handleUpload = () => {
@@ -116,21 +193,68 @@ function Menu({ onStartGame, user, onLogout, selectedModel, onSelectModel }) {
                         <span>📤</span> 上传汤面
                     </button>
                 </div>
+
+                {/* --- 搜索区域 --- */}
+                <div style={{ display: 'flex', gap: '10px', justifyContent: 'center', marginTop: '20px' }}>
+                    <input
+                        type="text"
+                        value={query}
+                        onChange={(e) => setQuery(e.target.value)}
+                        onKeyPress={(e) => e.key === 'Enter' && handleSearch()}
+                        placeholder="搜索标题或汤面..."
+                        style={{
+                            padding: '10px 15px',
+                            borderRadius: '8px',
+                            background: 'rgba(30, 41, 59, 0.8)',
+                            border: '1px solid rgba(255,255,255,0.2)',
+                            color: '#e2e8f0',
+                            outline: 'none',
+                            minWidth: '280px'
+                        }}
+                    />
+                    <button className="refresh-btn" onClick={handleSearch}>
+                        <span>🔍</span> 搜索
+                    </button>
+                    {user?.token && (
+                        <button
+                            className="refresh-btn"
+                            onClick={handleToggleUnplayed}
+                            style={onlyUnplayed ? { borderColor: 'var(--accent)', color: 'var(--accent)' } : {}}
+                        >
+                            <span>{onlyUnplayed ? '☑' : '☐'}</span> 只看未玩
+                        </button>
+                    )}
+                </div>
             </header>
 
             {/* --- 题目卡片网格 --- */}
             <div className="cards-grid">
-                {puzzles.map((p, index) => (
-                    <div key={index} className="menu-card" onClick={() => onStartGame(p)}>
+                {puzzles.map((p) => (
+                    <div key={p.id} className="menu-card" onClick={() => onStartGame(p)} style={isSolved(p) ? { opacity: 0.6 } : {}}>
+                        {isPlayed(p) && (
+                            <span style={{ float: 'right', fontSize: '0.75rem', padding: '2px 6px', borderRadius: '4px', background: isSolved(p) ? 'rgba(80, 200, 120, 0.2)' : 'rgba(245, 158, 11, 0.2)' }}>
+                                {isSolved(p) ? '✅ 已解开' : '👣 玩过'}
+                            </span>
+                        )}
                         <h3>{p.title || '无题档案'}</h3>
-                        <p>{p.question.length > 60 ? p.question.substring(0, 60) + "..." : p.question}</p>
+                        <p>{p.question}</p>
                     </div>
                 ))}
             </div>
 
+            {/* --- 加载更多 (列表 / 搜索模式) --- */}
+            {nextOffset !== null && (
+                <div style={{ textAlign: 'center', marginTop: '20px' }}>
+                    <button className="refresh-btn" onClick={handleLoadMore} disabled={loadingMore}>
+                        {loadingMore ? '加载中...' : `加载更多 (${puzzles.length} / ${total})`}
+                    </button>
+                </div>
+            )}
+
             {/* --- 底部状态栏 --- */}
             <div style={{ textAlign: 'center', marginTop: '30px', color: '#666', fontSize: '0.8rem' }}>
-                SYSTEM STATUS: ONLINE | {puzzles.length} ENTRIES LOADED
+                SYSTEM STATUS: ONLINE | {puzzles.length} / {total} ENTRIES LOADED
+                {progress && ` | PLAYED ${progress.played.size} · SOLVED ${progress.solved.size}`}
             </div>
 
             {/* --- 上传弹窗组件 (条件渲染) --- */}
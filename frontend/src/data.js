@@ -54,219 +54,3 @@ export const AVAILABLE_MODELS = [
     },
 ];
 
-
-export const PUZZLE_DATA = [
-    {
-        "question": "小明在图书馆看书，在一本书里翻到了100块钱，但是他却哭了。",
-        "answer": "小明是一个不火的作家，他在图书馆自己写的书里放了张100元，如果有人看到就会拿走表示有人看了他的书，而至今这100还是夹在书里，表示至今都没有人看过小明的书，于是小明哭了。",
-        "note": "这是一个海龟汤谜题。",
-        "title": "100元钱"
-    },
-    {
-        "question": "一个男人放手抛出保龄球。不久，他被送往医院急诊。",
-        "answer": "这个男人是一个物理教授。他在课堂上演示能量守恒定律。他用绳子把一个保龄球拴在天花板上，然后双手握球置于脸前并站在房间一侧。根据动能和重力势能的相互转化，松手后保龄球将荡到房间另一侧再荡回来，但其幅度不会超过初始位置。不幸的是，教授放手时稍微用了一点推力，这导致实验失败。",
-        "note": "男人当时在课堂上演示，因此会有很多学生作他的观众",
-        "title": "保龄球"
-    },
-    {
-        "question": "一个男人走进一家餐馆，大吃一顿，却没有支付任何费用。",
-        "answer": "这个男人是一位知名艺术家。一个专门收集名人签名的女人看到了该艺术家正在用餐，于是待他用餐完毕并用支票支付费用后，从餐厅经理那儿买下了支票。该支票从未被兑现，因此男人并未为这顿大餐支付任何费用。",
-        "note": "这是一个海龟汤谜题。",
-        "title": "免费的大餐"
-    },
-    {
-        "question": "小明半夜起来喝水，然后把灯关上继续睡觉，醒了之后他就自杀了，为什么?",
-        "answer": "小明是一个海上的灯塔守护人，他半夜起来顺手把灯塔的灯关掉了，那些大型船只找不到方向、乱作一团甚至发生海难，小明自责所以自杀了。",
-        "note": "喝水只是导致半夜起床、从而不小心将灯关掉的原因，并不是谜题的重点。",
-        "title": "关灯之后"
-    },
-    {
-        "question": "两个死人，现场只有一把枪，一颗子弹，一副牌。发生了什么？",
-        "answer": "两个人在潜艇里，潜艇在深水因故障进水，两个人赌牌，赢的人才可以用枪自杀，体面死去。输的人只能在潜艇中痛苦地死亡。",
-        "note": "故事中一个人死于枪击，另一个人死于潜艇失事",
-        "title": "对赌"
-    },
-    {
-        "question": "海伦从未想到，她乘坐飞机旅行的决定会挽救她的生命。",
-        "answer": "几天前，海伦接受了手术。在登机前，她必须通过金属探测器，尽管她已经摘掉了身上所有的金属物品，但金属探测器一直响个不停。经过X光检查后，发现医生在她体内留了一把手术刀。如果不是海伦及时发现，她必死无疑。",
-        "note": "这是一个海龟汤谜题。",
-        "title": "延迟死亡"
-    },
-    {
-        "question": "小强养了一只很忠诚的狗，今天他牵着狗上街，然后小强死了。为什么？",
-        "answer": "小强这次上街突发心脏病，狗不让其他人靠近主人包括医生。耽误了治疗时间，导致了小强的死亡。",
-        "note": "这是一个海龟汤谜题。",
-        "title": "忠诚的狗"
-    },
-    {
-        "question": "妻子怀孕了两次，一次高兴 ，一次哭。为什么？",
-        "answer": "妻子怀孕的时候，丈夫得了精神病，习惯了妻子怀孕的模样。 妻子生出孩子肚子就不大了，丈夫很不习惯 ，于是把妻子绑在沙发上， 往她的肚子里注水， 直到注射到和妻子怀孕一样大为止……",
-        "note": "这是一个海龟汤谜题。",
-        "提供者的社交媒体链接": "chii",
-        "title": "怀孕"
-    },
-    {
-        "question": "我在和闺蜜聊天，忽然手机掉在了地上。闺蜜吓傻了。 我死了。 为什么？",
-        "answer": "晚上 我在房间和闺蜜视频聊天 忽然我手一滑 手机掉在了地上 闺蜜通过视频看到我床下有个男人 那个男人见我要捡手机 怕被发现就冲出来把我杀了 闺蜜目睹一切 吓傻了！",
-        "note": "这是一个海龟汤谜题。",
-        "提供者的社交媒体链接": "chii",
-        "title": "手滑"
-    },
-    {
-        "question": "一天，游手好闲的阿星在大街上游荡。正巧碰上一所小学放学，他在拥挤的人流中不幸被无良小学生倒，小学生不仅没有道歉而且还出言挑衅阿星，阿星却没有因此生气反而很高兴，这是为什么?",
-        "answer": "小学生很生气的说了一句：“你是哪个班的？下次带我哥揍你。”年近30的阿星没想到自己在小学生眼里看上去这么年轻，心里舒坦了很多。",
-        "note": "这是一个海龟汤谜题。",
-        "title": "挑衅"
-    },
-    {
-        "question": "我六岁那年，外公去世，我和亲人一起去祭奠，和姐姐玩捉迷藏，然后我对母亲说了句话把她吓昏了过去，我说了什么?",
-        "answer": "我去参加外公的葬礼，同行的还有比我大两岁的姐姐，我和她玩捉迷藏，我没有找到她。没想到她躲在了纸做的房子里，当纸房子被点燃，姐姐被烧死了。我对妈说，姐姐在那房子里面跳舞。",
-        "note": "谜题的重点包括：纸房子，姐姐在祭奠中被烧死。",
-        "title": "捉迷藏"
-    },
-    {
-        "question": "我跟妈妈玩捉迷藏，当妈妈看到我时，我却一动也不能动了。",
-        "answer": "我跟妈妈在家玩捉迷藏，我藏到了床底下，随着咚咚咚的脚步声，我知道妈妈要进来了，可当门被打开后，我看到了妈妈的眼睛，她倒在地上，身体被人拖着，似乎已经没有了呼吸，而我捂着口鼻一动也不敢动！",
-        "note": "1.故事中除了“我“”和妈妈还有其他人，也就是闯入家里并杀害、拖动妈妈的人。2.重点是这个事实本身，而非行凶的原因和凶手的身份",
-        "title": "捉迷藏2"
-    },
-    {
-        "question": "我有两个哥哥，我们三兄弟自小就睡在一张床上。后来有一天二哥因为生病死了，不久后我把大哥也杀了。",
-        "answer": "我的两个哥哥是双胞胎。从小我们关系就特别好，同睡一张床。大哥睡我左边，二哥睡我右边，十几年了，我已经习惯了这样。可是有一天二哥却因为得了大病死了。我床的右边就这样空了。我很不习惯，突然我想到了!把大哥砍成两半不就好了吗，今天晚上我又睡得好香。",
-        "note": "无",
-        "title": "接连死去的哥哥"
-    },
-    {
-        "question": "个没有护照的普通美国公民，一天之内访问了30多个国家。在每个国家里他都受到热情招待，并且离开时也完全自由。",
-        "answer": "他是一个送信人，负责将包裹送到各个大使馆。大使馆的领地为使馆国所有。",
-        "note": "这是一个海龟汤谜题。",
-        "title": "日访三十国"
-    },
-    {
-        "question": "他在公园的长椅上醒来。昨天晚上，他刚向苏珊求婚，而她已经几乎接受了他，并让他第二天下午去她家。他舒缓着酥麻的腿脚，叩响了她的门，喊着苏珊的名字。然而房门打开后，他才意识到有事情不对劲。",
-        "answer": "他是阿兹海默症患者，经常觉得自己还在刚刚跟妻子表白的那天。这天他又一次走丢并在长椅上睡着，他凭着记忆找回家以为能见到自己的女朋友，然而确实跟自己妻子有几分相似的孙女，他这才意识到自己又犯病了。",
-        "note": "这是一个海龟汤谜题。",
-        "提供者的社交媒体链接": "bilibiliUID：11627331 Bot_824",
-        "title": "最棒的一天"
-    },
-    {
-        "question": "他被自己做的早餐杀死了。",
-        "answer": "这个男人在登雪山。他做早餐时放了些胡椒，这致使他大声地打了个喷嚏，从而引起雪崩。",
-        "note": "这是一个海龟汤谜题。",
-        "title": "杀人早餐"
-    },
-    {
-        "question": "一个男人杀死自己的妻子，然后回到自己的房间，而后自杀。",
-        "answer": "为了庆祝自己50岁生日，男人计划杀死自己的妻子，然后拿走所有的钱，到一个新的城市去过一个崭新的生活。他的妻子带他出去晚餐，回家时男人在房前杀死了她。他打开家门，把妻子的尸体拖进房间，突然屋里的所有灯同时亮起，他的朋友们跳出来大叫“Surprise”。他自杀了。",
-        "note": "男人自杀的原因是他明白来给他惊喜的朋友们一定会发现他杀害妻子的事实。",
-        "title": "杀妻后自杀"
-    },
-    {
-        "question": "我在床上躺着看直播，刷到了一个漆黑的直播间，直播间里越来越亮，我看到了天花板，然后我死了。",
-        "answer": "我观看的这个直播间正在直播杀人，巧的是这一次要杀的人就是我。我关着灯躺在床上看直播，所以直播间里漆黑一片。主播进来后打开了灯，直播间逐渐变亮，而我也能看见天花板了。看清我位置的主播把我给杀了。",
-        "note": "这是一个海龟汤谜题。",
-        "title": "死亡直播"
-    },
-    {
-        "question": "一名男子被发现死在一间空荡荡的房间里，附近只有一池水。他怎么死的？",
-        "answer": "他被冰柱刺伤了。",
-        "note": "只要答出死者是被冰刺伤/刺死的，就可以判定为完全正确。",
-        "title": "水池中的死者"
-    },
-    {
-        "question": "他决定给经济拮据的母亲治病，却被母亲强硬地拒绝了。",
-        "answer": "生意破产的母亲患了肾衰竭，需要肾移植，他决定将自己的肾捐给母亲。他不知道的是，自己的一个肾，早在小的时候，就被因为做生意而缺钱的母亲卖掉了。",
-        "note": "男人，也就是汤面中的“他”现在只有一个肾了。",
-        "title": "治病"
-    },
-    {
-        "question": "一个女孩独居，陪伴她的只有爱犬。半夜醒来，她听到一下一下的水滴声，非常害怕。于是把手放到了床边，让爱犬舔了舔她的手，渐渐又睡着了。第二天，她发现狗死了。",
-        "answer": "当天晚上小偷潜入她家，为避免狗叫惊醒女孩，就将狗杀死，滴水声是狗在流血。舔她手的也不是她的狗，而是躺在她床边的小偷。",
-        "note": "这是一个海龟汤谜题。",
-        "title": "爱犬"
-    },
-    {
-        "question": "男人照常做了一笔赚钱生意，但是以往很支持他的家人，这次却非常愤怒。",
-        "answer": "男人是一个人贩子，年轻时靠此发家致富，家人也很高兴。但他现在换了老年痴呆，转手将孙子卖了，家人们很愤怒。",
-        "note": "这是一个海龟汤谜题。",
-        "title": "生意"
-    },
-    {
-        "question": "一个人住在高层公寓楼里。每天下班回家后，他对电梯有一个不寻常的习惯。如果下雨，他总是乘电梯到他住的楼层，即 17 层。如果没有下雨，但电梯里还有其他人，那么他也乘电梯到17楼。但如果没有下雨，而且电梯里只有他一个人，那么他就会乘电梯到11楼，然后走楼梯走完剩下的路。",
-        "answer": "这个男人异常矮小。他只能按到11楼的按钮。如果电梯里还有其他人，他会要求他们按他所在楼层的按钮。如果下雨了，他就会用雨伞按下按钮。",
-        "note": "1.主角是儿童也是一种可能的解释方式（儿童身高不高）",
-        "title": "电梯里的人"
-    },
-    {
-        "question": "一个人坐火车去临镇看病，看完之后病全好了。回来的路上火车经过一个隧道，这个人就跳车自杀了。",
-        "answer": "因为他看好的是眼睛的病。经过隧道，以为眼睛又看不见了。经受不住打击，自杀了。",
-        "note": "这是一个海龟汤谜题。",
-        "title": "看病"
-    },
-    {
-        "question": "男人无法想象他的感冒会导致他的死亡。",
-        "answer": "男人家发生了煤气泄漏，但由于他感冒了，所以他闻不到煤气的味道。他在做饭时起火而死。",
-        "note": "间接导致男人死亡的症状是嗅觉的丧失。",
-        "title": "看起来没那么严重"
-    },
-    {
-        "question": "在儿子去世一周年的祭日上， 我杀死了三个来悼念他的人。",
-        "answer": "儿子生病去世，他在临终前告诉我，把他的器官捐献给有需要的人，这样他就能以另外的方式继续活在世界上。我同意了。最后儿子身上有三个器官分别捐献给了三个不同的人。在儿子的祭日上，我认出了他们，接受皮肤捐赠的男人，居然满身都是纹身，接受肺部捐赠的小伙，不停地在那吸烟，而接受肝捐赠的居然打电话约朋友晚上出去喝酒。我儿子把生的机会留给他们，但他们竟然这样继续糟践自己。我深深为儿子感到不甘，愤怒不已的我杀了他们三个。",
-        "note": "被我杀死的人具体怎样滥用或忽视儿子捐献的器官并不是重点。",
-        "title": "祭日"
-    },
-    {
-        "question": "我接到了一个电话，然后杀死了一个人。",
-        "answer": "我的私人医生在电话那头说，我有严重的精神分裂，那个所谓的朋友不过是我幻想出来的。我想继续问下去，可是朋友过来了，他疑惑地问我为什么要对着一部坏掉的电话说话。医生告诉我说，只要彻底把这个幻想出来的朋友杀死，他就不会出现在我的世界里了。现在我蹲坐在尸体边上，等待着他从我的世界消失。",
-        "note": "电话是我的臆想，朋友是真实存在的。",
-        "title": "私人医生"
-    },
-    {
-        "question": "每次单独走路都能听到两个人的脚步声，有一次终于变成一个人的了，我却后悔了。",
-        "answer": "我是一个盲人，爸爸不放心我出门每次都会悄悄跟上，可我却不知道一直以为有人尾随。有一天，一辆失控的卡车向我冲了过来，千钧一发之际爸爸从后面跑过来推开了我，自己却葬身车下。脚步声终于变成一个人的了，可是爸爸却永远离开了我。",
-        "note": "这是一个海龟汤谜题。",
-        "title": "脚步声"
-    },
-    {
-        "question": "两兄弟在酒吧喝酒。他们开始争吵。其中一人掏枪射杀了另一人。不久后他自己也不幸身亡。",
-        "answer": "两兄弟是连体人。其中一人抱怨另一人不讲卫生，口臭难忍，并掏枪杀死了他。他自己也因失血过多而死。",
-        "note": "谜题的重点是两兄弟是连体人的特殊生理症状。",
-        "title": "自相残杀"
-    },
-    {
-        "question": "我正在街上努力工作，突然一个疯疯癫癫的女人向我扑来，爸爸赶紧把我抱回了家，但随后那个女人又跟来了。",
-        "answer": "“爸爸”并不是我真正的爸爸，而是将我拐走的人贩子，而那个疯癫的女人就是一直在寻找我的妈妈，那天我跟着“爸爸”在街上行乞，她一眼就认出了被折磨的不成人形的我，人贩子见事情败露，急忙将我抱回了家，妈妈为了复仇，用人贩子折磨我的方式折磨人贩子，随后杀了他，我终于可以回家了。",
-        "note": "爸爸不是“我”真正的爸爸，而是人贩子，将我折磨得不成人形，带到街上乞讨。",
-        "title": "街上的工作"
-    },
-    {
-        "question": "我的裤子破了，我知道我马上要死了。",
-        "answer": "我是一名宇航员，这一天我正身着宇航服在太空中执行任务，突然我发现我的裤子破了，之后我暴露在太空中，不到几秒钟，我将死去",
-        "note": "1.这条裤子是宇航服的一部分,并不是普通的裤子。2.谜题的重点是“我”作为宇航员身处太空的特殊境况。",
-        "title": "裤子破了"
-    },
-    {
-        "question": "我有一个要好的朋友，我们形影不离。可惜，他死了。",
-        "answer": "我一直孤单，长期的孤独引发了我的妄想症。在妄想中，我有一个很好的朋友。我的症状被家人发现，我被迫接受治疗。我的妄想症治好了，他也就死了。",
-        "note": "这是一个海龟汤谜题。",
-        "title": "要好的朋友"
-    },
-    {
-        "question": "一个男人走进一家酒吧，并向酒保要了一杯水。酒保拿出一支枪并瞄准他，该名男子说：“谢谢你！”然后离开，请问发生了什么事？",
-        "answer": "该名男子打嗝，他希望喝一杯水来改善状况。酒保意识到这一点，选择拿枪吓他，男子一紧张之下，打嗝自然消失，因而衷心感谢酒保后就离开了。",
-        "note": "这是一个海龟汤谜题。",
-        "title": "要水拿枪"
-    },
-    {
-        "question": "两个男人在车头灯关闭的情况下朝对方行驶。看不到月亮或星星，附近也没有电灯。两辆车都漆成黑色，没有反光表面。然而两人都知道何时该踩刹车并险些避免撞到对方。这怎么可能？",
-        "answer": "现在是白天。 （而且今天是阴天，这就是为什么我们称之为太阳的恒星看不见的原因。）",
-        "note": "谜题唯一的关键线索是当时是白天。",
-        "title": "车头灯关闭"
-    },
-    {
-        "question": "“祝你生日快乐”，我终于在45岁这天度过了6岁的生日。",
-        "answer": "我在6岁生日到来之前，在路边玩耍的时候被人贩子拐走了。在45岁生日到来之际，我终于找到了我的家",
-        "note": "这是一个海龟汤谜题。",
-        "title": "长路终有归途"
-    }
-];
\ No newline at end of file